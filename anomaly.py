@@ -0,0 +1,296 @@
+import json
+import math
+import sqlite3
+import logging
+import argparse
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Online degradation detection, run on every new row in the same
+# transaction that stores it. Each probe's download, upload and ping keep
+# an EWMA baseline (mean and variance of the log value, so noise is
+# relative) and a one-sided CUSUM of standardized deviations in the bad
+# direction. An incident opens when the CUSUM crosses CUSUM_H and closes
+# after CLEAR_RUNS samples back within CLEAR_Z of the baseline, which
+# stays frozen meanwhile. Shifts of less than MIN_SEVERITY are learned as
+# the new baseline rather than reported. ERROR_RUNS failed tests in a row
+# open an 'error' incident, closed by the next success. The per-metric
+# state is a handful of numbers kept in anomaly_state, so each sample
+# costs O(1) and history is never rescanned.
+METRICS = {'download': -1, 'upload': -1, 'ping': 1}   # sign of a degradation
+ALPHA = 0.05              # EWMA weight of each new sample
+WARMUP = 12               # samples learned before any alarm
+CUSUM_K = 0.5             # deviations (in std devs) below this are noise
+CUSUM_H = 5.0             # CUSUM level that opens an incident
+CLEAR_RUNS = 3            # samples back to normal that close an incident
+CLEAR_Z = 2.0             # deviations (in std devs) that count as back to normal
+ERROR_RUNS = 2            # failed tests in a row that open an error incident
+MIN_SEVERITY = 0.2        # smaller deviations are absorbed into the baseline instead
+CLIP = 3.0                # baseline updates are clipped to this many std devs
+MIN_STD = 0.05            # noise floor of the log value, i.e. 5%
+MAX_INCIDENT_SAMPLES = 672  # degraded samples (a week at 15 min) before a new level is accepted
+FLOOR = 0.001             # smallest value taken the log of
+ROW_COLUMNS = 'id, probe_id, ts, download, upload, ping, error'
+
+def create_incident_tables(c):
+    """Create the incidents table, the detector state and its high-water mark
+
+    Detection starts from the newest row: existing history is not
+    scanned (see rebuild_incidents).
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS incidents
+                 (id INTEGER PRIMARY KEY,
+                  probe_id TEXT NOT NULL,
+                  metric TEXT NOT NULL,
+                  start_ts INTEGER NOT NULL,
+                  end_ts INTEGER,
+                  last_ts INTEGER NOT NULL,
+                  severity REAL NOT NULL,
+                  baseline REAL,
+                  samples INTEGER NOT NULL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_incidents_start ON incidents (start_ts)')
+    c.execute('''CREATE TABLE IF NOT EXISTS anomaly_state
+                 (probe_id TEXT NOT NULL,
+                  metric TEXT NOT NULL,
+                  state TEXT NOT NULL,
+                  PRIMARY KEY (probe_id, metric)) WITHOUT ROWID''')
+    max_id = c.execute('SELECT MAX(id) FROM speedtests').fetchone()[0]
+    c.execute("INSERT OR IGNORE INTO meta VALUES ('detected_id', ?)", (max_id or 0,))
+
+def get_detected_id(c):
+    """Return the highest speedtests.id already fed to the detector"""
+    row = c.execute("SELECT value FROM meta WHERE key = 'detected_id'").fetchone()
+    return row[0] if row else 0
+
+def _new_state():
+    return {'n': 0, 'mean': 0.0, 'var': 0.0, 'cusum': 0.0, 'since': None,
+            'incident': None, 'severity': 0.0, 'samples': 0, 'clear': 0, 'last': None,
+            'recovered': None}
+
+def _learn(state, x, z, std):
+    """Fold x into the EWMA baseline, clipped so one outlier can't drag it"""
+    delta = max(-CLIP, min(CLIP, z)) * std
+    state['mean'] += ALPHA * delta
+    state['var'] = (1 - ALPHA) * (state['var'] + ALPHA * delta * delta)
+    state['n'] += 1
+
+class Detector:
+    """Detector state for the rows of one transaction, written back by flush()"""
+
+    def __init__(self, c):
+        self.c = c
+        self.states = {}
+        self.dirty = set()
+        self.opened = 0
+        self.closed = 0
+
+    def _state(self, probe_id, metric):
+        key = (probe_id, metric)
+        state = self.states.get(key)
+        if state is None:
+            row = self.c.execute('SELECT state FROM anomaly_state WHERE probe_id = ? AND metric = ?',
+                                 key).fetchone()
+            state = self.states[key] = json.loads(row[0]) if row else _new_state()
+        self.dirty.add(key)
+        return state
+
+    def _open(self, probe_id, metric, state, start_ts, ts, severity, baseline):
+        self.c.execute('''INSERT INTO incidents
+                          (probe_id, metric, start_ts, last_ts, severity, baseline, samples)
+                          VALUES (?, ?, ?, ?, ?, ?, 1)''',
+                       (probe_id, metric, start_ts, ts, severity, baseline))
+        state.update(incident=self.c.lastrowid, severity=severity, samples=1, clear=0,
+                     last=ts, recovered=None)
+        self.opened += 1
+
+    def _close(self, state, end_ts):
+        self.c.execute('''UPDATE incidents SET end_ts = ?, last_ts = ?, severity = ?, samples = ?
+                          WHERE id = ?''',
+                       (end_ts, state['last'], state['severity'], state['samples'],
+                        state['incident']))
+        state.update(incident=None, cusum=0.0, since=None)
+        self.closed += 1
+
+    def observe(self, probe_id, ts, download, upload, ping, error):
+        """Feed one row to the detectors of its probe"""
+        errors = self._state(probe_id, 'error')
+        if error is not None:
+            if errors['incident'] is not None:
+                errors['samples'] += 1
+                errors['last'] = ts
+                return
+            errors['n'] += 1
+            if errors['n'] == 1:
+                errors['since'] = ts
+            if errors['n'] >= ERROR_RUNS:
+                self._open(probe_id, 'error', errors, errors['since'], ts, 1.0, None)
+                errors['samples'] = errors['n']
+            return
+        errors['n'] = 0
+        if errors['incident'] is not None:
+            self._close(errors, ts)
+        for metric, value in (('download', download), ('upload', upload), ('ping', ping)):
+            if value is not None:
+                self._observe_metric(probe_id, metric, self._state(probe_id, metric), ts, value)
+
+    def _observe_metric(self, probe_id, metric, state, ts, value):
+        x = math.log(max(value, FLOOR))
+        if state['n'] == 0:
+            state.update(n=1, mean=x, var=0.0)
+            return
+        std = max(math.sqrt(state['var']), MIN_STD)
+        z = (x - state['mean']) / std
+        score = METRICS[metric] * z
+        if state['incident'] is not None:
+            if score < CLEAR_Z:
+                state['clear'] += 1
+                if state['clear'] == 1:
+                    state['recovered'] = ts
+                if state['clear'] >= CLEAR_RUNS:
+                    self._close(state, state['recovered'])
+            else:
+                state['clear'] = 0
+                state['samples'] += 1
+                state['last'] = ts
+                state['severity'] = max(state['severity'], self._severity(metric, x, state))
+                if state['samples'] >= MAX_INCIDENT_SAMPLES:
+                    # Not an incident any more but the new normal
+                    self._close(state, ts)
+                    state.update(mean=x, var=0.0, n=1)
+            return
+        if state['n'] < WARMUP:
+            _learn(state, x, z, std)
+            return
+        cusum = max(0.0, state['cusum'] + score - CUSUM_K)
+        if cusum > 0 and state['cusum'] == 0:
+            state['since'] = ts
+        state['cusum'] = cusum
+        if cusum > CUSUM_H:
+            severity = self._severity(metric, x, state)
+            if severity >= MIN_SEVERITY:
+                self._open(probe_id, metric, state, state['since'], ts, severity,
+                           math.exp(state['mean']))
+                return
+            # Significant but slight: let the baseline follow
+            state['cusum'] = CUSUM_H
+            _learn(state, x, z, std)
+        elif cusum == 0:
+            # Otherwise only in-control samples teach the baseline
+            state['since'] = None
+            _learn(state, x, z, std)
+
+    @staticmethod
+    def _severity(metric, x, state):
+        """Relative deviation from the baseline: the fraction of speed lost, or extra ping"""
+        ratio = math.exp(x - state['mean'])
+        return round(1 - ratio if METRICS[metric] < 0 else ratio - 1, 4)
+
+    def flush(self):
+        """Write back open incidents' progress and every touched state"""
+        states = [self.states[key] for key in self.dirty]
+        self.c.executemany('''UPDATE incidents SET last_ts = ?, severity = ?, samples = ?
+                              WHERE id = ?''',
+                           [(state['last'], state['severity'], state['samples'], state['incident'])
+                            for state in states if state['incident'] is not None])
+        self.c.executemany('INSERT OR REPLACE INTO anomaly_state VALUES (?, ?, ?)',
+                           [(probe_id, metric, json.dumps(self.states[probe_id, metric]))
+                            for probe_id, metric in self.dirty])
+        self.dirty.clear()
+
+def detect_pending(c, limit=-1):
+    """Feed speedtests rows above the high-water mark to the detector
+
+    Runs inside the caller's transaction, next to the rollup update. Rows
+    are taken in id (arrival) order, at most limit of them (-1: all).
+    Returns the number of rows seen.
+    """
+    rows = c.execute('''SELECT %s FROM speedtests WHERE id > ? ORDER BY id LIMIT ?'''
+                     % ROW_COLUMNS, (get_detected_id(c), limit)).fetchall()
+    if not rows:
+        return 0
+    _observe(c, rows)
+    c.execute("UPDATE meta SET value = ? WHERE key = 'detected_id'", (rows[-1][0],))
+    return len(rows)
+
+def _observe(c, rows):
+    """Run ROW_COLUMNS rows through the detector and store the outcome"""
+    detector = Detector(c)
+    for row in rows:
+        detector.observe(*row[1:])
+    detector.flush()
+    if detector.opened or detector.closed:
+        logger.info("Incidents: %d opened, %d closed", detector.opened, detector.closed)
+
+def get_incidents(c, start_ts=None, end_ts=None, probe_id=None):
+    """Incidents overlapping [start_ts, end_ts), oldest first, as dicts
+
+    end_ts is None while an incident is still open.
+    """
+    clauses, params = [], []
+    if end_ts is not None:
+        clauses.append('start_ts < ?')
+        params.append(end_ts)
+    if start_ts is not None:
+        clauses.append('(end_ts IS NULL OR end_ts > ?)')
+        params.append(start_ts)
+    if probe_id is not None:
+        clauses.append('probe_id = ?')
+        params.append(probe_id)
+    c.execute('''SELECT id, probe_id, metric, start_ts, end_ts, last_ts, severity, baseline, samples
+                 FROM incidents %s ORDER BY start_ts, id'''
+              % ('WHERE ' + ' AND '.join(clauses) if clauses else ''), params)
+    fields = ('id', 'probe_id', 'metric', 'start_ts', 'end_ts', 'last_ts', 'severity',
+              'baseline', 'samples')
+    return [dict(zip(fields, row)) for row in c.fetchall()]
+
+def rebuild_incidents(conn, batch_size=50000):
+    """Forget every incident and replay the whole history through the detector
+
+    Shards can't be attached inside conn's write transaction, so history
+    is read through a second, read-only connection, a batch of sealed
+    months at a time (see shards.ranges) and in id order within each.
+    """
+    import shards  # shards imports this module
+    path = conn.execute('PRAGMA database_list').fetchone()[2]
+    reader = sqlite3.connect('file:%s?mode=ro' % quote(path), uri=True)
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM incidents')
+        c.execute('DELETE FROM anomaly_state')
+        last_id = 0
+        for lo, hi in shards.ranges(reader):
+            clauses, params = shards.ts_clause(lo, hi)
+            where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+            rows = reader.execute('SELECT %s FROM speedtests %s ORDER BY id'
+                                  % (ROW_COLUMNS, where), params)
+            # The same code path as live inserts, a bounded number of rows at a time
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                _observe(c, batch)
+                last_id = max(last_id, batch[-1][0])
+        c.execute("UPDATE meta SET value = ? WHERE key = 'detected_id'", (last_id,))
+        c.execute('COMMIT')
+    except BaseException:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        reader.close()
+    return c.execute('SELECT COUNT(*) FROM incidents').fetchone()[0]
+
+def _main():
+    parser = argparse.ArgumentParser(description='Replay history through the incident detector')
+    parser.add_argument('db_path', help='path to speedtest.db')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.db_path, isolation_level=None)
+    try:
+        logger.info("Found %d incidents", rebuild_incidents(conn))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    _main()
@@ -1,11 +1,33 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, abort, g, jsonify, render_template, request
 import sqlite3
 import logging
 import sys
+import queue
+import threading
 import os
+import time
 from datetime import datetime, timedelta
-import plotly.graph_objs as go
+from urllib.parse import urlencode
 import json
+import mimetypes
+import numpy as np
+from werkzeug.utils import safe_join
+import downsample
+import db
+import rollups
+import sketch
+import probes
+import latency
+import export
+import shards
+import anomaly
+import heatmap
+import payload
+from response_cache import LRUCache
+from snapshot import SharedSnapshot
+from window_cache import WindowCache
+from events import ChangeFeed
+import metrics
 
 # Configure logging to output to both file and console
 logging.basicConfig(
@@ -23,238 +45,306 @@ logger = logging.getLogger(__name__)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(SCRIPT_DIR, 'speedtest.db')
 
+# Versioned third-party assets, served from /vendor/ with immutable caching
+VENDOR_DIR = os.path.join(SCRIPT_DIR, 'vendor')
+PLOTLY_JS = 'plotly-4.1.1.min.js'
+VENDOR_MAX_AGE = 365 * 86400  # seconds
+
+# Bounds for the number of points per plotted series (?points=N)
+DEFAULT_MAX_POINTS = 2000
+MIN_POINTS = 10
+MAX_POINTS = 20000
+
+# Columnar copy of recent samples (see sync_window_cache)
+window_cache = WindowCache()
+
+# Computed payloads and rendered pages, keyed on the data they came from
+stats_cache = LRUCache(maxsize=256)
+plot_cache = LRUCache(maxsize=256)
+html_cache = LRUCache(maxsize=64)
+CACHES = {'stats': stats_cache, 'series': plot_cache, 'html': html_cache}
+
+# Prometheus metrics, served at /metrics
+REQUEST_DURATION = metrics.Histogram('bandwidth_probe_http_request_duration_seconds',
+                                     'Time to handle a request, per route',
+                                     ['route', 'method', 'status'])
+SQL_DURATION = metrics.Histogram('bandwidth_probe_sql_duration_seconds',
+                                 'Time spent in one dashboard query or cache sync',
+                                 ['query'])
+RENDER_DURATION = metrics.Histogram('bandwidth_probe_render_duration_seconds',
+                                    'Time to render a template', ['template'])
+
 # Create Flask app
 app = Flask(__name__)
+# How many days of recent samples the in-memory window cache holds
+app.config.setdefault('WINDOW_CACHE_DAYS', 7)
+# Seconds between the /events watcher's checks for new samples
+app.config.setdefault('EVENTS_POLL_INTERVAL', 1.0)
+# Seconds of idle time before /events sends a keepalive comment
+app.config.setdefault('EVENTS_KEEPALIVE', 15.0)
+# Bearer token remote collectors must send to /api/ingest (None: no check)
+app.config.setdefault('INGEST_TOKEN', os.environ.get('INGEST_TOKEN'))
+# Largest ingest batch accepted, after decompression
+app.config.setdefault('MAX_INGEST_BYTES', probes.MAX_BATCH_BYTES)
+# Share computed stats and plots between worker processes (set by serve.py)
+app.config.setdefault('SHARED_SNAPSHOT', False)
+
+# The snapshot file shared by every worker, when SHARED_SNAPSHOT is set
+snapshot = None
+snapshot_lock = threading.Lock()
+
+# The single watcher thread feeding every /events subscriber
+change_feed = None
+change_feed_lock = threading.Lock()
 
 def get_db_connection():
-    """Create a database connection"""
+    """Return the request thread's database connection"""
     try:
         # Use test database if configured
         db_path = app.config.get('DATABASE', DB_PATH)
         if not os.path.exists(db_path):
             logger.warning("Database does not exist at %s", db_path)
             return None
-        conn = sqlite3.connect(db_path)
-        logger.debug("Database connection established to %s", db_path)
+        # Pooled per-thread read-only connection; do not close it. The
+        # shard view the request it last served may have left is dropped,
+        # so readers that don't attach shards read the main database.
+        conn = db.get_reader(db_path)
+        shards.detach(conn)
         return conn
     except Exception as e:
         logger.error("Database connection failed: %s", str(e))
         return None
 
-def get_stats(conn, offset_days=0):
-    """Calculate statistics for the dashboard"""
-    cursor = conn.cursor()
+def to_epoch(dt):
+    """Convert a naive local datetime to the integer epoch stored in speedtests.ts"""
+    return int(dt.timestamp())
+
+def attach_window(conn, start_date=None, end_date=None):
+    """Read the monthly shards holding start_date < ts <= end_date along with the main database"""
+    with SQL_DURATION.labels('attach_shards').time():
+        shards.attach(conn, to_epoch(start_date) + 1 if start_date is not None else None,
+                      to_epoch(end_date) + 1 if end_date is not None else None)
+
+def sync_window_cache(conn):
+    """Tail new rows into the window cache and return its column snapshot"""
+    window_cache.window_seconds = app.config['WINDOW_CACHE_DAYS'] * 86400
+    with SQL_DURATION.labels('window_cache_sync').time():
+        return window_cache.sync(conn)
+
+def window_cache_covers(cursor, start_ts):
+    """Whether a window starting at start_ts can be read from the window cache
     
-    # Get 24 hours of data based on offset
+    The cache only tails new rows from the main database, so it is not
+    used for windows that reach into compacted history or sealed shards.
+    """
+    return (window_cache.covers(start_ts) and start_ts >= rollups.get_floors(cursor)[0]
+            and start_ts >= shards.sealed_until(cursor))
+
+def get_window(offset_days=0):
+    """Return the (start, end) datetimes of the 24h window at offset_days"""
     end_date = datetime.now() - timedelta(days=offset_days)
-    start_date = end_date - timedelta(days=1)
-    
-    # Calculate period-specific stats for successful tests
-    cursor.execute('''
-        SELECT 
-            MIN(download) as min_down,
-            MAX(download) as max_down,
-            AVG(download) as avg_down,
-            MIN(upload) as min_up,
-            MAX(upload) as max_up,
-            AVG(upload) as avg_up,
-            COUNT(*) as test_count
-        FROM speedtests
-        WHERE error IS NULL
-        AND timestamp > ?
-        AND timestamp <= ?
-    ''', (start_date.isoformat(), end_date.isoformat()))
-    period_stats = cursor.fetchone()
-    
-    # Get period error count and total tests
-    cursor.execute('''
-        SELECT 
-            SUM(CASE WHEN error IS NOT NULL THEN 1 ELSE 0 END) as error_count,
-            COUNT(*) as total_count
-        FROM speedtests
-        WHERE timestamp > ?
-        AND timestamp <= ?
-    ''', (start_date.isoformat(), end_date.isoformat()))
-    period_row = cursor.fetchone()
-    period_errors = period_row[0] if period_row[0] is not None else 0
-    period_total = period_row[1] if period_row[1] is not None else 0
-    
-    # Calculate overall stats for successful tests
-    cursor.execute('''
-        SELECT 
-            MIN(download) as min_down,
-            MAX(download) as max_down,
-            AVG(download) as avg_down,
-            MIN(upload) as min_up,
-            MAX(upload) as max_up,
-            AVG(upload) as avg_up,
-            COUNT(*) as test_count
-        FROM speedtests
-        WHERE error IS NULL
-    ''')
-    overall_stats = cursor.fetchone()
+    return end_date - timedelta(days=1), end_date
+
+def summarize(aggregate, metric):
+    """Return min/max/avg for one metric of a rollup aggregate"""
+    count = aggregate['count']
+    return {
+        'min': aggregate[metric + '_min'] or 0,
+        'max': aggregate[metric + '_max'] or 0,
+        'avg': aggregate[metric + '_sum'] / count if count else 0
+    }
+
+def _section_stats(aggregate, distribution):
+    """Structure one stats section (period or overall) from its aggregate"""
+    total, errors = aggregate['total_count'], aggregate['error_count']
+    return {
+        'download': summarize(aggregate, 'down'),
+        'upload': summarize(aggregate, 'up'),
+        'test_count': aggregate['count'],
+        'error_count': errors,
+        'error_chart': {
+            'data': [{
+                'type': 'pie',
+                'values': [total - errors, errors],
+                'labels': ['Success', 'Failure'],
+                'hole': 0.4,
+                'marker': {'colors': ['#2ecc71', '#e74c3c']}
+            }],
+            'layout': {
+                'showlegend': False,
+                'margin': {'t': 0, 'b': 0, 'l': 0, 'r': 0},
+                'height': 150,
+                'width': 300
+            }
+        },
+        'distribution': distribution
+    }
+
+def get_period_stats(conn, offset_days=0, distributions=True, probe=None):
+    """Calculate the stats section for the 24h window at offset_days"""
+    cursor = conn.cursor()
     
-    # Get overall error count and total tests
-    cursor.execute('''
-        SELECT 
-            SUM(CASE WHEN error IS NOT NULL THEN 1 ELSE 0 END) as error_count,
-            COUNT(*) as total_count
-        FROM speedtests
-    ''')
-    overall_row = cursor.fetchone()
-    overall_errors = overall_row[0] if overall_row[0] is not None else 0
-    overall_total = overall_row[1] if overall_row[1] is not None else 0
+    # Get 24 hours of data based on offset
+    start_date, end_date = get_window(offset_days)
+    start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+    attach_window(conn, start_date, end_date)
     
-    # Structure the stats data
-    stats = {
-        'period': {
-            'download': {
-                'min': period_stats[0] if period_stats[0] is not None else 0,
-                'max': period_stats[1] if period_stats[1] is not None else 0,
-                'avg': period_stats[2] if period_stats[2] is not None else 0
-            },
-            'upload': {
-                'min': period_stats[3] if period_stats[3] is not None else 0,
-                'max': period_stats[4] if period_stats[4] is not None else 0,
-                'avg': period_stats[5] if period_stats[5] is not None else 0
-            },
-            'test_count': period_stats[6] if period_stats[6] is not None else 0,
-            'error_count': period_errors,
-            'error_chart': {
-                'data': [{
-                    'type': 'pie',
-                    'values': [period_total - period_errors, period_errors],
-                    'labels': ['Success', 'Failure'],
-                    'hole': 0.4,
-                    'marker': {'colors': ['#2ecc71', '#e74c3c']}
-                }],
-                'layout': {
-                    'showlegend': False,
-                    'margin': {'t': 0, 'b': 0, 'l': 0, 'r': 0},
-                    'height': 150,
-                    'width': 300
-                }
-            },
-            'distribution': get_distribution_data(cursor, 'period', start_date.isoformat(), end_date.isoformat())
-        },
-        'overall': {
-            'download': {
-                'min': overall_stats[0] if overall_stats[0] is not None else 0,
-                'max': overall_stats[1] if overall_stats[1] is not None else 0,
-                'avg': overall_stats[2] if overall_stats[2] is not None else 0
-            },
-            'upload': {
-                'min': overall_stats[3] if overall_stats[3] is not None else 0,
-                'max': overall_stats[4] if overall_stats[4] is not None else 0,
-                'avg': overall_stats[5] if overall_stats[5] is not None else 0
-            },
-            'test_count': overall_stats[6] if overall_stats[6] is not None else 0,
-            'error_count': overall_errors,
-            'error_chart': {
-                'data': [{
-                    'type': 'pie',
-                    'values': [overall_total - overall_errors, overall_errors],
-                    'labels': ['Success', 'Failure'],
-                    'hole': 0.4,
-                    'marker': {'colors': ['#2ecc71', '#e74c3c']}
-                }],
-                'layout': {
-                    'showlegend': False,
-                    'margin': {'t': 0, 'b': 0, 'l': 0, 'r': 0},
-                    'height': 150,
-                    'width': 300
-                }
-            },
-            'distribution': get_distribution_data(cursor, 'overall')
-        }
+    # Recent windows are answered from the in-memory columns; older ones
+    # from whole-hour rollups, with only partial hours and not-yet-rolled
+    # rows read from speedtests, and compacted ones from the rollups
+    # alone. A single probe is read through its index.
+    columns = sync_window_cache(conn)
+    with SQL_DURATION.labels('period_aggregate').time():
+        if probe is not None:
+            period = rollups.probe_aggregate(cursor, probe, start_ts, end_ts)
+        elif window_cache_covers(cursor, start_ts):
+            period = window_cache.aggregate(columns, start_ts, end_ts)
+        else:
+            period = rollups.window_aggregate(cursor, start_ts, end_ts)
+    distribution = (get_distribution_data(cursor, 'period', start_ts, end_ts, period, probe)
+                    if distributions else None)
+    return _section_stats(period, distribution)
+
+def get_overall_stats(conn, distributions=True, probe=None):
+    """Calculate the all-time stats section"""
+    cursor = conn.cursor()
+    with SQL_DURATION.labels('overall_aggregate').time():
+        if probe is not None:
+            overall = rollups.probe_aggregate(cursor, probe)
+        else:
+            overall = rollups.overall_aggregate(cursor)
+    distribution = (get_distribution_data(cursor, 'overall', aggregate=overall, probe=probe)
+                    if distributions else None)
+    return _section_stats(overall, distribution)
+
+def get_stats(conn, offset_days=0, distributions=True, probe=None):
+    """Calculate statistics for the dashboard, for every probe or just one"""
+    return {
+        'period': get_period_stats(conn, offset_days, distributions, probe),
+        'overall': get_overall_stats(conn, distributions, probe)
+    }
+
+def _box_trace(counts, name, color, aggregate=None, metric=None):
+    """Build a precomputed Plotly box trace from a histogram sketch"""
+    lo = hi = mean = None
+    if aggregate is not None and aggregate['count']:
+        lo, hi = aggregate[metric + '_min'], aggregate[metric + '_max']
+        mean = aggregate[metric + '_sum'] / aggregate['count']
+    q1, median, q3 = sketch.quantiles(counts, [0.25, 0.5, 0.75], lo, hi)
+    if lo is None:
+        lo, hi = sketch.quantiles(counts, [0.0, 1.0])
+    iqr = q3 - q1
+    return {
+        'type': 'box',
+        'name': name,
+        'q1': [q1],
+        'median': [median],
+        'q3': [q3],
+        'lowerfence': [max(lo, q1 - 1.5 * iqr)],
+        'upperfence': [min(hi, q3 + 1.5 * iqr)],
+        'mean': [mean if mean is not None else sketch.mean(counts)],
+        'boxmean': True,
+        'line': {'color': color}
     }
-    return stats
-
-def get_distribution_data(cursor, period_type, start_date=None, end_date=None):
-    """Generate distribution data for download and upload speeds"""
-    if period_type == 'period':
-        cursor.execute('''
-            SELECT download, upload
-            FROM speedtests
-            WHERE error IS NULL
-            AND timestamp > ?
-            AND timestamp <= ?
-            ORDER BY timestamp
-        ''', (start_date, end_date))
-    else:  # overall
-        cursor.execute('''
-            SELECT download, upload
-            FROM speedtests
-            WHERE error IS NULL
-            ORDER BY timestamp
-        ''')
+
+def get_distribution_data(cursor, period_type, start_ts=None, end_ts=None, aggregate=None,
+                          probe=None):
+    """Generate distribution data for download and upload speeds
     
-    rows = cursor.fetchall()
-    if not rows:
-        return None
+    Distributions are read from the rollup quantile sketches, so the payload
+    is a handful of numbers per chart however much history there is.
+    """
+    columns = sync_window_cache(cursor.connection) if period_type == 'period' else None
+    with SQL_DURATION.labels(period_type + '_distribution').time():
+        if probe is not None:
+            downloads = rollups.probe_sketch(cursor, probe, 'down', start_ts, end_ts)
+            uploads = rollups.probe_sketch(cursor, probe, 'up', start_ts, end_ts)
+        elif period_type == 'period' and window_cache_covers(cursor, start_ts):
+            downloads = sketch.histogram(window_cache.values(columns, 'down', start_ts, end_ts))
+            uploads = sketch.histogram(window_cache.values(columns, 'up', start_ts, end_ts))
+        elif period_type == 'period':
+            downloads = rollups.window_sketch(cursor, 'down', start_ts, end_ts)
+            uploads = rollups.window_sketch(cursor, 'up', start_ts, end_ts)
+        else:  # overall
+            downloads = rollups.overall_sketch(cursor, 'down')
+            uploads = rollups.overall_sketch(cursor, 'up')
     
-    downloads = [row[0] for row in rows]
-    uploads = [row[1] for row in rows]
+    if not downloads.sum():
+        return None
     
     return {
         'download': {
-            'data': [{
-                'type': 'violin',
-                'y': downloads,
-                'name': 'Download',
-                'box': {'visible': True},
-                'line': {'color': '#3498db'},
-                'meanline': {'visible': True}
-            }],
+            'data': [_box_trace(downloads, 'Download', '#3498db', aggregate, 'down')],
             'layout': {
                 'showlegend': False,
                 'margin': {'t': 0, 'b': 0, 'l': 30, 'r': 0},
                 'height': 100,
-                'yaxis': {'title': ''}
+                'yaxis': {'title': {'text': ''}}
             }
         },
         'upload': {
-            'data': [{
-                'type': 'violin',
-                'y': uploads,
-                'name': 'Upload',
-                'box': {'visible': True},
-                'line': {'color': '#2ecc71'},
-                'meanline': {'visible': True}
-            }],
+            'data': [_box_trace(uploads, 'Upload', '#2ecc71', aggregate, 'up')],
             'layout': {
                 'showlegend': False,
                 'margin': {'t': 0, 'b': 0, 'l': 30, 'r': 0},
                 'height': 100,
-                'yaxis': {'title': ''}
+                'yaxis': {'title': {'text': ''}}
             }
         }
     }
 
-def get_plot_data(conn, offset_days=0):
+def plot_title(start_date, end_date):
+    """Format the date range for the plot title"""
+    start_str = start_date.strftime('%Y-%m-%d %H:%M')
+    end_str = end_date.strftime('%Y-%m-%d %H:%M')
+    return f'Bandwidth for {start_str} to {end_str}'
+
+def get_plot_data(conn, offset_days=0, max_points=DEFAULT_MAX_POINTS, probe=None):
     """Generate plot data for the dashboard"""
     cursor = conn.cursor()
     
     # Get 24 hours of data based on offset
-    end_date = datetime.now() - timedelta(days=offset_days)
-    start_date = end_date - timedelta(days=1)
+    start_date, end_date = get_window(offset_days)
+    start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+    attach_window(conn, start_date, end_date)
     
-    cursor.execute('''
-        SELECT timestamp, download, upload
-        FROM speedtests
-        WHERE error IS NULL 
-        AND timestamp > ? 
-        AND timestamp <= ?
-        ORDER BY timestamp
-    ''', (start_date.isoformat(), end_date.isoformat()))
+    columns = sync_window_cache(conn)
+    raw_floor = rollups.get_floors(cursor)[0]
+    if probe is None and window_cache_covers(cursor, start_ts):
+        ts, downloads, uploads = window_cache.series(columns, start_ts, end_ts)
+    else:
+        with SQL_DURATION.labels('series').time():
+            # Compacted history is plotted as hourly or daily averages
+            rows = []
+            raw_start = start_ts
+            if probe is None and start_ts < raw_floor:
+                rows = rollups.compacted_series(cursor, start_ts, end_ts)
+                raw_start = max(start_ts, raw_floor - 1)
+            probe_clause = 'AND probe_id = ?' if probe is not None else ''
+            cursor.execute('''
+                SELECT ts, download, upload
+                FROM speedtests
+                WHERE error IS NULL 
+                AND ts > ? 
+                AND ts <= ?
+                %s
+                ORDER BY ts
+            ''' % probe_clause, (raw_start, end_ts) + probe_params(probe))
+            rows += cursor.fetchall()
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        ts, downloads, uploads = columns[:, 0], columns[:, 1], columns[:, 2]
     
-    rows = cursor.fetchall()
-    if not rows:
+    if not len(ts):
         return None
-        
-    timestamps = [row[0] for row in rows]
-    downloads = [row[1] for row in rows]
-    uploads = [row[2] for row in rows]
+    
+    # Downsample on the server so the page never carries more than
+    # max_points samples per trace, whatever the window or sample rate
+    x, (downloads, uploads) = downsample.downsample(ts, [downloads, uploads], max_points)
+    
+    # Binary-encoded; NaN gap markers break the lines
+    timestamps = payload.time_array(x)
+    downloads = payload.float32_array(downloads)
+    uploads = payload.float32_array(uploads)
     
     data = [
         {
@@ -273,23 +363,270 @@ def get_plot_data(conn, offset_days=0):
         }
     ]
     
-    # Format date range for title
-    start_str = start_date.strftime('%Y-%m-%d %H:%M')
-    end_str = end_date.strftime('%Y-%m-%d %H:%M')
-    title = f'Bandwidth for {start_str} to {end_str}'
-    
     layout = {
-        'title': title,
-        'xaxis': {'title': 'Time'},
-        'yaxis': {'title': 'Speed (Mbps)'}
+        'title': {'text': plot_title(start_date, end_date)},
+        'xaxis': {'title': {'text': 'Time'}},
+        'yaxis': {'title': {'text': 'Speed (Mbps)'}}
     }
     
     return {'data': data, 'layout': layout}
 
+# One color per latency target, reused in order
+LATENCY_COLORS = ['#9b59b6', '#e67e22', '#1abc9c', '#34495e', '#e74c3c']
+
+def latency_minutes(offset_days=0):
+    """Epoch minutes [start, end) of the 24h window at offset_days
+    
+    The minute in progress is included: the sampler writes it once it ends.
+    """
+    start_date, end_date = get_window(offset_days)
+    return to_epoch(start_date) // 60, to_epoch(end_date) // 60 + 1
+
+def get_latency_plot(series):
+    """Plot p50/p99 RTT and loss of every latency target"""
+    data = []
+    for i, (target, columns) in enumerate(sorted(series.items())):
+        color = LATENCY_COLORS[i % len(LATENCY_COLORS)]
+        times = payload.time_array(np.array(columns['minute'], dtype=np.int64) * 60)
+        data.append({'type': 'scatter', 'x': times, 'y': payload.float32_array(columns['rtt_p50']),
+                     'name': target + ' p50', 'line': {'color': color}})
+        data.append({'type': 'scatter', 'x': times, 'y': payload.float32_array(columns['rtt_p99']),
+                     'name': target + ' p99', 'line': {'color': color, 'dash': 'dot'}})
+        data.append({'type': 'bar', 'x': times, 'y': payload.float32_array(columns['loss']),
+                     'yaxis': 'y2', 'name': target + ' loss', 'marker': {'color': color},
+                     'opacity': 0.4})
+    layout = {
+        'title': {'text': 'Latency (TCP connect)'},
+        'xaxis': {'title': {'text': 'Time'}},
+        'yaxis': {'title': {'text': 'RTT (ms)'}, 'rangemode': 'tozero'},
+        'yaxis2': {'title': {'text': 'Loss (%)'}, 'overlaying': 'y', 'side': 'right',
+                   'range': [0, 100], 'showgrid': False}
+    }
+    return {'data': data, 'layout': layout}
+
+# Incident shading: speed and ping degradations in red, failed tests in grey
+INCIDENT_COLORS = {'error': '127, 140, 141'}
+INCIDENT_COLOR = '231, 76, 60'
+
+def get_incident_shapes(cursor, offset_days=0, probe=None):
+    """Shade the incidents in the 24h window, deeper for more severe ones
+    
+    Open incidents are drawn up to the end of the window.
+    """
+    start_date, end_date = get_window(offset_days)
+    start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+    with SQL_DURATION.labels('incidents').time():
+        incidents = anomaly.get_incidents(cursor, start_ts, end_ts, probe)
+    shapes = []
+    for incident in incidents:
+        end = incident['end_ts'] if incident['end_ts'] is not None else end_ts
+        alpha = 0.1 + 0.3 * min(incident['severity'], 1.0)
+        shapes.append({'type': 'rect', 'xref': 'x', 'yref': 'paper', 'layer': 'below',
+                       'x0': datetime.fromtimestamp(max(incident['start_ts'], start_ts)).isoformat(),
+                       'x1': datetime.fromtimestamp(min(end, end_ts)).isoformat(),
+                       'y0': 0, 'y1': 1, 'line': {'width': 0},
+                       'fillcolor': 'rgba(%s, %.2f)' % (
+                           INCIDENT_COLORS.get(incident['metric'], INCIDENT_COLOR), alpha)})
+    return shapes
+
+def probe_params(probe):
+    """Query parameters for an optional 'AND probe_id = ?' clause"""
+    return (probe,) if probe is not None else ()
+
+def get_data_version(conn, offset_days=0, probe=None):
+    """Identify the data behind a window as (max_id, window_min_id, window_max_id, window_count, *tiers)
+    
+    max_id changes whenever a sample is saved anywhere; the window part
+    changes only when a sample enters, leaves or is removed from the 24h
+    window at offset_days (for one probe, if given). All of it is answered
+    from the id, ts and (probe_id, ts) indexes. tiers is all zeroes unless
+    the window reaches into compacted history.
+    """
+    with SQL_DURATION.labels('data_version').time():
+        return _data_version(conn.cursor(), offset_days, probe)
+
+def _data_version(cursor, offset_days, probe):
+    start_date, end_date = get_window(offset_days)
+    attach_window(cursor.connection, start_date, end_date)
+    cursor.execute('SELECT MAX(id) FROM main.speedtests')
+    max_id = cursor.fetchone()[0]
+    cursor.execute('''
+        SELECT MIN(id), MAX(id), COUNT(*)
+        FROM speedtests
+        WHERE ts > ?
+        AND ts <= ?
+        %s
+    ''' % ('AND probe_id = ?' if probe is not None else ''),
+        (to_epoch(start_date), to_epoch(end_date)) + probe_params(probe))
+    window = cursor.fetchone()
+    # Windows reaching into compacted history are read from the rollups,
+    # which change as the window slides by an hour or compaction moves on
+    start_ts = to_epoch(start_date)
+    raw_floor, hour_floor = rollups.get_floors(cursor)
+    tiers = (start_ts // 3600, raw_floor, hour_floor) if start_ts < raw_floor else (0, 0, 0)
+    return (max_id or 0, window[0] or 0, window[1] or 0, window[2]) + tiers
+
+def get_snapshot():
+    """Return the snapshot shared with other worker processes, or None"""
+    global snapshot
+    if not app.config['SHARED_SNAPSHOT']:
+        return None
+    path = os.path.splitext(app.config.get('DATABASE', DB_PATH))[0] + '.snapshot'
+    with snapshot_lock:
+        if snapshot is None or snapshot.path != path:
+            snapshot = SharedSnapshot(path)
+        return snapshot
+
+def cached(cache, key, compute):
+    """compute() through this process's cache, then the shared snapshot if enabled"""
+    shared = get_snapshot()
+    if shared is None:
+        return cache.get_or_compute(key, compute)
+    return cache.get_or_compute(key, lambda: shared.get_or_compute(key, compute))
+
+def cached_stats(conn, offset_days, version, distributions=True, probe=None):
+    """get_stats through the stats cache
+    
+    The period section is keyed on the window's contents, so historical
+    windows survive new inserts; the overall section is keyed on max_id.
+    """
+    max_id, window = version[0], version[1:]
+    return {
+        'period': cached(stats_cache, ('period', offset_days, distributions, probe) + window,
+                         lambda: get_period_stats(conn, offset_days, distributions, probe)),
+        'overall': cached(stats_cache, ('overall', distributions, probe, max_id),
+                          lambda: get_overall_stats(conn, distributions, probe))
+    }
+
+def cached_plot_data(conn, offset_days, max_points, version, probe=None):
+    """get_plot_data through the plot cache, keyed on the window's contents"""
+    plot_data = cached(plot_cache, ('series', offset_days, max_points, probe) + version[1:],
+                       lambda: get_plot_data(conn, offset_days, max_points, probe))
+    if plot_data is None:
+        return None
+    # The title names the current window bounds, which move with the clock,
+    # as do the ends of open incidents
+    layout = dict(plot_data['layout'], title={'text': plot_title(*get_window(offset_days))},
+                  shapes=get_incident_shapes(conn.cursor(), offset_days, probe))
+    return {'data': plot_data['data'], 'layout': layout}
+
+def make_etag(kind, offset, version, *key):
+    """Build the (unquoted) ETag for an API resource
+
+    It names the data version, not the bytes sent, which differ with the
+    content encoding, so it is always sent as a weak validator.
+    """
+    return '-'.join(str(part) for part in (kind, offset) + key + version)
+
+def not_modified(etag):
+    """Whether the request's If-None-Match has etag, by weak comparison"""
+    return request.if_none_match.contains_weak(etag)
+
+def conditional_json(kind, offset, build, *key):
+    """Serve build(conn, version) as JSON with an ETag, or 304 if the client has it
+    
+    The ETag is derived from the data version, so the payload is only
+    recomputed when a sample has been added or has left the window.
+    """
+    probe = get_probe()
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    
+    try:
+        version = get_data_version(conn, offset, probe)
+        etag = make_etag(kind, offset, version, *(key + probe_params(probe)))
+        if not_modified(etag):
+            logger.debug("Not modified: %s", etag)
+            response = app.response_class(status=304)
+        else:
+            response = jsonify(build(conn, version))
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error("Database query failed: %s", str(e))
+        return jsonify({'error': str(e)}), 500
+
+def get_probe():
+    """Read the ?probe=ID filter; None means every probe"""
+    probe = request.args.get('probe') or None
+    if probe is not None and not probes.valid_probe_id(probe):
+        abort(400, 'Invalid probe id')
+    return probe
+
+def api_url(path, probe, **params):
+    """URL of an API resource as the dashboard requests it"""
+    if probe is not None:
+        params['probe'] = probe
+    return path + ('?' + urlencode(params) if params else '')
+
+def get_max_points():
+    """Read the per-request ?points=N target, clamped to sane bounds"""
+    points = request.args.get('points', DEFAULT_MAX_POINTS, type=int)
+    return max(MIN_POINTS, min(points, MAX_POINTS))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    """Observe the request's duration under its route pattern, not its path"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.labels(route, request.method, response.status_code).observe(
+            time.perf_counter() - start)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress text responses with the best encoding the client accepts
+
+    Streamed responses (exports, /events) and ones already encoded are
+    left alone. The compressed bytes differ from the identity ones, so a
+    strong ETag is made weak: caches then can't serve one encoding's
+    304 or byte range for the other.
+    """
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in payload.COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(payload.available_encodings())
+    body = response.get_data()
+    if encoding is None or len(body) < payload.MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(payload.compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/vendor/<filename>')
+def vendor_asset(filename):
+    """Serve a vendored asset; its name carries its version, so it never changes"""
+    path = safe_join(VENDOR_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    encoding = request.accept_encodings.best_match(payload.available_encodings())
+    response = Response(payload.compressed_asset(path, encoding),
+                        content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = VENDOR_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/')
 @app.route('/<int:offset>')
 def index(offset=0):
     logger.info(f"Received request for index page with offset {offset}")
+    probe = get_probe()
     conn = get_db_connection()
     if conn is None:
         return 'Database not found. Please start the collector first.', 503
@@ -297,29 +634,333 @@ def index(offset=0):
     try:
         # Get the earliest timestamp to determine max offset
         cursor = conn.cursor()
-        cursor.execute('SELECT MIN(timestamp) FROM speedtests WHERE error IS NULL')
-        earliest_timestamp = cursor.fetchone()[0]
+        if probe is None:
+            earliest_ts = rollups.earliest_ts(cursor)
+        else:
+            earliest_ts = rollups.probe_earliest_ts(cursor, probe)
         max_offset = 0
         
-        if earliest_timestamp:
-            earliest_date = datetime.fromisoformat(earliest_timestamp)
+        if earliest_ts is not None:
+            earliest_date = datetime.fromtimestamp(earliest_ts)
             max_offset = (datetime.now() - earliest_date).days
         
-        stats = get_stats(conn, offset)
-        plot_data = get_plot_data(conn, offset)
+        # Read the data version first so a sample saved mid-render makes
+        # the next poll fetch again rather than being missed
+        version = get_data_version(conn, offset, probe)
+        max_points = get_max_points()
+        end_minute = get_window(offset)[1].strftime('%Y-%m-%d %H:%M')
         
-        return render_template('index.html',
-                             stats=stats,
-                             plot_data=plot_data,
-                             now=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                             current_offset=offset,
-                             max_offset=max_offset)
+        def render():
+            stats = cached_stats(conn, offset, version, probe=probe)
+            plot_data = cached_plot_data(conn, offset, max_points, version, probe)
+            
+            # API URLs and their ETags matching this render, so the page's
+            # first poll is already answered with 304 if nothing changed
+            extra = probe_params(probe)
+            api_urls = {
+                'stats': api_url('/api/stats', probe),
+                'series': api_url('/api/series', probe, points=max_points),
+                'distribution': api_url('/api/distribution', probe)
+            }
+            etags = {
+                api_urls['stats']: 'W/"%s"' % make_etag('stats', offset, version, *extra),
+                api_urls['series']: 'W/"%s"' % make_etag('series', offset, version, max_points,
+                                                         *extra),
+                api_urls['distribution']: 'W/"%s"' % make_etag('distribution', offset, version,
+                                                               *extra)
+            }
+            
+            probe_ids = [row[0] for row in probes.list_probes(conn.cursor())]
+            with RENDER_DURATION.labels('index.html').time():
+                return render_template('index.html',
+                                       stats=stats,
+                                       plot_data=plot_data,
+                                       now=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                       current_offset=offset,
+                                       max_points=max_points,
+                                       api_urls=api_urls,
+                                       etags=etags,
+                                       probe=probe,
+                                       probes=probe_ids,
+                                       plotly_js=PLOTLY_JS,
+                                       heatmap_lookbacks=heatmap.LOOKBACKS,
+                                       heatmap_lookback=heatmap.DEFAULT_LOOKBACK,
+                                       max_offset=max_offset)
+        
+        # The rendered page only changes with the data or the minute shown
+        # in the plot title
+        return html_cache.get_or_compute(
+            ('html', offset, max_points, probe, max_offset, end_minute) + version, render)
     except Exception as e:
         logger.error("Database query failed: %s", str(e))
         return f"Error accessing database: {str(e)}", 500
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/api/stats')
+def api_stats():
+    offset = request.args.get('offset', 0, type=int)
+    probe = get_probe()
+    logger.info(f"Received API request for stats with offset {offset}")
+    return conditional_json('stats', offset,
+                            lambda conn, version: cached_stats(conn, offset, version,
+                                                               distributions=False,
+                                                               probe=probe))
+
+@app.route('/api/series')
+def api_series():
+    offset = request.args.get('offset', 0, type=int)
+    points = get_max_points()
+    probe = get_probe()
+    logger.info(f"Received API request for series with offset {offset}")
+    return conditional_json('series', offset,
+                            lambda conn, version: cached_plot_data(conn, offset, points,
+                                                                   version, probe),
+                            points)
+
+@app.route('/api/distribution')
+def api_distribution():
+    offset = request.args.get('offset', 0, type=int)
+    probe = get_probe()
+    logger.info(f"Received API request for distribution with offset {offset}")
+    
+    def build(conn, version):
+        stats = cached_stats(conn, offset, version, probe=probe)
+        return {'period': stats['period']['distribution'],
+                'overall': stats['overall']['distribution']}
+    return conditional_json('distribution', offset, build)
+
+@app.route('/api/latency')
+def api_latency():
+    """Per-minute TCP connect latency of every sampled target in a 24h window"""
+    offset = request.args.get('offset', 0, type=int)
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    try:
+        start_minute, end_minute = latency_minutes(offset)
+        cursor = conn.cursor()
+        etag = make_etag('latency', offset, latency.get_version(cursor, start_minute, end_minute),
+                         start_minute)
+        if not_modified(etag):
+            response = app.response_class(status=304)
+        else:
+            series = latency.get_series(cursor, start_minute, end_minute)
+            response = jsonify({'series': series,
+                                'plot': get_latency_plot(series) if series else None})
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error("Database query failed: %s", str(e))
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/incidents')
+def api_incidents():
+    """Degradation incidents overlapping a time range, oldest first
+
+    ?start= and ?end= take an epoch or a local ISO date/time; without them
+    the 24h window at ?offset= is used. end is null while an incident is
+    still open.
+    """
+    probe = get_probe()
+    try:
+        start_ts = export.parse_time(request.args.get('start'))
+        end_ts = export.parse_time(request.args.get('end'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if start_ts is None and end_ts is None:
+        start_date, end_date = get_window(request.args.get('offset', 0, type=int))
+        start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    try:
+        incidents = anomaly.get_incidents(conn.cursor(), start_ts, end_ts, probe)
+    except Exception as e:
+        logger.error("Database query failed: %s", str(e))
+        return jsonify({'error': str(e)}), 500
+    for incident in incidents:
+        for key in ('start', 'end', 'last'):
+            ts = incident[key + '_ts']
+            incident[key] = datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+    return jsonify(incidents)
+
+@app.route('/api/heatmap')
+def api_heatmap():
+    """p10/median/p90 of every metric per weekday and local hour over ?days=
+
+    Keyed on max_id and the current hour, so it is recomputed at most
+    once per new sample or hour whatever the lookback.
+    """
+    days = max(1, min(request.args.get('days', heatmap.DEFAULT_LOOKBACK, type=int),
+                      heatmap.MAX_LOOKBACK))
+    probe = get_probe()
+    hour = int(time.time()) // heatmap.HOUR
+
+    def compute(conn):
+        with SQL_DURATION.labels('heatmap').time():
+            return heatmap.get_heatmap(conn.cursor(), days, probe_id=probe)
+
+    def build(conn, version):
+        return cached(plot_cache, ('heatmap', days, probe, hour, version[0]),
+                      lambda: compute(conn))
+    return conditional_json('heatmap', 0, build, days, hour)
+
+@app.route('/export/<fmt>')
+def export_history(fmt):
+    """Stream raw results as CSV, NDJSON, Parquet or Arrow
+
+    ?start= and ?end= take an epoch or a local ISO date/time (end is
+    exclusive; both optional). Text formats are compressed with the best
+    of zstd/gzip the client accepts.
+    """
+    if fmt not in export.FORMATS:
+        abort(404)
+    probe = get_probe()
+    try:
+        start_ts = export.parse_time(request.args.get('start'))
+        end_ts = export.parse_time(request.args.get('end'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    encoding = None
+    if fmt not in export.COLUMNAR:
+        encoding = request.accept_encodings.best_match(export.available_encodings() + ['identity'],
+                                                       default='identity')
+        if encoding == 'identity':
+            encoding = None
+    try:
+        chunks = export.export(conn, fmt, start_ts, end_ts, probe, encoding)
+    except export.ExportError as e:
+        return jsonify({'error': str(e)}), 501
+    filename = 'speedtests%s.%s' % ('-' + probe if probe else '', fmt)
+    response = Response(chunks, content_type=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/api/probes')
+def api_probes():
+    """List every probe with the time and sequence number of its latest sample"""
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    return jsonify([{'probe_id': probe_id,
+                     'last_seen': datetime.fromtimestamp(last_seen).isoformat() if last_seen else None,
+                     'last_seq': last_seq}
+                    for probe_id, last_seen, last_seq in probes.list_probes(conn.cursor())])
+
+@app.route('/api/ingest/<probe_id>', methods=['POST'])
+def api_ingest(probe_id):
+    """Store a batch of results from a remote collector
+    
+    The body is NDJSON, one result per line, optionally gzip-compressed
+    (Content-Encoding: gzip). Each result carries the probe's own
+    sequence number; results already stored are skipped, so a collector
+    can safely resend a batch it is unsure about.
+    """
+    token = app.config.get('INGEST_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer %s' % token:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not probes.valid_probe_id(probe_id):
+        return jsonify({'error': 'Invalid probe id'}), 400
+    max_bytes = app.config['MAX_INGEST_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify({'error': 'Batch too large'}), 413
+    try:
+        records = probes.decode_batch(request.get_data(), request.headers.get('Content-Encoding'),
+                                      max_bytes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    db_path = app.config.get('DATABASE', DB_PATH)
+    if not os.path.exists(db_path):
+        return jsonify({'error': 'Database not found. Please start the collector first.'}), 503
+    try:
+        result = db.get_writer(db_path).transaction(
+            lambda c: probes.ingest_batch(c, probe_id, records))
+    except sqlite3.Error as e:
+        logger.error("Ingest from %s failed: %s", probe_id, str(e))
+        return jsonify({'error': str(e)}), 503
+    return jsonify(result)
+
+def get_change_feed():
+    """Return the shared change feed, starting its watcher thread on first use"""
+    global change_feed
+    db_path = app.config.get('DATABASE', DB_PATH)
+    with change_feed_lock:
+        if change_feed is None or change_feed.db_path != db_path:
+            if change_feed is not None:
+                change_feed.stop()
+            change_feed = ChangeFeed(
+                db_path,
+                lambda conn: cached_stats(conn, 0, get_data_version(conn, 0), distributions=False),
+                poll_interval=app.config['EVENTS_POLL_INTERVAL'])
+            change_feed.start()
+        return change_feed
+
+@app.route('/events')
+def events():
+    """Stream new measurements and updated stats as Server-Sent Events"""
+    logger.info("Received events subscription")
+    feed = get_change_feed()
+    subscription = feed.subscribe()
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield subscription.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            feed.unsubscribe(subscription)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/cache')
+def api_cache():
+    """Report hit/miss counters for the response caches"""
+    stats = {name: cache.stats() for name, cache in CACHES.items()}
+    shared = get_snapshot()
+    if shared is not None:
+        stats['snapshot'] = shared.stats()
+    return jsonify(stats)
+
+def update_latest_gauges(conn):
+    """Set the latest-measurement gauges from each probe's newest successful test
+
+    Only the main database is read: sealed months are at least two weeks
+    old, too old to report as a latest measurement.
+    """
+    cursor = conn.cursor()
+    with SQL_DURATION.labels('latest').time():
+        for probe_id, _, _ in probes.list_probes(cursor):
+            # Walks the (probe_id, ts) index backwards to the first success
+            cursor.execute('''SELECT download, upload, ping, ts FROM main.speedtests
+                              WHERE probe_id = ? AND error IS NULL
+                              ORDER BY ts DESC LIMIT 1''', (probe_id,))
+            row = cursor.fetchone()
+            for key, value in zip(('download', 'upload', 'ping', 'ts'), row or ()):
+                if value is not None:
+                    metrics.LATEST[key].labels(probe_id).set(value)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    conn = get_db_connection()
+    if conn is not None:
+        try:
+            update_latest_gauges(conn)
+        except Exception as e:
+            logger.error("Could not read latest results: %s", str(e))
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/health')
 def health():
@@ -0,0 +1,365 @@
+import os
+import json
+import math
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import platform
+import subprocess
+import sys
+import tracemalloc
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Benchmarks the dashboard's read paths against a synthetic history.
+# Results are written as JSON; pass a previous file to --compare to see
+# how each timing moved.
+DEFAULT_DAYS = 30
+DEFAULT_INTERVAL = 15         # minutes between samples of each probe
+DEFAULT_ERROR_RATE = 0.02
+DEFAULT_PROBES = 1
+DEFAULT_ITERATIONS = 20
+GENERATE_BATCH = 20000        # rows per write transaction while generating
+OUTAGE_RATE = 0.0005          # chance per sample that a multi-hour outage starts
+PERCENTILES = (50, 90, 99)
+
+# Entry points timed by --startup, as the statement each process runs
+# before it settles into waiting for work
+STARTUP_ENTRIES = {'collector': 'import speedtest_collector', 'web': 'import app'}
+STARTUP_RUNS = 5
+# http.server, http.client and email come with the HTTP stack; ssl is left
+# out because asyncio imports it
+HEAVY_MODULES = ('numpy', 'pandas', 'plotly', 'flask', 'http.server', 'http.client', 'email')
+# Entry points expected to load none of them
+LEAN_ENTRIES = ('collector',)
+
+_STARTUP_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+try:
+    with open('/proc/self/status') as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+except OSError:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss //= 1024 if sys.platform == 'darwin' else 1
+print(json.dumps({'import_ms': elapsed * 1000, 'rss_kib': rss,
+                  'modules': [m for m in %r if m in sys.modules]}))
+"""
+
+def _probe_profile(rng, index):
+    """Base download/upload/ping of one synthetic probe"""
+    download = rng.choice((100.0, 300.0, 500.0, 940.0))
+    return {
+        'probe_id': 'local' if index == 0 else 'probe-%d' % index,
+        'download': download,
+        'upload': download * rng.choice((0.1, 0.2, 1.0)),
+        'ping': rng.uniform(5.0, 30.0),
+    }
+
+def _evening_load(ts):
+    """0..1 congestion factor peaking at 21:00 local time"""
+    hour = datetime.fromtimestamp(ts).hour + datetime.fromtimestamp(ts).minute / 60
+    return max(0.0, math.cos((hour - 21) / 24 * 2 * math.pi)) ** 3
+
+def generate_records(days, interval=DEFAULT_INTERVAL, error_rate=DEFAULT_ERROR_RATE,
+                     probe_count=DEFAULT_PROBES, seed=0, now=None):
+    """Yield make_record-style dicts covering the last `days` days
+
+    Speeds dip in the evening with log-normal noise; failures are a mix
+    of random errors at error_rate and occasional multi-hour outages.
+    """
+    rng = random.Random(seed)
+    now = int(time.time() if now is None else now)
+    step = int(interval * 60)
+    start = now - int(days * 86400)
+    profiles = [_probe_profile(rng, i) for i in range(probe_count)]
+    outage_until = [0] * probe_count
+    seq = 0
+    for ts in range(start - start % step, now, step):
+        load = _evening_load(ts)
+        for i, profile in enumerate(profiles):
+            seq += 1
+            record = {'seq': seq, 'ts': ts + i,
+                      'timestamp': datetime.fromtimestamp(ts + i).isoformat(),
+                      'probe_id': profile['probe_id'],
+                      'download': None, 'upload': None, 'ping': None, 'error': None}
+            if ts < outage_until[i]:
+                record['error'] = 'Network unreachable'
+            elif rng.random() < OUTAGE_RATE:
+                outage_until[i] = ts + rng.randint(1, 6) * 3600
+                record['error'] = 'Network unreachable'
+            elif rng.random() < error_rate:
+                record['error'] = 'speedtest timed out'
+            else:
+                factor = (1 - 0.4 * load) * rng.lognormvariate(0, 0.1)
+                record.update(download=profile['download'] * min(factor, 1.05),
+                              upload=profile['upload'] * min(factor * 1.1, 1.05),
+                              ping=profile['ping'] * (1 + load) * rng.lognormvariate(0, 0.2))
+            yield record
+
+def generate_history(db_path, days=DEFAULT_DAYS, interval=DEFAULT_INTERVAL,
+                     error_rate=DEFAULT_ERROR_RATE, probe_count=DEFAULT_PROBES, seed=0):
+    """Create a database at db_path holding a synthetic history; returns the row count
+
+    Rows go through the collector's own write path, so rollups, sketches
+    and the probe table are populated exactly as in production.
+    """
+    import speedtest_collector
+    speedtest_collector.setup_database(db_path)
+    batch, total = [], 0
+    for record in generate_records(days, interval, error_rate, probe_count, seed):
+        batch.append(record)
+        if len(batch) == GENERATE_BATCH:
+            speedtest_collector.save_records(batch, db_path)
+            total += len(batch)
+            batch = []
+            logger.info("Generated %d rows", total)
+    if batch:
+        speedtest_collector.save_records(batch, db_path)
+        total += len(batch)
+    return total
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def measure(fn, iterations=DEFAULT_ITERATIONS, setup=None):
+    """Time fn() over iterations and trace its peak memory in one more run
+
+    setup() runs untimed before every call (e.g. to clear caches).
+    Returns a dict of latency percentiles in ms, peak traced KiB and,
+    when fn returns bytes, the response size.
+    """
+    timings = []
+    result = None
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    report = {'iterations': iterations,
+              'mean_ms': round(sum(timings) / len(timings), 3),
+              'max_ms': round(timings[-1], 3),
+              'peak_kib': round(peak / 1024, 1)}
+    for q in PERCENTILES:
+        report['p%d_ms' % q] = round(_percentile(timings, q), 3)
+    if isinstance(result, bytes):
+        report['bytes'] = len(result)
+    return report
+
+def measure_startup(statement, runs=STARTUP_RUNS):
+    """Run statement in fresh interpreters; report start-up time and resident memory
+
+    p50_ms/max_ms time the whole process from spawn to exit, import_ms
+    just the statement; rss_kib is the resident set once it has run, and
+    modules lists the HEAVY_MODULES it loaded.
+    """
+    script = _STARTUP_SCRIPT % (statement, HEAVY_MODULES)
+    timings, samples = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append((time.perf_counter() - start) * 1000)
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    timings.sort()
+    middle = lambda key: sorted(sample[key] for sample in samples)[len(samples) // 2]
+    return {'runs': runs,
+            'p50_ms': round(_percentile(timings, 50), 1),
+            'max_ms': round(timings[-1], 1),
+            'import_ms': round(middle('import_ms'), 1),
+            'rss_kib': middle('rss_kib'),
+            'modules': samples[-1]['modules']}
+
+def run_startup(runs=STARTUP_RUNS):
+    """Time the start-up of every STARTUP_ENTRIES entry point; returns {name: report}"""
+    results = {}
+    for name, statement in STARTUP_ENTRIES.items():
+        results[name] = measure_startup(statement, runs)
+        logger.info("%-30s p50 %8.1f ms  rss %6d KiB  loads %s", name, results[name]['p50_ms'],
+                    results[name]['rss_kib'], ', '.join(results[name]['modules']) or '-')
+        if name in LEAN_ENTRIES and results[name]['modules']:
+            logger.warning("%s should load none of %s", name, ', '.join(results[name]['modules']))
+    return results
+
+def run_benchmarks(db_path, iterations=DEFAULT_ITERATIONS, offset=7):
+    """Time the dashboard's read paths against db_path; returns {name: report}
+
+    Function benchmarks use the pooled read-only connection; route
+    benchmarks go through the Flask test client, once with every cache
+    cleared before each request ('cold') and once warm.
+    """
+    import db
+    import payload
+    import app as app_module
+    from app import app, get_stats, get_plot_data, get_distribution_data, get_window, to_epoch
+
+    # Per-request log lines would dominate the timings
+    app_logger = logging.getLogger('app')
+    saved = app_logger.level, app.config.get('DATABASE')
+    app_logger.setLevel(logging.WARNING)
+    app.config['DATABASE'] = db_path
+    client = app.test_client()
+    conn = db.get_reader(db_path)
+    compressed = ', '.join(payload.available_encodings())
+
+    def clear_caches():
+        for cache in app_module.CACHES.values():
+            cache.clear()
+        app_module.window_cache.clear()
+
+    def distribution(offset_days):
+        start_date, end_date = get_window(offset_days)
+        cursor = conn.cursor()
+        return lambda: get_distribution_data(cursor, 'period',
+                                             to_epoch(start_date), to_epoch(end_date))
+
+    def page(path, encoding='identity'):
+        def fetch():
+            response = client.get(path, headers={'Accept-Encoding': encoding})
+            if response.status_code != 200:
+                raise RuntimeError('%s returned HTTP %d' % (path, response.status_code))
+            return response.data
+        return fetch
+
+    cases = [
+        ('get_stats', lambda: get_stats(conn, 0), None),
+        ('get_stats_offset', lambda: get_stats(conn, offset), None),
+        ('get_plot_data', lambda: get_plot_data(conn, 0), None),
+        ('get_plot_data_offset', lambda: get_plot_data(conn, offset), None),
+        ('get_distribution_data', distribution(0), None),
+        ('get_distribution_data_offset', distribution(offset), None),
+        ('index_cold', page('/'), clear_caches),
+        ('index_warm', page('/'), None),
+        ('offset_cold', page('/%d' % offset), clear_caches),
+        ('offset_warm', page('/%d' % offset), None),
+        ('series_warm', page('/api/series'), None),
+        # What a client that accepts compression actually downloads
+        ('index_compressed', page('/', compressed), None),
+        ('series_compressed', page('/api/series', compressed), None),
+    ]
+    results = {}
+    try:
+        for name, fn, setup in cases:
+            results[name] = measure(fn, iterations, setup)
+            logger.info("%-30s p50 %8.2f ms  p99 %8.2f ms%s", name,
+                        results[name]['p50_ms'], results[name]['p99_ms'],
+                        '  %8d bytes' % results[name]['bytes'] if 'bytes' in results[name] else '')
+    finally:
+        app_logger.setLevel(saved[0])
+        app.config['DATABASE'] = saved[1]
+    return results
+
+def compare(results, baseline):
+    """Lines comparing p50/p99 of results against a previous run's"""
+    lines = []
+    for name, report in results.items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        changes = ['%s %+.0f%%' % (key, (report[key] / old[key] - 1) * 100)
+                   for key in ('p50_ms', 'p99_ms', 'peak_kib', 'rss_kib', 'bytes')
+                   if old.get(key) and key in report]
+        lines.append('%-30s %s' % (name, '  '.join(changes)))
+    return lines
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard against a synthetic history')
+    parser.add_argument('--db', default='bench_speedtest.db',
+                        help='database to benchmark; generated unless it exists (default: %(default)s)')
+    parser.add_argument('--days', type=float, default=DEFAULT_DAYS,
+                        help='days of history to generate (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='minutes between samples of each probe (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_ERROR_RATE,
+                        help='fraction of failed tests (default: %(default)s)')
+    parser.add_argument('--probes', type=int, default=DEFAULT_PROBES,
+                        help='number of probes (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true',
+                        help='replace an existing --db with a freshly generated one')
+    parser.add_argument('--compact', action='store_true',
+                        help='apply the default retention tiers before benchmarking')
+    parser.add_argument('--generate-only', action='store_true')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--offset', type=int, default=7,
+                        help='day offset of the historical page and queries (default: %(default)s)')
+    parser.add_argument('--output', default='bench.json',
+                        help='where to write the JSON results (default: %(default)s)')
+    parser.add_argument('--compare', metavar='JSON', help='previous results to compare against')
+    parser.add_argument('--startup', action='store_true',
+                        help='time start-up and idle memory of the collector and web app instead')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.startup:
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': run_startup(args.iterations)
+        }
+        _write_report(report, args)
+        return
+
+    if args.regenerate:
+        for path in (args.db, args.db + '-wal', args.db + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+    if not os.path.exists(args.db):
+        start = time.perf_counter()
+        rows = generate_history(args.db, args.days, args.interval, args.error_rate,
+                                args.probes, args.seed)
+        logger.info("Generated %d rows in %.1fs", rows, time.perf_counter() - start)
+    if args.compact:
+        import retention
+        retention.compact(args.db)
+    if args.generate_only:
+        return
+
+    conn = sqlite3.connect(args.db)
+    rows, first_ts = conn.execute('SELECT COUNT(*), MIN(ts) FROM speedtests').fetchone()
+    conn.close()
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'db': {'path': args.db, 'rows': rows, 'bytes': os.path.getsize(args.db),
+               'first': datetime.fromtimestamp(first_ts).isoformat() if first_ts else None},
+        'iterations': args.iterations,
+        'offset': args.offset,
+        'results': run_benchmarks(args.db, args.iterations, args.offset)
+    }
+    _write_report(report, args)
+
+def _write_report(report, args):
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %s", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(report['results'], baseline)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Pragmas for the per-thread read-only connections used by the web app.
+# mmap lets SQLite read pages straight from the page cache without
+# copying; cache_size is in KiB when negative.
+READ_PRAGMAS = (
+    'PRAGMA mmap_size = 134217728',
+    'PRAGMA cache_size = -8192',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Pragmas for the single long-lived writer. WAL lets readers proceed
+# while a write is in progress; synchronous=NORMAL is durable across
+# application crashes in WAL mode and avoids an fsync per commit.
+WRITE_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+)
+
+WRITE_RETRIES = 6
+WRITE_BACKOFF = 0.05  # seconds, doubled after every failed attempt
+
+_lock = threading.Lock()
+_local = threading.local()
+_readers = []        # every reader handed out, so close_all can reach them
+_writers = {}        # db_path -> Writer
+_generation = 0      # bumped by close_all to invalidate thread-local readers
+
+def _file_id(db_path):
+    """Identify the file behind db_path, so a replaced database is noticed"""
+    st = os.stat(db_path)
+    return st.st_dev, st.st_ino
+
+def enable_wal(conn):
+    """Switch a database to WAL mode (persistent in the file)"""
+    for pragma in WRITE_PRAGMAS:
+        conn.execute(pragma)
+
+def get_reader(db_path):
+    """Return this thread's read-only connection to db_path
+
+    Connections are opened once per thread and reused across requests.
+    Callers must not close them.
+    """
+    file_id = _file_id(db_path)
+    readers = getattr(_local, 'readers', None)
+    if readers is None or getattr(_local, 'generation', None) != _generation:
+        readers = _local.readers = {}
+        _local.generation = _generation
+    entry = readers.get(db_path)
+    if entry is not None and entry[1] == file_id:
+        return entry[0]
+
+    if entry is not None:
+        entry[0].close()
+        with _lock:
+            if entry[0] in _readers:
+                _readers.remove(entry[0])
+    conn = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(db_path)),
+                           uri=True, check_same_thread=False)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    readers[db_path] = (conn, file_id)
+    with _lock:
+        _readers.append(conn)
+    logger.debug("Opened read-only connection to %s", db_path)
+    return conn
+
+class Writer:
+    """The single persistent write connection to a database
+
+    All writes go through transaction(), which serializes them, runs the
+    callback inside BEGIN IMMEDIATE ... COMMIT and retries with
+    exponential backoff when the database is locked or busy.
+    """
+
+    def __init__(self, db_path, retries=WRITE_RETRIES, backoff=WRITE_BACKOFF):
+        self.db_path = db_path
+        self.retries = retries
+        self.backoff = backoff
+        self.file_id = _file_id(db_path)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        enable_wal(self.conn)
+        logger.debug("Opened writer connection to %s", db_path)
+
+    def transaction(self, fn):
+        """Run fn(cursor) in a write transaction and return its result"""
+        with self._lock:
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                c = self.conn.cursor()
+                try:
+                    c.execute('BEGIN IMMEDIATE')
+                    result = fn(c)
+                    c.execute('COMMIT')
+                    return result
+                except sqlite3.OperationalError as e:
+                    if self.conn.in_transaction:
+                        self.conn.execute('ROLLBACK')
+                    message = str(e)
+                    if attempt == self.retries or ('locked' not in message and 'busy' not in message):
+                        raise
+                    logger.warning("Write to %s failed (%s), retrying in %.2fs",
+                                   self.db_path, message, delay)
+                    time.sleep(delay)
+                    delay *= 2
+                except Exception:
+                    if self.conn.in_transaction:
+                        self.conn.execute('ROLLBACK')
+                    raise
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def get_writer(db_path):
+    """Return the process-wide writer for db_path, reopening it if the file was replaced"""
+    with _lock:
+        writer = _writers.get(db_path)
+        if writer is not None and writer.file_id != _file_id(db_path):
+            writer.close()
+            writer = None
+        if writer is None:
+            writer = _writers[db_path] = Writer(db_path)
+        return writer
+
+def close_all():
+    """Close every pooled connection (e.g. before deleting a database file)"""
+    global _generation
+    with _lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
+        for conn in _readers:
+            conn.close()
+        del _readers[:]
+        _generation += 1
@@ -0,0 +1,70 @@
+import numpy as np
+
+# A spacing this many times the median sample spacing counts as an outage
+GAP_FACTOR = 3.0
+
+def find_gaps(x, factor=GAP_FACTOR):
+    """Return indexes i where x[i + 1] - x[i] is an outage-sized gap"""
+    if len(x) < 3:
+        return np.zeros(0, dtype=np.int64)
+    spacing = np.diff(x)
+    return np.flatnonzero(spacing > factor * np.median(spacing))
+
+def minmax_indexes(x, ys, n_buckets):
+    """Indexes of the min and max of every series in each time bucket
+
+    Buckets split the x range into equal time slices, so sparse stretches
+    are not padded out with extra points. Selecting both extremes keeps
+    every dip and spike visible at any zoom level.
+    """
+    edges = np.searchsorted(x, np.linspace(x[0], x[-1], n_buckets + 1)[1:-1], side='right')
+    segment = np.zeros(len(x), dtype=np.int64)
+    np.add.at(segment, edges[edges < len(x)], 1)
+    segment = np.cumsum(segment)
+
+    selected = [np.array([0, len(x) - 1])]
+    for y in ys:
+        # Sort by (segment, value); the first and last entry of each
+        # segment are its argmin and argmax.
+        order = np.lexsort((y, segment))
+        starts = np.flatnonzero(np.r_[True, np.diff(segment[order]) != 0])
+        ends = np.r_[starts[1:] - 1, len(order) - 1]
+        selected += [order[starts], order[ends]]
+    return np.unique(np.concatenate(selected))
+
+def downsample(x, ys, max_points):
+    """Reduce a time series to at most max_points entries
+
+    x is a sorted array of epoch seconds and ys a list of value arrays of
+    the same length. Returns (x, ys) where outages are marked by a NaN
+    entry between the samples on either side of the gap, so the plotted
+    line breaks instead of bridging them.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    ys = [np.asarray(y, dtype=np.float64) for y in ys]
+    gaps = find_gaps(x)
+
+    # Each gap costs its two endpoints plus the NaN marker; only the
+    # largest gaps are kept if there are too many to fit.
+    max_gaps = max_points // 6
+    if len(gaps) > max_gaps:
+        widths = x[gaps + 1] - x[gaps]
+        gaps = np.sort(gaps[np.argsort(widths)[::-1][:max_gaps]])
+
+    if len(x) + len(gaps) <= max_points:
+        keep = np.arange(len(x))
+    else:
+        budget = max_points - 3 * len(gaps)
+        # Every bucket can contribute a min and a max for each series
+        n_buckets = max(1, (budget - 2) // (2 * len(ys)))
+        keep = np.unique(np.concatenate([minmax_indexes(x, ys, n_buckets), gaps, gaps + 1]))
+
+    out_x = x[keep]
+    out_ys = [y[keep] for y in ys]
+    if len(gaps):
+        # Insert a NaN after each kept gap start, halfway across the gap
+        positions = np.searchsorted(keep, gaps) + 1
+        midpoints = (x[gaps] + x[gaps + 1]) / 2
+        out_x = np.insert(out_x, positions, midpoints)
+        out_ys = [np.insert(y, positions, np.nan) for y in out_ys]
+    return out_x, out_ys
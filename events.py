@@ -0,0 +1,126 @@
+import json
+import queue
+import logging
+import threading
+from datetime import datetime
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 1.0  # seconds between PRAGMA data_version checks
+MAX_QUEUED_EVENTS = 100      # per subscriber, before it is dropped as too slow
+MAX_MEASUREMENT_EVENTS = 20  # new rows sent one by one; bigger batches send 'refresh'
+
+def format_event(event, data):
+    """Encode one Server-Sent Events message"""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+class ChangeFeed:
+    """One watcher thread that turns new speedtests rows into SSE messages
+
+    The thread polls PRAGMA data_version on its own pooled connection,
+    which only changes when another connection commits, so detecting "no
+    change" costs no query against the data. When it does change, new
+    rows are read once by rowid and every message is fanned out to all
+    subscriber queues, however many dashboards are open.
+    """
+
+    def __init__(self, db_path, summarize, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.db_path = db_path
+        self.summarize = summarize
+        self.poll_interval = poll_interval
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self):
+        """Register a new subscriber and return its message queue"""
+        q = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def publish(self, event, data):
+        """Queue a message for every subscriber, dropping any that are too slow"""
+        message = format_event(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                logger.warning("Dropping slow event subscriber")
+                self.unsubscribe(q)
+
+    def _run(self):
+        conn = version = last_id = None
+        while not self._stop.wait(self.poll_interval):
+            try:
+                current = db.get_reader(self.db_path)
+                if current is not conn:
+                    # New or reopened connection: start from its present state
+                    conn = current
+                    version = conn.execute('PRAGMA data_version').fetchone()[0]
+                    last_id = conn.execute('SELECT MAX(id) FROM speedtests').fetchone()[0] or 0
+                    continue
+                new_version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if new_version == version:
+                    continue
+                version = new_version
+                last_id = self._publish_new_rows(conn, last_id)
+            except Exception as e:
+                # Typically the database is missing or being replaced; retry
+                logger.debug("Change feed poll failed: %s", str(e))
+                conn = None
+
+    def _publish_new_rows(self, conn, last_id):
+        # Read one row past the limit, just enough to tell a bulk ingest apart
+        rows = conn.execute('''
+            SELECT id, ts, download, upload, ping, error, probe_id
+            FROM speedtests
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, MAX_MEASUREMENT_EVENTS + 1)).fetchall()
+        if not rows:
+            return last_id
+        newest = rows[-1][0]
+        if len(rows) > MAX_MEASUREMENT_EVENTS:
+            newest = conn.execute('SELECT MAX(id) FROM speedtests').fetchone()[0]
+        if not self.subscriber_count():
+            return newest
+        if len(rows) > MAX_MEASUREMENT_EVENTS:
+            # A bulk ingest or backfill: have pages refetch instead
+            self.publish('refresh', {'rows': newest - last_id})
+        else:
+            for row_id, ts, download, upload, ping, error, probe_id in rows:
+                self.publish('measurement', {
+                    'id': row_id,
+                    'time': datetime.fromtimestamp(ts).isoformat(),
+                    'download': download,
+                    'upload': upload,
+                    'ping': ping,
+                    'error': error,
+                    'probe_id': probe_id
+                })
+        self.publish('stats', self.summarize(conn))
+        return newest
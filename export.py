@@ -0,0 +1,223 @@
+import io
+import csv
+import sys
+import json
+import zlib
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Exports stream raw results in ts order, fetchmany() batch by batch, so
+# memory stays flat however long the range is. CSV and NDJSON need only
+# the standard library; Parquet and Arrow need pyarrow, and zstd
+# compression needs zstandard.
+COLUMNS = ('timestamp', 'ts', 'probe_id', 'download', 'upload', 'ping', 'error')
+BATCH_SIZE = 5000
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+# Columnar formats compress internally, column by column
+COLUMNAR = ('parquet', 'arrow')
+ENCODINGS = ('zstd', 'gzip')
+
+class ExportError(Exception):
+    """An export that cannot be produced, e.g. for lack of an optional module"""
+
+def _require(module):
+    try:
+        return __import__(module)
+    except ImportError:
+        raise ExportError('%s is required for this export; pip install %s' % (module, module))
+
+def available_encodings():
+    """Content encodings this installation can produce, best first"""
+    encodings = []
+    for encoding in ENCODINGS:
+        if encoding == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                continue
+        encodings.append(encoding)
+    return encodings
+
+def iter_batches(conn, start_ts=None, end_ts=None, probe_id=None, batch_size=BATCH_SIZE):
+    """Yield lists of COLUMNS tuples for start_ts <= ts < end_ts, oldest first
+
+    conn is attached to the sealed shards the range covers a batch of
+    months at a time (see shards.ranges), as the rows are reached.
+    """
+    for lo, hi in shards.ranges(conn, start_ts, end_ts):
+        clauses, params = shards.ts_clause(lo, hi)
+        if probe_id is not None:
+            clauses.append('probe_id = ?')
+            params.append(probe_id)
+        where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        # The ts and (probe_id, ts) indexes already hold rows in this order
+        cursor = conn.execute('SELECT %s FROM speedtests %s ORDER BY ts, id'
+                              % (', '.join(COLUMNS), where), params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+def encode_csv(batches):
+    yield (','.join(COLUMNS) + '\r\n').encode()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+def encode_ndjson(batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row)), separators=(',', ':')) + '\n'
+                      for row in rows).encode()
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what pyarrow writes, drained between batches"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _arrow_schema(pa):
+    return pa.schema([('timestamp', pa.string()), ('ts', pa.int64()), ('probe_id', pa.string()),
+                      ('download', pa.float64()), ('upload', pa.float64()),
+                      ('ping', pa.float64()), ('error', pa.string())])
+
+def _arrow_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    return pa.record_batch([pa.array(column, type=field.type)
+                            for column, field in zip(columns, schema)], schema=schema)
+
+def encode_columnar(batches, fmt, compression='zstd'):
+    """Encode batches as Parquet (one row group per batch) or an Arrow IPC stream"""
+    pa = _require('pyarrow')
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema, compression=compression)
+        write = lambda batch: writer.write_batch(batch)
+    else:
+        import pyarrow.ipc as ipc
+        writer = ipc.new_stream(sink, schema,
+                                options=ipc.IpcWriteOptions(compression=compression))
+        write = writer.write_batch
+    for rows in batches:
+        write(_arrow_batch(pa, schema, rows))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def compress(chunks, encoding=None):
+    """Compress a stream of byte chunks with gzip or zstd (None: as is)"""
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif encoding == 'zstd':
+        compressor = _require('zstandard').ZstdCompressor().compressobj()
+    else:
+        raise ExportError('unsupported encoding: %s' % encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export(conn, fmt, start_ts=None, end_ts=None, probe_id=None, encoding=None,
+           batch_size=BATCH_SIZE):
+    """Stream an export as byte chunks
+
+    For columnar formats encoding picks the internal codec (default
+    zstd); for text formats it is the compression of the whole stream.
+    """
+    if fmt not in FORMATS:
+        raise ExportError('unknown format: %s' % fmt)
+    if fmt in COLUMNAR:
+        _require('pyarrow')  # fail before anything has been sent
+    elif encoding == 'zstd':
+        _require('zstandard')
+    batches = iter_batches(conn, start_ts, end_ts, probe_id, batch_size)
+    if fmt == 'csv':
+        return compress(encode_csv(batches), encoding)
+    if fmt == 'ndjson':
+        return compress(encode_ndjson(batches), encoding)
+    return encode_columnar(batches, fmt, encoding or 'zstd')
+
+def parse_time(value):
+    """Parse an epoch or a local ISO date/time into an epoch; None passes through"""
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise ValueError('invalid time: %s' % value)
+
+def _main():
+    parser = argparse.ArgumentParser(description='Export measurement history')
+    parser.add_argument('db_path', help='path to speedtest.db')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--start', help='first time to include (epoch or ISO date/time)')
+    parser.add_argument('--end', help='time to stop before (epoch or ISO date/time)')
+    parser.add_argument('--probe', help='only this probe')
+    parser.add_argument('--compress', choices=ENCODINGS,
+                        help='compress the output (the codec inside Parquet/Arrow files)')
+    parser.add_argument('--output', '-o', help='file to write (default: stdout)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        start_ts, end_ts = parse_time(args.start), parse_time(args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    conn = sqlite3.connect('file:%s?mode=ro' % args.db_path, uri=True)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in export(conn, args.format, start_ts, end_ts, args.probe, args.compress):
+            out.write(chunk)
+    except ExportError as e:
+        parser.error(str(e))
+    finally:
+        if args.output:
+            out.close()
+        conn.close()
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,153 @@
+import time
+import logging
+import sketch
+import shards
+import rollups
+
+logger = logging.getLogger(__name__)
+
+# Weekly pattern of the link: the quantiles of every metric for each of
+# the 168 hour-of-week slots (Monday 00:00 local time first) over a
+# lookback. The whole fleet is read from the hourly rollups, whose
+# sketches are kept up to date as results are saved: every bucket is
+# mapped to its local slot and the sketches are summed per slot with one
+# NumPy group-by, so the cost depends on the number of hours in the
+# lookback, not the number of results. A single probe is read from its
+# raw rows through the (probe_id, ts) index, like every per-probe view,
+# from the main database and the sealed shards the lookback covers.
+# Buckets are UTC hours, so in zones with a half-hour offset each slot is
+# labelled with the local hour its bucket starts in.
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+SLOTS = 7 * 24
+LOOKBACKS = (7, 28, 91, 365)   # days offered by the dashboard
+DEFAULT_LOOKBACK = 28          # days
+MAX_LOOKBACK = 3650            # days
+STATS = {'p10': 0.1, 'median': 0.5, 'p90': 0.9}
+METRICS = {'download': 'down', 'upload': 'up', 'ping': 'ping'}
+HOUR = 3600
+DAY = 86400
+
+def local_slots(ts):
+    """Hour-of-week slot (0 = Monday 00:00 local) of every epoch in a NumPy array
+
+    The UTC offset is looked up once per UTC day, so only the hours
+    between a DST change and the next UTC midnight can land one slot off.
+    """
+    import numpy as np
+    ts = np.asarray(ts, dtype=np.int64)
+    days, inverse = np.unique(ts // DAY, return_inverse=True)
+    offsets = np.array([time.localtime(int(day) * DAY + DAY // 2).tm_gmtoff for day in days],
+                       dtype=np.int64)
+    local = ts + offsets[inverse]
+    # 1970-01-01 was a Thursday
+    return (local // DAY + 3) % 7 * 24 + local % DAY // HOUR
+
+def _slot_histograms(slots, bins, counts):
+    """Sum (slot, bin, count) entries into a SLOTS x NUM_BINS count array"""
+    import numpy as np
+    return np.bincount(slots * sketch.NUM_BINS + bins, weights=counts,
+                       minlength=SLOTS * sketch.NUM_BINS).reshape(SLOTS, sketch.NUM_BINS)
+
+def _slot_quantiles(histograms):
+    """{stat: per-slot value} from a SLOTS x NUM_BINS count array, NaN where empty"""
+    import numpy as np
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1:]
+    values = sketch.bin_values()
+    result = {}
+    for stat, q in STATS.items():
+        # Per-row searchsorted(side='left'), as in sketch.quantiles
+        positions = np.minimum((cumulative < q * totals).sum(axis=1), sketch.NUM_BINS - 1)
+        result[stat] = np.where(totals[:, 0] > 0, values[positions], np.nan)
+    return result
+
+def _grid(values, digits=2):
+    """7 x 24 nested lists (weekday-major) with None for empty slots
+
+    digits=None gives integers, for counts.
+    """
+    import numpy as np
+    return [[None if np.isnan(v) else int(v) if digits is None else round(float(v), digits)
+             for v in row]
+            for row in np.asarray(values, dtype=np.float64).reshape(7, 24)]
+
+def _fleet_histograms(c, start_ts, end_ts):
+    """Per-slot test/error counts and histograms from the hourly rollups"""
+    import numpy as np
+    metrics = list(METRICS.values())
+    c.execute('''SELECT bucket, total_count, error_count, %s, %s FROM speedtest_rollups_hour
+                 WHERE bucket >= ? AND bucket < ?'''
+              % (', '.join('%s_sketch' % metric for metric in metrics),
+                 ', '.join('IFNULL(LENGTH(%s_sketch), 0)' % metric for metric in metrics)),
+              (start_ts // HOUR, end_ts // HOUR))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    slots = local_slots(np.array(columns[0], dtype=np.int64) * HOUR)
+    tests = np.bincount(slots, weights=columns[1], minlength=SLOTS)
+    errors = np.bincount(slots, weights=columns[2], minlength=SLOTS)
+    histograms = {}
+    for i, metric in enumerate(METRICS):
+        owner, bins, counts = sketch.decode_many(columns[3 + i], columns[3 + len(metrics) + i])
+        histograms[metric] = _slot_histograms(slots[owner], bins, counts)
+    return tests, errors, histograms
+
+def _probe_histograms(c, probe_id, start_ts, end_ts):
+    """Per-slot test/error counts and histograms from one probe's raw rows"""
+    import numpy as np
+    rows = []
+    for lo, hi in shards.ranges(c.connection, start_ts, end_ts):
+        c.execute('''SELECT ts, error IS NOT NULL, download, upload, ping FROM speedtests
+                     WHERE probe_id = ? AND ts >= ? AND ts < ?''', (probe_id, lo, hi))
+        rows.extend(c.fetchall())
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    slots = local_slots(columns[0])
+    failed = np.array(columns[1], dtype=bool)
+    tests = np.bincount(slots, minlength=SLOTS).astype(np.float64)
+    errors = np.bincount(slots[failed], minlength=SLOTS).astype(np.float64)
+    histograms = {}
+    for metric, values in zip(METRICS, columns[2:]):
+        values = np.array(values, dtype=np.float64)
+        present = ~np.isnan(values)
+        histograms[metric] = _slot_histograms(slots[present], sketch.bin_indexes(values[present]),
+                                              None)
+    return tests, errors, histograms
+
+def get_range(c, days=DEFAULT_LOOKBACK, now=None, probe_id=None):
+    """[start_ts, end_ts) of the last days whole hours the heatmap can read
+
+    The range ends with the current hour and starts no earlier than the
+    oldest hour still kept at hourly (or, for one probe, raw) resolution.
+    """
+    now = int(time.time() if now is None else now)
+    end_ts = (now // HOUR + 1) * HOUR
+    raw_floor, hour_floor = rollups.get_floors(c)
+    floor = raw_floor if probe_id is not None else hour_floor
+    start_ts = max(end_ts - days * DAY, -(-floor // HOUR) * HOUR)
+    return start_ts, end_ts
+
+def get_heatmap(c, days=DEFAULT_LOOKBACK, now=None, probe_id=None):
+    """Quantiles of every metric per weekday and hour over the last days
+
+    Returns None without data, otherwise the range actually covered and,
+    per metric and stat, a 7 x 24 grid (Monday first, hour 0 first) with
+    None for slots without results, plus the tests and errors per slot.
+    """
+    start_ts, end_ts = get_range(c, days, now, probe_id)
+    if probe_id is None:
+        result = _fleet_histograms(c, start_ts, end_ts)
+    else:
+        result = _probe_histograms(c, probe_id, start_ts, end_ts)
+    if result is None:
+        return None
+    tests, errors, histograms = result
+    heatmap = {'days': days, 'start_ts': start_ts, 'end_ts': end_ts,
+               'weekdays': list(WEEKDAYS), 'hours': list(range(24)),
+               'tests': _grid(tests, None), 'errors': _grid(errors, None)}
+    for metric, histogram in histograms.items():
+        heatmap[metric] = {stat: _grid(values)
+                           for stat, values in _slot_quantiles(histogram).items()}
+    return heatmap
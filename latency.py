@@ -0,0 +1,225 @@
+import time
+import math
+import socket
+import asyncio
+import logging
+from array import array
+import db
+
+logger = logging.getLogger(__name__)
+
+# Probes every target once per SAMPLE_INTERVAL by timing a TCP connect,
+# and stores one row of aggregates per target and minute.
+SAMPLE_INTERVAL = 1.0      # seconds
+CONNECT_TIMEOUT = 1.0      # seconds before a probe counts as lost
+RING_SIZE = 64             # samples kept per target; > one minute at 1 Hz
+MAX_PENDING_MINUTES = 60   # per target, kept while the database is unavailable
+DEFAULT_PORT = 443
+
+# Columns of latency_minutes after (target, minute)
+AGGREGATE_FIELDS = ('sent', 'received', 'rtt_min', 'rtt_p50', 'rtt_p99', 'jitter')
+
+def create_latency_table(c):
+    """Create the per-minute latency aggregate table"""
+    c.execute('''CREATE TABLE IF NOT EXISTS latency_minutes
+                 (target TEXT NOT NULL,
+                  minute INTEGER NOT NULL,
+                  sent INTEGER NOT NULL,
+                  received INTEGER NOT NULL,
+                  rtt_min REAL,
+                  rtt_p50 REAL,
+                  rtt_p99 REAL,
+                  jitter REAL,
+                  PRIMARY KEY (minute, target)) WITHOUT ROWID''')
+
+def parse_target(spec):
+    """Parse HOST[:PORT] (IPv6 as [addr]:port) into (host, port)"""
+    host, port = spec, DEFAULT_PORT
+    if spec.startswith('['):
+        host, _, rest = spec[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+    elif spec.count(':') == 1:
+        host, port = spec.split(':')
+        port = int(port)
+    if not host or not 0 < port < 65536:
+        raise ValueError('invalid latency target: %s' % spec)
+    return host, port
+
+class RttRing:
+    """Fixed-size ring of RTT samples (ms) with their timestamps
+
+    Backed by two preallocated arrays, so recording a sample never
+    allocates. A lost probe is stored as NaN.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.rtts = array('d', bytes(8 * size))
+        self.count = 0  # total samples ever added
+
+    def add(self, when, rtt):
+        i = self.count % self.size
+        self.times[i] = when
+        self.rtts[i] = math.nan if rtt is None else rtt
+        self.count += 1
+
+    def window(self, start, end):
+        """RTTs sampled at start <= time < end, oldest first"""
+        values = []
+        for k in range(max(0, self.count - self.size), self.count):
+            i = k % self.size
+            if start <= self.times[i] < end:
+                values.append(self.rtts[i])
+        return values
+
+def _percentile(ordered, q):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def aggregate(rtts):
+    """Summarize one minute of RTTs (NaN for lost probes) as AGGREGATE_FIELDS
+
+    Jitter is the mean absolute difference between consecutive replies.
+    """
+    received = [rtt for rtt in rtts if rtt == rtt]
+    result = {'sent': len(rtts), 'received': len(received),
+              'rtt_min': None, 'rtt_p50': None, 'rtt_p99': None, 'jitter': None}
+    if received:
+        ordered = sorted(received)
+        result.update(rtt_min=ordered[0],
+                      rtt_p50=_percentile(ordered, 0.5),
+                      rtt_p99=_percentile(ordered, 0.99))
+    if len(received) > 1:
+        result['jitter'] = (sum(abs(b - a) for a, b in zip(received, received[1:]))
+                            / (len(received) - 1))
+    return result
+
+async def tcp_rtt(address, family, timeout=CONNECT_TIMEOUT):
+    """Time a TCP handshake in ms; None if it timed out or the host is unreachable
+
+    A refused connection still took a full round trip, so it counts.
+    """
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, address), timeout)
+    except ConnectionRefusedError:
+        pass
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        sock.close()
+    return (time.perf_counter() - start) * 1000
+
+def save_minutes(db_path, rows):
+    """Write (target, minute, *AGGREGATE_FIELDS) rows in one transaction"""
+    def write(c):
+        c.executemany('INSERT OR REPLACE INTO latency_minutes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                      rows)
+    db.get_writer(db_path).transaction(write)
+
+def get_version(c, start_minute, end_minute):
+    """(latest minute, row count) of the aggregates in [start_minute, end_minute)"""
+    c.execute('SELECT MAX(minute), COUNT(*) FROM latency_minutes WHERE minute >= ? AND minute < ?',
+              (start_minute, end_minute))
+    return tuple(c.fetchone())
+
+def get_series(c, start_minute, end_minute):
+    """Per-target columns of the aggregates in [start_minute, end_minute)
+
+    Returns {target: {'minute': [...], 'rtt_min': [...], ..., 'loss': [...]}}
+    with loss as a percentage of the probes sent.
+    """
+    c.execute('''SELECT target, minute, sent, received, rtt_min, rtt_p50, rtt_p99, jitter
+                 FROM latency_minutes WHERE minute >= ? AND minute < ?
+                 ORDER BY target, minute''', (start_minute, end_minute))
+    series = {}
+    for target, minute, sent, received, rtt_min, rtt_p50, rtt_p99, jitter in c.fetchall():
+        columns = series.get(target)
+        if columns is None:
+            columns = series[target] = {key: [] for key in
+                                        ('minute', 'rtt_min', 'rtt_p50', 'rtt_p99', 'jitter', 'loss')}
+        columns['minute'].append(minute)
+        columns['rtt_min'].append(rtt_min)
+        columns['rtt_p50'].append(rtt_p50)
+        columns['rtt_p99'].append(rtt_p99)
+        columns['jitter'].append(jitter)
+        columns['loss'].append(100.0 * (sent - received) / sent if sent else None)
+    return series
+
+class LatencySampler:
+    """Samples several targets every interval and flushes per-minute rows"""
+
+    def __init__(self, targets, db_path, interval=SAMPLE_INTERVAL):
+        self.targets = [parse_target(spec) if isinstance(spec, str) else spec
+                        for spec in targets]
+        self.names = ['%s:%d' % target for target in self.targets]
+        self.db_path = db_path
+        self.interval = interval
+        self.rings = [RttRing() for _ in self.targets]
+        self.addresses = [None] * len(self.targets)
+        self.pending = []
+
+    async def _resolve(self, i):
+        host, port = self.targets[i]
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            logger.warning("Cannot resolve latency target %s: %s", self.names[i], e)
+            return None
+        family, _, _, _, address = info[0]
+        self.addresses[i] = (family, address)
+        return self.addresses[i]
+
+    async def _probe(self, i, when):
+        resolved = self.addresses[i] or await self._resolve(i)
+        rtt = await tcp_rtt(resolved[1], resolved[0]) if resolved else None
+        if rtt is None:
+            self.addresses[i] = None  # resolve again next time, the address may have moved
+        self.rings[i].add(when, rtt)
+
+    def minute_rows(self, minute):
+        """Aggregate rows for every target over the given epoch minute"""
+        rows = []
+        for name, ring in zip(self.names, self.rings):
+            rtts = ring.window(minute * 60, minute * 60 + 60)
+            if rtts:
+                agg = aggregate(rtts)
+                rows.append((name, minute) + tuple(agg[field] for field in AGGREGATE_FIELDS))
+        return rows
+
+    async def flush(self, minute):
+        self.pending.extend(self.minute_rows(minute))
+        if not self.pending:
+            return
+        try:
+            await asyncio.to_thread(save_minutes, self.db_path, self.pending)
+            self.pending = []
+        except Exception as e:
+            limit = MAX_PENDING_MINUTES * len(self.targets)
+            logger.error("Could not save latency aggregates (%s); %d pending",
+                         str(e), len(self.pending))
+            del self.pending[:-limit]
+
+    async def run(self):
+        """Sample forever on a drift-free monotonic schedule"""
+        logger.info("Sampling latency to %s every %gs", ', '.join(self.names), self.interval)
+        start = time.monotonic()
+        tick = 0
+        minute = int(time.time()) // 60
+        while True:
+            when = time.time()
+            current = int(when) // 60
+            if current != minute:
+                await self.flush(minute)
+                minute = current
+            await asyncio.gather(*(self._probe(i, when) for i in range(len(self.targets))))
+            tick += 1
+            # Skip ticks missed while the loop was busy instead of bursting
+            tick = max(tick, int((time.monotonic() - start) / self.interval))
+            await asyncio.sleep(max(0.0, start + tick * self.interval - time.monotonic()))
@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+import http.client
+import multiprocessing
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Measures dashboard throughput under concurrent load for several worker
+# counts of serve.py, against a bench.py history. Clients are separate
+# processes holding keep-alive connections, so the load generator itself
+# is not limited to one core.
+DEFAULT_WORKERS = (1, 2, 4)
+DEFAULT_CLIENTS = 16
+DEFAULT_DURATION = 10.0   # seconds of load per worker count
+WARMUP = 2.0              # seconds of load before measuring
+DEFAULT_PATHS = ('/', '/api/stats', '/api/series', '/api/distribution')
+START_TIMEOUT = 30.0
+
+def _client(args):
+    """Request paths round-robin for duration seconds; returns (latencies ms, errors)"""
+    host, port, paths, duration = args
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    latencies, errors, i = [], 0, 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', paths[i % len(paths)])
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+    conn.close()
+    return latencies, errors
+
+def run_load(host, port, paths=DEFAULT_PATHS, clients=DEFAULT_CLIENTS, duration=DEFAULT_DURATION):
+    """Load a running server from clients processes; returns a report dict"""
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(_client, [(host, port, list(paths), duration)] * clients)
+    latencies = sorted(ms for result in results for ms in result[0])
+    errors = sum(result[1] for result in results)
+    if not latencies:
+        return {'requests': 0, 'errors': errors, 'rps': 0.0}
+    percentile = lambda q: latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+    return {'requests': len(latencies), 'errors': errors,
+            'rps': round(len(latencies) / duration, 1),
+            'p50_ms': round(percentile(50), 2), 'p99_ms': round(percentile(99), 2)}
+
+def start_server(db_path, workers, host='127.0.0.1'):
+    """Start serve.py on a free port; returns (process, port)"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+    process = subprocess.Popen([sys.executable, script, '--host', host, '--port', '0',
+                                '--workers', str(workers), '--db', db_path],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        line = process.stdout.readline()
+        if not line:
+            break
+        match = re.search(r'Serving on http://\S+:(\d+)', line)
+        if match:
+            # Keep draining the log so workers never block on a full pipe
+            threading.Thread(target=process.stdout.read, daemon=True).start()
+            return process, int(match.group(1))
+    process.kill()
+    raise RuntimeError('serve.py did not start')
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def _insert_samples(db_path, every, stop):
+    """Save a result every `every` seconds, so shared payloads keep changing"""
+    import speedtest_collector
+    while not stop.wait(every):
+        speedtest_collector.save_result({'download': 90.0, 'upload': 20.0, 'ping': 12.0,
+                                         'error': None}, db_path)
+
+def run(db_path, worker_counts=DEFAULT_WORKERS, clients=DEFAULT_CLIENTS,
+        duration=DEFAULT_DURATION, paths=DEFAULT_PATHS, insert_every=0):
+    """Load serve.py once per worker count; returns {workers: report}"""
+    results = {}
+    for workers in worker_counts:
+        process, port = start_server(db_path, workers)
+        stop = threading.Event()
+        try:
+            run_load('127.0.0.1', port, paths, clients, min(WARMUP, duration))
+            if insert_every:
+                threading.Thread(target=_insert_samples, args=(db_path, insert_every, stop),
+                                 daemon=True).start()
+            report = run_load('127.0.0.1', port, paths, clients, duration)
+        finally:
+            stop.set()
+            stop_server(process)
+        base = results[worker_counts[0]]['rps'] if results else report['rps']
+        report['speedup'] = round(report['rps'] / base, 2) if base else None
+        results[workers] = report
+        logger.info("%2d workers: %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d  x%.2f",
+                    workers, report['rps'], report.get('p50_ms', 0), report.get('p99_ms', 0),
+                    report['errors'], report['speedup'] or 0)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure dashboard throughput per worker count')
+    parser.add_argument('--db', default='bench_speedtest.db',
+                        help='database to serve; generated with bench.py defaults unless it exists')
+    parser.add_argument('--workers', type=int, nargs='+', default=list(DEFAULT_WORKERS))
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS,
+                        help='concurrent client processes (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help='seconds of load per worker count (default: %(default)s)')
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='path to request, repeatable (default: the dashboard and its APIs)')
+    parser.add_argument('--insert-every', type=float, default=0, metavar='SECONDS',
+                        help='save a new sample this often during the load (default: never)')
+    parser.add_argument('--output', help='write the JSON results here')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not os.path.exists(args.db):
+        import bench
+        bench.generate_history(args.db)
+    results = run(args.db, args.workers, args.clients, args.duration,
+                  args.paths or DEFAULT_PATHS, args.insert_every)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'),
+                       'cpus': os.cpu_count(), 'clients': args.clients,
+                       'duration': args.duration, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
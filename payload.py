@@ -0,0 +1,109 @@
+import gzip
+import time
+import base64
+import logging
+import functools
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Plot arrays leave the dashboard as Plotly typed-array specs,
+# {'dtype': 'f4', 'bdata': <base64 little-endian bytes>}, instead of JSON
+# number lists: a float32 is 4 bytes (5.3 in base64) where its JSON text
+# takes 6 to 20, and NaN marks a gap without a null. Timestamps are the
+# local wall-clock epoch seconds of each point, delta-encoded as int32
+# after 'start', which the page (decodeTraces in index.html) turns back
+# into the naive ISO strings the rest of the dashboard uses.
+#
+# Text responses are compressed for clients that accept it: brotli when
+# the brotli package is installed, otherwise gzip. Versioned vendor assets
+# are compressed once, at a higher level, and kept in memory.
+DTYPES = {'f4': '<f4', 'f8': '<f8', 'i4': '<i4'}
+ENCODINGS = ('br', 'gzip')
+COMPRESSIBLE = ('text/html', 'text/plain', 'text/css', 'application/json',
+                'application/javascript', 'text/javascript')
+MIN_COMPRESS_SIZE = 512   # bytes; smaller responses are sent as is
+GZIP_LEVEL = 6            # per-response levels favour speed
+BROTLI_QUALITY = 5
+ASSET_GZIP_LEVEL = 9      # vendor assets are compressed once per process
+ASSET_BROTLI_QUALITY = 9
+HOUR = 3600
+
+def _spec(values, dtype, **extra):
+    data = np.ascontiguousarray(values, dtype=DTYPES[dtype]).tobytes()
+    return dict(extra, dtype=dtype, bdata=base64.b64encode(data).decode('ascii'))
+
+def float32_array(values):
+    """Encode a sequence of numbers (None or NaN for gaps) as a float32 spec"""
+    return _spec(np.asarray(values, dtype=np.float64), 'f4')
+
+def local_wall_time(ts):
+    """Epoch seconds shifted by the local UTC offset in force at each of them
+
+    The offset is looked up once per distinct hour, so this stays exact
+    across DST changes. The result, read as UTC, is the local wall clock.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    hours, inverse = np.unique(ts // HOUR, return_inverse=True)
+    offsets = np.array([time.localtime(int(hour) * HOUR).tm_gmtoff for hour in hours],
+                       dtype=np.int64)
+    return ts + offsets[inverse]
+
+def time_array(ts):
+    """Encode epoch seconds as delta-encoded local wall-clock times"""
+    wall = local_wall_time(np.rint(np.asarray(ts, dtype=np.float64)))
+    if not len(wall):
+        return _spec(wall, 'i4', start=0)
+    return _spec(np.diff(wall, prepend=wall[0]), 'i4', start=int(wall[0]))
+
+def decode_array(spec):
+    """Decode a spec from float32_array or time_array into a list
+
+    Floats come back with None for gaps; times as naive ISO strings, as
+    the dashboard decodes them.
+    """
+    values = np.frombuffer(base64.b64decode(spec['bdata']), dtype=DTYPES[spec['dtype']])
+    if 'start' in spec:
+        wall = spec['start'] + np.cumsum(values, dtype=np.int64)
+        return [time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) for t in wall.tolist()]
+    return [None if v != v else v for v in values.astype(np.float64).tolist()]
+
+def decode_traces(traces):
+    """Copies of Plotly traces with every encoded array decoded into a list"""
+    return [{key: decode_array(value) if isinstance(value, dict) and 'bdata' in value else value
+             for key, value in trace.items()}
+            for trace in traces]
+
+def available_encodings():
+    """Content encodings this installation can produce, best first"""
+    encodings = []
+    for encoding in ENCODINGS:
+        if encoding == 'br':
+            try:
+                import brotli  # noqa: F401
+            except ImportError:
+                continue
+        encodings.append(encoding)
+    return encodings
+
+def compress(data, encoding, asset=False):
+    """Compress a response body with br or gzip; asset picks the slower, denser level"""
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data, quality=ASSET_BROTLI_QUALITY if asset else BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(data, ASSET_GZIP_LEVEL if asset else GZIP_LEVEL, mtime=0)
+    raise ValueError('unsupported encoding: %s' % encoding)
+
+@functools.lru_cache(maxsize=8)
+def compressed_asset(path, encoding=None):
+    """Contents of an immutable asset file, compressed with encoding (None: as is)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if encoding is None:
+        return data
+    start = time.perf_counter()
+    body = compress(data, encoding, asset=True)
+    logger.info("Compressed %s with %s: %d -> %d bytes in %.2fs", path, encoding,
+                len(data), len(body), time.perf_counter() - start)
+    return body
@@ -0,0 +1,149 @@
+import re
+import gzip
+import json
+import zlib
+import logging
+from datetime import datetime
+import rollups
+import anomaly
+
+logger = logging.getLogger(__name__)
+
+# Probe id of rows measured by the collector on this machine, including
+# every row from before probes were tracked
+LOCAL_PROBE = 'local'
+
+# Probe ids appear in URLs, ETags and log lines
+PROBE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.:-]{1,64}$')
+
+# Largest batch accepted by ingest, after decompression
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Largest seq and ts accepted: seq is stored as a signed 64-bit SQLite
+# INTEGER, and ts must convert to a local datetime in any time zone
+# (9999-12-30T23:59:59Z)
+MAX_SEQ = 2 ** 63 - 1
+MAX_TS = 253402214399
+
+# Fields of one NDJSON record, in the order they are inserted
+RECORD_FIELDS = ('seq', 'ts', 'download', 'upload', 'ping', 'error')
+
+def valid_probe_id(probe_id):
+    return bool(probe_id) and PROBE_ID_PATTERN.match(probe_id) is not None
+
+def add_probe_columns(c):
+    """Tag speedtests rows with the probe that measured them
+
+    Remote rows also carry the probe's own sequence number; the partial
+    unique index on (probe_id, seq) makes re-sent batches a no-op.
+    """
+    # A constant default is stored in the schema, so existing rows are not rewritten
+    c.execute("ALTER TABLE speedtests ADD COLUMN probe_id TEXT NOT NULL DEFAULT '%s'" % LOCAL_PROBE)
+    c.execute('ALTER TABLE speedtests ADD COLUMN seq INTEGER')
+    c.execute('''CREATE UNIQUE INDEX idx_speedtests_probe_seq
+                 ON speedtests (probe_id, seq) WHERE seq IS NOT NULL''')
+    c.execute('CREATE INDEX idx_speedtests_probe_ts ON speedtests (probe_id, ts)')
+    c.execute('''CREATE TABLE probes
+                 (probe_id TEXT PRIMARY KEY,
+                  last_seen INTEGER,
+                  last_seq INTEGER)''')
+    c.execute('''INSERT INTO probes (probe_id, last_seen)
+                 SELECT ?, MAX(ts) FROM speedtests HAVING COUNT(*) > 0''', (LOCAL_PROBE,))
+
+def touch_probe(c, probe_id, last_seen, last_seq=None):
+    """Record that probe_id has reported samples up to last_seen/last_seq"""
+    c.execute('''INSERT INTO probes (probe_id, last_seen, last_seq) VALUES (?, ?, ?)
+                 ON CONFLICT(probe_id) DO UPDATE SET
+                     last_seen = COALESCE(MAX(last_seen, excluded.last_seen), excluded.last_seen),
+                     last_seq = COALESCE(MAX(last_seq, excluded.last_seq), last_seq, excluded.last_seq)''',
+              (probe_id, last_seen, last_seq))
+
+def list_probes(c):
+    """Return (probe_id, last_seen, last_seq) for every known probe"""
+    c.execute('SELECT probe_id, last_seen, last_seq FROM probes ORDER BY probe_id')
+    return c.fetchall()
+
+def encode_batch(records):
+    """Serialize record dicts as gzip-compressed NDJSON"""
+    lines = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+    return gzip.compress(lines.encode(), compresslevel=6)
+
+def _decompress(body, max_bytes):
+    """Inflate a gzip body, refusing anything that expands past max_bytes"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(body, max_bytes + 1)
+    except zlib.error as e:
+        raise ValueError('invalid gzip body: %s' % e)
+    if len(data) > max_bytes or decompressor.unconsumed_tail:
+        raise ValueError('batch larger than %d bytes' % max_bytes)
+    return data
+
+def _number(value, field):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('%s must be a number' % field)
+    return float(value)
+
+def _integer(value, field, maximum):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError('%s must be a positive integer' % field)
+    if value > maximum:
+        raise ValueError('%s must be at most %d' % (field, maximum))
+    return value
+
+def decode_batch(body, content_encoding=None, max_bytes=MAX_BATCH_BYTES):
+    """Parse an NDJSON batch into validated record tuples in RECORD_FIELDS order
+
+    Raises ValueError on the first malformed line, so a batch is accepted
+    or rejected as a whole.
+    """
+    if (content_encoding or '').lower() == 'gzip':
+        body = _decompress(body, max_bytes)
+    elif len(body) > max_bytes:
+        raise ValueError('batch larger than %d bytes' % max_bytes)
+    records = []
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('expected an object')
+            error = record.get('error')
+            if error is not None and not isinstance(error, str):
+                raise ValueError('error must be a string')
+            records.append((_integer(record.get('seq'), 'seq', MAX_SEQ),
+                            _integer(record.get('ts'), 'ts', MAX_TS),
+                            _number(record.get('download'), 'download'),
+                            _number(record.get('upload'), 'upload'),
+                            _number(record.get('ping'), 'ping'),
+                            error))
+        except ValueError as e:
+            raise ValueError('line %d: %s' % (number, e))
+    return records
+
+def ingest_batch(c, probe_id, records):
+    """Insert one probe's batch and fold it into the rollups and incident detector
+
+    Runs inside the caller's transaction: a single executemany for the
+    whole batch, with rows already stored under the same (probe_id, seq)
+    skipped, so retried batches are idempotent.
+    """
+    if not records:
+        return {'accepted': 0, 'duplicates': 0, 'last_seq': None}
+    rows = [(datetime.fromtimestamp(ts).isoformat(), download, upload, ping, error,
+             ts, probe_id, seq)
+            for seq, ts, download, upload, ping, error in records]
+    before = c.connection.total_changes
+    c.executemany('''INSERT OR IGNORE INTO speedtests
+                     (timestamp, download, upload, ping, error, ts, probe_id, seq)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    accepted = c.connection.total_changes - before
+    last_seq = max(record[0] for record in records)
+    touch_probe(c, probe_id, max(record[1] for record in records), last_seq)
+    rollups.roll_up_pending(c)
+    anomaly.detect_pending(c)
+    logger.info("Ingested %d of %d samples from probe %s", accepted, len(records), probe_id)
+    return {'accepted': accepted, 'duplicates': len(records) - accepted, 'last_seq': last_seq}
@@ -0,0 +1,148 @@
+import time
+import asyncio
+import logging
+import db
+import rollups
+import shipper
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Retention tiers: raw rows for RAW_DAYS, hourly rollups for HOURLY_MONTHS,
+# daily rollups forever. Cutoffs fall on whole UTC days, so every tier
+# ends on a bucket boundary of the next.
+RAW_DAYS = 90
+HOURLY_MONTHS = 24
+MONTH_DAYS = 30
+
+BATCH_SIZE = 2000        # rows deleted per transaction
+BATCH_PAUSE = 0.1        # seconds between transactions, so collector writes get in
+VACUUM_PAGES = 512       # pages returned to the filesystem per transaction
+COMPACT_INTERVAL = 3600  # seconds between compaction passes
+
+DAY = rollups.ROLLUPS['day']
+HOUR = rollups.ROLLUPS['hour']
+
+def enable_incremental_vacuum(conn):
+    """Switch a database to auto_vacuum=INCREMENTAL
+
+    Must run outside a transaction. A new database only needs the pragma;
+    an existing one is rebuilt once with VACUUM, which takes a while on a
+    large file.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.info("Rebuilding database once to enable incremental vacuum")
+        conn.execute('VACUUM')
+
+def get_cutoffs(now=None, raw_days=RAW_DAYS, hourly_months=HOURLY_MONTHS):
+    """Return (raw_cutoff, hour_cutoff): ts before which each finer tier is dropped"""
+    today = int(time.time() if now is None else now) // DAY
+    return ((today - raw_days) * DAY,
+            (today - raw_days - hourly_months * MONTH_DAYS) * DAY)
+
+def raise_floors(c, raw_cutoff, hour_cutoff):
+    """Move the tier floors up to the cutoffs; they never move down
+
+    Committed before anything is deleted, so readers switch to the
+    coarser tier at once and never see a half-compacted range.
+    """
+    raw_floor, hour_floor = rollups.get_floors(c)
+    raw_floor, hour_floor = max(raw_floor, raw_cutoff), max(hour_floor, hour_cutoff)
+    c.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                  [('raw_floor', raw_floor), ('hour_floor', hour_floor)])
+    return raw_floor, hour_floor
+
+def deletable_id(c, keep_unshipped=False):
+    """Highest speedtests.id compaction may delete
+
+    Rows not yet folded into the rollups, or not yet acknowledged by the
+    ingest server when shipping, are kept whatever their age.
+    """
+    limit = rollups.get_rolled_id(c)
+    if keep_unshipped:
+        limit = min(limit, shipper.get_shipped_id(c))
+    return limit
+
+def delete_raw_batch(c, raw_floor, keep_unshipped=False, batch_size=BATCH_SIZE):
+    """Delete up to batch_size raw rows older than raw_floor; returns the count"""
+    c.execute('''DELETE FROM speedtests WHERE id IN
+                 (SELECT id FROM speedtests WHERE ts < ? AND id <= ? LIMIT ?)''',
+              (raw_floor, deletable_id(c, keep_unshipped), batch_size))
+    return c.rowcount
+
+def delete_latency_batch(c, raw_floor, batch_size=BATCH_SIZE):
+    """Delete up to batch_size per-minute latency rows older than raw_floor"""
+    c.execute('''DELETE FROM latency_minutes WHERE (minute, target) IN
+                 (SELECT minute, target FROM latency_minutes WHERE minute < ? LIMIT ?)''',
+              (raw_floor // 60, batch_size))
+    return c.rowcount
+
+def delete_hour_batch(c, hour_floor, batch_size=BATCH_SIZE):
+    """Delete up to batch_size hourly buckets older than hour_floor"""
+    c.execute('''DELETE FROM speedtest_rollups_hour WHERE bucket IN
+                 (SELECT bucket FROM speedtest_rollups_hour WHERE bucket < ? LIMIT ?)''',
+              (hour_floor // HOUR, batch_size))
+    return c.rowcount
+
+def vacuum_step(c, pages=VACUUM_PAGES):
+    """Release up to pages free pages; returns how many are left"""
+    c.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall()
+    return c.execute('PRAGMA freelist_count').fetchone()[0]
+
+def _in_batches(writer, step, batch_size, pause):
+    """Run step in its own transaction until it handles less than a full batch"""
+    total = 0
+    while True:
+        n = writer.transaction(step)
+        total += n
+        if n < batch_size:
+            return total
+        time.sleep(pause)
+
+def compact(db_path, now=None, raw_days=RAW_DAYS, hourly_months=HOURLY_MONTHS,
+            keep_unshipped=False, batch_size=BATCH_SIZE, pause=0):
+    """Run one full compaction pass in small transactions
+
+    Returns (raw rows deleted, hourly buckets deleted). pause is slept
+    between transactions to leave the writer to others.
+    """
+    writer = db.get_writer(db_path)
+    raw_cutoff, hour_cutoff = get_cutoffs(now, raw_days, hourly_months)
+    raw_floor, hour_floor = writer.transaction(
+        lambda c: raise_floors(c, raw_cutoff, hour_cutoff))
+    # Sealed months go as whole files once they are entirely below the floor
+    shards.drop_expired(db_path, raw_floor)
+    raw = _in_batches(writer, lambda c: delete_raw_batch(c, raw_floor, keep_unshipped,
+                                                         batch_size),
+                      batch_size, pause)
+    _in_batches(writer, lambda c: delete_latency_batch(c, raw_floor, batch_size),
+                batch_size, pause)
+    hourly = _in_batches(writer, lambda c: delete_hour_batch(c, hour_floor, batch_size),
+                         batch_size, pause)
+    # Give the freed pages back to the filesystem, a few at a time
+    free = None
+    while True:
+        left = writer.transaction(vacuum_step)
+        if not left or left == free:  # nothing left, or not in incremental mode
+            break
+        free = left
+        time.sleep(pause)
+    if raw or hourly:
+        logger.info("Compacted %d raw rows before %s and %d hourly buckets before %s",
+                    raw, time.strftime('%Y-%m-%d', time.gmtime(raw_floor)),
+                    hourly, time.strftime('%Y-%m-%d', time.gmtime(hour_floor)))
+    return raw, hourly
+
+async def compact_loop(db_path, raw_days=RAW_DAYS, hourly_months=HOURLY_MONTHS,
+                       keep_unshipped=False, interval=COMPACT_INTERVAL):
+    """Compact in the background every interval, yielding between transactions"""
+    while True:
+        try:
+            await asyncio.to_thread(compact, db_path, None, raw_days, hourly_months,
+                                    keep_unshipped, BATCH_SIZE, BATCH_PAUSE)
+        except Exception as e:
+            logger.error("Compaction failed: %s", str(e))
+        await asyncio.sleep(interval)
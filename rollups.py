@@ -0,0 +1,431 @@
+import sqlite3
+import logging
+import sketch
+
+logger = logging.getLogger(__name__)
+
+# Rollup granularities, keyed by the suffix of their table name. A bucket is
+# the integer epoch divided by the bucket width, so bucket * width is the
+# first second it covers.
+ROLLUPS = {
+    'hour': 3600,
+    'day': 86400,
+}
+
+METRICS = ('down', 'up', 'ping')
+METRIC_COLUMNS = {'down': 'download', 'up': 'upload', 'ping': 'ping'}
+
+# Order of the aggregate tuples returned by aggregate_raw/aggregate_rollups
+AGG_FIELDS = ('total_count', 'error_count', 'count') + tuple(
+    '%s_%s' % (metric, field)
+    for metric in METRICS
+    for field in ('sum', 'sumsq', 'min', 'max')
+)
+
+def _table(granularity):
+    return 'speedtest_rollups_%s' % granularity
+
+def _sketch_column(metric):
+    return '%s_sketch' % metric
+
+def create_rollup_tables(c):
+    """Create the rollup tables and the rollup high-water mark"""
+    for granularity in ROLLUPS:
+        columns = ',\n'.join('%s_%s REAL' % (metric, field)
+                             for metric in METRICS
+                             for field in ('sum', 'sumsq', 'min', 'max'))
+        c.execute('''CREATE TABLE IF NOT EXISTS %s
+                     (bucket INTEGER PRIMARY KEY,
+                      total_count INTEGER NOT NULL,
+                      error_count INTEGER NOT NULL,
+                      count INTEGER NOT NULL,
+                      %s)''' % (_table(granularity), columns))
+    c.execute('''CREATE TABLE IF NOT EXISTS meta
+                 (key TEXT PRIMARY KEY, value)''')
+    c.execute("INSERT OR IGNORE INTO meta VALUES ('rolled_id', 0)")
+
+def add_sketch_columns(c):
+    """Add a quantile sketch column per metric to every rollup table"""
+    for granularity in ROLLUPS:
+        for metric in METRICS:
+            c.execute('ALTER TABLE %s ADD COLUMN %s BLOB'
+                      % (_table(granularity), _sketch_column(metric)))
+
+def backfill_sketches(c):
+    """Fill the sketch columns from every row already rolled up"""
+    _update_sketches(c, 0, get_rolled_id(c))
+
+def _raw_select():
+    # Error rows store NULL measurements, so SUM/MIN/MAX only see successes
+    parts = ['COUNT(*)',
+             'SUM(error IS NOT NULL)',
+             'SUM(error IS NULL)']
+    for metric in METRICS:
+        column = METRIC_COLUMNS[metric]
+        parts += ['SUM(%s)' % column,
+                  'SUM(%s * %s)' % (column, column),
+                  'MIN(%s)' % column,
+                  'MAX(%s)' % column]
+    return ', '.join(parts)
+
+def _rollup_select():
+    parts = ['SUM(total_count)', 'SUM(error_count)', 'SUM(count)']
+    for metric in METRICS:
+        parts += ['SUM(%s_sum)' % metric,
+                  'SUM(%s_sumsq)' % metric,
+                  'MIN(%s_min)' % metric,
+                  'MAX(%s_max)' % metric]
+    return ', '.join(parts)
+
+def get_rolled_id(c):
+    """Return the highest speedtests.id already folded into the rollups"""
+    row = c.execute("SELECT value FROM meta WHERE key = 'rolled_id'").fetchone()
+    return row[0] if row else 0
+
+def get_floors(c):
+    """Return (raw_floor, hour_floor), the oldest ts each finer tier is complete from
+
+    Retention (see retention.py) deletes raw rows older than raw_floor and
+    hourly buckets older than hour_floor; windows reaching below them are
+    answered from the next coarser tier. Both are 0 until the first
+    compaction.
+    """
+    c.execute("SELECT key, value FROM meta WHERE key IN ('raw_floor', 'hour_floor')")
+    floors = dict(c.fetchall())
+    return floors.get('raw_floor', 0), floors.get('hour_floor', 0)
+
+def roll_up_pending(c):
+    """Fold every speedtests row above the high-water mark into the rollups
+
+    Runs inside the caller's transaction, so a sample and its rollup
+    update are committed together.
+    """
+    rolled_id = get_rolled_id(c)
+    max_id = c.execute('SELECT MAX(id) FROM speedtests').fetchone()[0]
+    if max_id is None or max_id <= rolled_id:
+        return 0
+    _roll_up(c, rolled_id, max_id)
+    c.execute("UPDATE meta SET value = ? WHERE key = 'rolled_id'", (max_id,))
+    return max_id - rolled_id
+
+def _roll_up(c, rolled_id, max_id, min_ts=None):
+    """Add rows with rolled_id < id <= max_id (and ts >= min_ts) to the rollups"""
+    updates = ['total_count = total_count + excluded.total_count',
+               'error_count = error_count + excluded.error_count',
+               'count = count + excluded.count']
+    for metric in METRICS:
+        for field in ('sum', 'sumsq'):
+            column = '%s_%s' % (metric, field)
+            updates.append('%s = COALESCE(%s, 0) + COALESCE(excluded.%s, 0)'
+                           % (column, column, column))
+        for field, func in (('min', 'MIN'), ('max', 'MAX')):
+            column = '%s_%s' % (metric, field)
+            # Scalar MIN/MAX return NULL if either side is NULL
+            updates.append('%s = %s(COALESCE(%s, excluded.%s), COALESCE(excluded.%s, %s))'
+                           % (column, func, column, column, column, column))
+
+    ts_clause = 'AND ts >= %d' % min_ts if min_ts is not None else ''
+    for granularity, width in ROLLUPS.items():
+        c.execute('''INSERT INTO %s (bucket, %s)
+                     SELECT ts / %d, %s
+                     FROM speedtests
+                     WHERE id > ? AND id <= ? %s
+                     GROUP BY ts / %d
+                     ON CONFLICT(bucket) DO UPDATE SET %s'''
+                  % (_table(granularity), ', '.join(AGG_FIELDS), width,
+                     _raw_select(), ts_clause, width, ', '.join(updates)),
+                  (rolled_id, max_id))
+    _update_sketches(c, rolled_id, max_id, ts_clause)
+
+def _has_sketches(c):
+    columns = [row[1] for row in c.execute('PRAGMA table_info(%s)' % _table('hour'))]
+    return _sketch_column(METRICS[0]) in columns
+
+def _update_sketches(c, rolled_id, max_id, ts_clause=''):
+    """Add successful samples with rolled_id < id <= max_id to the sketches"""
+    # Migration 2 rolls up before migration 3 has added the sketch columns
+    if not _has_sketches(c):
+        return
+    c.execute('''SELECT ts, download, upload, ping FROM speedtests
+                 WHERE id > ? AND id <= ? AND error IS NULL %s''' % ts_clause,
+              (rolled_id, max_id))
+    rows = c.fetchall()
+    for granularity, width in ROLLUPS.items():
+        by_bucket = {}
+        for row in rows:
+            by_bucket.setdefault(row[0] // width, []).append(row)
+        columns = [_sketch_column(metric) for metric in METRICS]
+        for bucket, samples in by_bucket.items():
+            c.execute('SELECT %s FROM %s WHERE bucket = ?'
+                      % (', '.join(columns), _table(granularity)), (bucket,))
+            blobs = c.fetchone()
+            updated = [sketch.add_values(blobs[i], [sample[i + 1] for sample in samples])
+                       for i in range(len(METRICS))]
+            c.execute('UPDATE %s SET %s WHERE bucket = ?'
+                      % (_table(granularity), ', '.join('%s = ?' % col for col in columns)),
+                      updated + [bucket])
+
+def rebuild_rollups(conn):
+    """Recompute the rollup tables from the raw speedtests rows
+
+    Buckets older than the raw tier (see get_floors) no longer have their
+    raw rows, and those of months sealed into shards can't have changed;
+    both are kept as they are.
+    """
+    import shards  # shards imports this module
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        raw_floor = max(get_floors(c)[0], shards.sealed_until(c))
+        # Old rows kept back from compaction still belong in the kept buckets
+        roll_up_pending(c)
+        for granularity, width in ROLLUPS.items():
+            c.execute('DELETE FROM %s WHERE bucket >= ?' % _table(granularity),
+                      (-(-raw_floor // width),))
+        max_id = c.execute('SELECT MAX(id) FROM speedtests').fetchone()[0] or 0
+        _roll_up(c, 0, max_id, raw_floor)
+        c.execute("UPDATE meta SET value = ? WHERE key = 'rolled_id'", (max_id,))
+        rolled = c.execute('SELECT COUNT(*) FROM speedtests WHERE ts >= ?',
+                           (raw_floor,)).fetchone()[0]
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+    logger.info("Rebuilt rollups from %d rows", rolled)
+    return rolled
+
+def _raw_where(start_ts=None, end_ts=None, min_id=None, successes_only=False, probe_id=None):
+    """Build the WHERE clause for a raw speedtests range, optionally for one probe"""
+    # Rows above the rollup high-water mark are few, so when min_id is
+    # given the unary + keeps the planner on the rowid range instead of
+    # walking the ts or error indexes.
+    prefix = '+' if min_id is not None else ''
+    clauses, params = [], []
+    if successes_only:
+        clauses.append('%serror IS NULL' % prefix)
+    if start_ts is not None:
+        clauses.append('%sts >= ?' % prefix)
+        params.append(start_ts)
+    if end_ts is not None:
+        clauses.append('%sts < ?' % prefix)
+        params.append(end_ts)
+    if min_id is not None:
+        clauses.append('id > ?')
+        params.append(min_id)
+    if probe_id is not None:
+        clauses.append('probe_id = ?')
+        params.append(probe_id)
+    return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+def aggregate_raw(c, start_ts=None, end_ts=None, min_id=None, probe_id=None):
+    """Aggregate raw rows with start_ts <= ts < end_ts and id > min_id"""
+    where, params = _raw_where(start_ts, end_ts, min_id, probe_id=probe_id)
+    c.execute('SELECT %s FROM speedtests %s' % (_raw_select(), where), params)
+    return c.fetchone()
+
+def aggregate_rollups(c, granularity, start_bucket=None, end_bucket=None):
+    """Aggregate rollup buckets with start_bucket <= bucket < end_bucket"""
+    clauses, params = [], []
+    if start_bucket is not None:
+        clauses.append('bucket >= ?')
+        params.append(start_bucket)
+    if end_bucket is not None:
+        clauses.append('bucket < ?')
+        params.append(end_bucket)
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    c.execute('SELECT %s FROM %s %s' % (_rollup_select(), _table(granularity), where),
+              params)
+    return c.fetchone()
+
+def combine(*aggregates):
+    """Merge aggregate tuples in AGG_FIELDS order into a dict
+
+    Counts and sums default to 0; min/max stay None when no sample
+    contributed to them.
+    """
+    result = dict.fromkeys(AGG_FIELDS)
+    for agg in aggregates:
+        for field, value in zip(AGG_FIELDS, agg):
+            current = result[field]
+            if value is None:
+                continue
+            if current is None:
+                result[field] = value
+            elif field.endswith('_min'):
+                result[field] = min(current, value)
+            elif field.endswith('_max'):
+                result[field] = max(current, value)
+            else:
+                result[field] = current + value
+    for field in AGG_FIELDS:
+        if result[field] is None and not field.endswith(('_min', '_max')):
+            result[field] = 0
+    return result
+
+def _window_pieces(start_ts, end_ts, rolled_id, raw_floor=0, hour_floor=0):
+    """Split start_ts < ts <= end_ts into raw and rollup pieces
+
+    Yields ('raw', start, end, min_id) for half-open ts ranges read from
+    speedtests and (granularity, first_bucket, end_bucket) for buckets
+    read from a rollup table. Below raw_floor the window is covered at
+    hour resolution and below hour_floor at day resolution, taking every
+    bucket that starts inside it.
+    """
+    lo, hi = start_ts + 1, end_ts + 1
+    for granularity, floor in (('day', hour_floor), ('hour', raw_floor)):
+        if lo >= min(hi, floor):
+            continue
+        top = min(hi, floor)
+        width = ROLLUPS[granularity]
+        yield (granularity, -(-lo // width), -(-top // width))
+        yield ('raw', lo, top, rolled_id)
+        lo = top
+    if lo >= hi:
+        return
+    width = ROLLUPS['hour']
+    first_bucket = -(-lo // width)  # first hour starting at or after lo
+    end_bucket = hi // width        # first hour not ending by hi
+    if first_bucket >= end_bucket:
+        yield ('raw', lo, hi, None)
+        return
+    yield ('raw', lo, first_bucket * width, None)
+    yield ('hour', first_bucket, end_bucket)
+    yield ('raw', first_bucket * width, end_bucket * width, rolled_id)
+    yield ('raw', end_bucket * width, hi, None)
+
+def window_aggregate(c, start_ts, end_ts):
+    """Aggregate all samples with start_ts < ts <= end_ts
+
+    Whole hours inside the window come from the hourly rollups; the
+    partial hours at either edge and any rows not yet rolled up are read
+    from speedtests through the ts index. Compacted history is read from
+    the rollups alone.
+    """
+    parts = []
+    for piece in _window_pieces(start_ts, end_ts, get_rolled_id(c), *get_floors(c)):
+        if piece[0] == 'raw':
+            parts.append(aggregate_raw(c, *piece[1:]))
+        else:
+            parts.append(aggregate_rollups(c, *piece))
+    return combine(*parts)
+
+def overall_aggregate(c):
+    """Aggregate every sample from the daily rollups plus the unrolled tail"""
+    rolled_id = get_rolled_id(c)
+    return combine(aggregate_rollups(c, 'day'),
+                   aggregate_raw(c, min_id=rolled_id))
+
+def _raw_values(c, metric, start_ts=None, end_ts=None, min_id=None, probe_id=None):
+    where, params = _raw_where(start_ts, end_ts, min_id, successes_only=True, probe_id=probe_id)
+    c.execute('SELECT %s FROM speedtests %s' % (METRIC_COLUMNS[metric], where), params)
+    return [row[0] for row in c.fetchall()]
+
+def _rollup_sketches(c, granularity, metric, start_bucket=None, end_bucket=None):
+    clauses, params = [], []
+    if start_bucket is not None:
+        clauses.append('bucket >= ?')
+        params.append(start_bucket)
+    if end_bucket is not None:
+        clauses.append('bucket < ?')
+        params.append(end_bucket)
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    c.execute('SELECT %s FROM %s %s' % (_sketch_column(metric), _table(granularity), where),
+              params)
+    return [row[0] for row in c.fetchall()]
+
+def window_sketch(c, metric, start_ts, end_ts):
+    """Merged histogram of one metric for samples with start_ts < ts <= end_ts"""
+    blobs, raw = [], []
+    for piece in _window_pieces(start_ts, end_ts, get_rolled_id(c), *get_floors(c)):
+        if piece[0] == 'raw':
+            raw.extend(_raw_values(c, metric, *piece[1:]))
+        else:
+            blobs.extend(_rollup_sketches(c, piece[0], metric, *piece[1:]))
+    return sketch.merge(blobs, raw)
+
+def overall_sketch(c, metric):
+    """Merged histogram of one metric over the whole history"""
+    return sketch.merge(_rollup_sketches(c, 'day', metric),
+                        _raw_values(c, metric, min_id=get_rolled_id(c)))
+
+def compacted_series(c, start_ts, end_ts):
+    """Per-bucket average (ts, download, upload) for start_ts < ts <= end_ts below raw_floor
+
+    Stands in for the raw series where raw rows have been compacted away;
+    each bucket is placed at its midpoint.
+    """
+    raw_floor, hour_floor = get_floors(c)
+    rows = []
+    for piece in _window_pieces(start_ts, min(end_ts, raw_floor - 1), 0, raw_floor, hour_floor):
+        if piece[0] == 'raw':
+            continue
+        granularity, first_bucket, end_bucket = piece
+        width = ROLLUPS[granularity]
+        c.execute('''SELECT bucket * %d + %d, down_sum / count, up_sum / count
+                     FROM %s WHERE bucket >= ? AND bucket < ? AND count > 0
+                     ORDER BY bucket''' % (width, width // 2, _table(granularity)),
+                  (first_bucket, end_bucket))
+        rows.extend(c.fetchall())
+    return rows
+
+def earliest_ts(c):
+    """Oldest successful sample's ts, from the raw rows or the daily rollups
+
+    Sealed months are all rolled up, so only the main database's raw
+    rows are read, whatever shards c's connection has attached.
+    """
+    raw = c.execute('SELECT MIN(ts) FROM main.speedtests WHERE error IS NULL').fetchone()[0]
+    day = c.execute('SELECT MIN(bucket) FROM %s WHERE count > 0'
+                    % _table('day')).fetchone()[0]
+    candidates = [ts for ts in (raw, day * ROLLUPS['day'] if day is not None else None)
+                  if ts is not None]
+    return min(candidates) if candidates else None
+
+def probe_earliest_ts(c, probe_id):
+    """Oldest successful sample's ts of one probe, from its raw rows"""
+    import shards  # shards imports this module
+    for lo, hi in shards.ranges(c.connection):
+        where, params = _raw_where(lo, hi, successes_only=True, probe_id=probe_id)
+        ts = c.execute('SELECT MIN(ts) FROM speedtests %s' % where, params).fetchone()[0]
+        if ts is not None:
+            return ts
+    return None
+
+def _open_range(start_ts, end_ts):
+    """Convert start_ts < ts <= end_ts (either end optional) to a half-open range"""
+    return (start_ts + 1 if start_ts is not None else None,
+            end_ts + 1 if end_ts is not None else None)
+
+def probe_aggregate(c, probe_id, start_ts=None, end_ts=None):
+    """Aggregate one probe's samples with start_ts < ts <= end_ts
+
+    The rollups cover the whole fleet, so a single probe is read from
+    speedtests through the (probe_id, ts) index, wherever the rows are
+    stored: c's connection is attached to the shards the range covers.
+    """
+    import shards  # shards imports this module
+    return combine(*[aggregate_raw(c, lo, hi, probe_id=probe_id)
+                     for lo, hi in shards.ranges(c.connection, *_open_range(start_ts, end_ts))])
+
+def probe_sketch(c, probe_id, metric, start_ts=None, end_ts=None):
+    """Histogram of one probe's metric for samples with start_ts < ts <= end_ts"""
+    import shards  # shards imports this module
+    values = []
+    for lo, hi in shards.ranges(c.connection, *_open_range(start_ts, end_ts)):
+        values.extend(_raw_values(c, metric, lo, hi, probe_id=probe_id))
+    return sketch.merge([], values)
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Rebuild speedtest rollup tables')
+    parser.add_argument('db_path', help='path to speedtest.db')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.db_path, isolation_level=None)
+    try:
+        rebuild_rollups(conn)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    _main()
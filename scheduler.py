@@ -0,0 +1,96 @@
+import time
+import random
+import logging
+import statistics
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Each target runs on its own monotonic schedule: the next run is due one
+# interval after the previous one was due (not after it finished), so
+# test durations never make the schedule drift. Runs are delayed by a
+# random fraction of the interval, so a fleet of probes started together
+# does not test in lockstep. The interval adapts to the link: it drops
+# to the minimum as soon as a result looks degraded, returns to the
+# base interval once results are healthy again, and doubles up to the
+# maximum while they stay healthy.
+JITTER = 0.1              # runs are delayed by up to this fraction of the interval
+STABLE_RUNS = 3           # healthy results in a row before backing off
+BACKOFF = 2.0             # interval growth per further healthy result
+BASELINE_RUNS = 12        # healthy results the baseline speeds are the median of
+MIN_BASELINE = 3          # healthy results needed before speeds are judged at all
+DEGRADED_RATIO = 0.7      # download or upload below this fraction of the baseline
+PING_RATIO = 2.0          # ping above this multiple of the baseline
+
+class Schedule:
+    """When a target should next run, and how often, given its results"""
+
+    def __init__(self, interval, min_interval=None, max_interval=None, jitter=JITTER,
+                 clock=time.monotonic, rng=None):
+        self.base = interval
+        self.min_interval = min(interval, min_interval or interval)
+        self.max_interval = max(interval, max_interval or interval)
+        self.interval = interval
+        self.jitter = jitter
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.due = None
+        self.skipped = 0
+        self.healthy_runs = 0
+        self.history = deque(maxlen=BASELINE_RUNS)
+
+    def start(self, delay=0):
+        """Seconds to wait before the first run, which is due delay seconds from now"""
+        self.due = self.clock() + delay
+        return delay + self._jitter()
+
+    def _jitter(self):
+        return self.rng.uniform(0, self.jitter * self.interval)
+
+    def baseline(self):
+        """Median (download, upload, ping) of recent healthy results, or None"""
+        if len(self.history) < MIN_BASELINE:
+            return None
+        return tuple(statistics.median(values) for values in zip(*self.history))
+
+    def is_degraded(self, result):
+        """Whether a result is an error or well off the recent baseline"""
+        if result.get('error'):
+            return True
+        baseline = self.baseline()
+        if baseline is None:
+            return False
+        download, upload, ping = baseline
+        return (result['download'] < DEGRADED_RATIO * download
+                or result['upload'] < DEGRADED_RATIO * upload
+                or result['ping'] > PING_RATIO * ping)
+
+    def observe(self, result):
+        """Adapt the interval to a result; returns the new interval"""
+        if self.is_degraded(result):
+            self.healthy_runs = 0
+            interval = self.min_interval
+        else:
+            self.history.append((result['download'], result['upload'], result['ping']))
+            self.healthy_runs += 1
+            interval = self.base
+            if self.healthy_runs > STABLE_RUNS:
+                interval = min(max(self.interval, self.base) * BACKOFF, self.max_interval)
+        self.interval = interval
+        return interval
+
+    def next_delay(self):
+        """Seconds to wait before the next run
+
+        The next run is due one interval after the last one was due. Slots
+        that have already passed, because the run overran, are skipped
+        rather than run back to back.
+        """
+        now = self.clock()
+        due = self.due + self.interval
+        if due < now:
+            missed = int((now - due) // self.interval) + 1
+            self.skipped += missed
+            due += missed * self.interval
+        self.due = due
+        return due - now + self._jitter()
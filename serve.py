@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+from werkzeug.serving import make_server
+import db
+import app as app_module
+from app import app
+
+logger = logging.getLogger(__name__)
+
+# Production server: one listening socket shared by several forked
+# worker processes, each serving requests on its own threads. Workers
+# share computed stats and plots through the snapshot file (see
+# snapshot.py), so a new sample is processed once, not once per worker.
+# Prometheus metrics are not shared: each worker has its own registry,
+# so /metrics reports the counters of whichever worker serves the scrape.
+# POSIX only.
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_PORT = 8000
+BACKLOG = 256
+RESPAWN_DELAY = 1.0   # seconds before replacing a worker that died
+
+def _run_worker(sock):
+    """Serve requests on the inherited socket until killed"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops us with SIGTERM
+    db.close_all()  # never share SQLite connections across a fork
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+def _spawn(sock):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_worker(sock)
+        except BaseException as e:
+            logger.error("Worker %d failed: %s", os.getpid(), str(e))
+        finally:
+            os._exit(1)
+    return pid
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+def serve(host='0.0.0.0', port=DEFAULT_PORT, workers=DEFAULT_WORKERS, db_path=None):
+    """Run workers processes serving the dashboard until SIGTERM or Ctrl+C"""
+    if db_path is not None:
+        app.config['DATABASE'] = db_path
+    app.config['SHARED_SNAPSHOT'] = True
+    # Entries are keyed on row ids, which mean nothing in another database
+    shared = app_module.get_snapshot()
+    if os.path.exists(shared.path):
+        os.remove(shared.path)
+
+    sock = socket.create_server((host, port), backlog=BACKLOG)
+    sock.set_inheritable(True)
+    logger.info("Serving on http://%s:%d with %d workers", host, sock.getsockname()[1], workers)
+    children = {_spawn(sock) for _ in range(workers)}
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid in children:
+                children.discard(pid)
+                logger.warning("Worker %d exited with status %d; replacing it", pid, status)
+                time.sleep(RESPAWN_DELAY)
+                children.add(_spawn(sock))
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping %d workers", len(children))
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the dashboard with several worker processes')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='worker processes (default: one per CPU, %(default)s here)')
+    parser.add_argument('--db', help='database to serve (default: speedtest.db next to app.py)')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    # Per-request DEBUG logging from every worker would swamp the output
+    logging.getLogger().setLevel(logging.INFO)
+    serve(args.host, args.port, args.workers, args.db)
+
+if __name__ == '__main__':
+    main()
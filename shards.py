@@ -0,0 +1,298 @@
+import os
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timezone
+from urllib.parse import quote
+import db
+import rollups
+import anomaly
+import shipper
+
+logger = logging.getLogger(__name__)
+
+# Finished months of raw results are moved out of the main database into
+# one file per month in <db>.shards/, listed in the main database's shards
+# table. A month is sealed ARCHIVE_DELAY_DAYS after it ends, once all its
+# rows are rolled up, checked for incidents and (when shipping) shipped.
+# Shard files are read-only and never modified in place: rows arriving
+# late for a sealed month produce a new generation of its file, swapped in
+# by the same transaction that removes them from the main database. That
+# lets readers open shards with immutable=1, skipping all locking and
+# change detection.
+#
+# Readers see the shards a query's time range touches through a TEMP VIEW
+# named speedtests that shadows main.speedtests with a UNION ALL over it
+# and the attached shards. SQLite pushes range conditions into every
+# branch, so each is still read through its own indexes. A range covering
+# more than MAX_ATTACHED shards is read in consecutive sub-ranges of at
+# most that many (see ranges), whose partial results the caller merges.
+ARCHIVE_DELAY_DAYS = 14   # days after a month ends before it is sealed
+ARCHIVE_INTERVAL = 3600   # seconds between archive passes
+MAX_ATTACHED = 8          # shards attached to one connection (SQLite allows 10)
+SCHEMA_PREFIX = 'shard_'
+DAY = 86400
+
+class TooManyShards(Exception):
+    """A range covers more shards than one connection can attach; see ranges()"""
+
+def create_shard_table(c):
+    """Create the manifest of sealed monthly shards"""
+    c.execute('''CREATE TABLE IF NOT EXISTS shards
+                 (month TEXT PRIMARY KEY,
+                  file TEXT NOT NULL,
+                  start_ts INTEGER NOT NULL,
+                  end_ts INTEGER NOT NULL,
+                  rows INTEGER NOT NULL,
+                  max_id INTEGER NOT NULL,
+                  generation INTEGER NOT NULL)''')
+
+def shard_dir(db_path):
+    """Directory holding db_path's shard files"""
+    return os.path.splitext(db_path)[0] + '.shards'
+
+def month_range(ts):
+    """Return ('YYYY-MM', start_ts, end_ts) of the UTC month containing ts"""
+    day = datetime.fromtimestamp(ts, timezone.utc)
+    start = day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start.strftime('%Y-%m'), int(start.timestamp()), int(end.timestamp())
+
+def _schema(month):
+    return SCHEMA_PREFIX + month.replace('-', '_')
+
+def _shard_uri(path):
+    return 'file:%s?mode=ro&immutable=1' % quote(os.path.realpath(path))
+
+def get_manifest(c):
+    """Every sealed shard as (month, file, start_ts, end_ts, rows, max_id, generation)"""
+    return c.execute('SELECT * FROM main.shards ORDER BY month').fetchall()
+
+def sealed_until(c):
+    """End of the newest sealed month, or 0 when nothing is sealed"""
+    return c.execute('SELECT MAX(end_ts) FROM main.shards').fetchone()[0] or 0
+
+def attach(conn, start_ts=None, end_ts=None):
+    """Make speedtests on a read connection cover the shards overlapping [start_ts, end_ts)
+
+    Other shards are detached, so queries only visit the months they
+    can match; with no shard involved the view is dropped and queries
+    read main.speedtests directly. The connection must not be in a
+    transaction or write to speedtests. Returns the number attached.
+    """
+    needed = [(month, file) for month, file, *_ in _overlapping(conn, start_ts, end_ts)]
+    databases = conn.execute('PRAGMA database_list').fetchall()
+    attached = {name: path for _, name, path in databases if name.startswith(SCHEMA_PREFIX)}
+    if not needed and not attached:
+        return 0
+    if len(needed) > MAX_ATTACHED:
+        raise TooManyShards('range covers %d shards; at most %d can be attached at once'
+                            % (len(needed), MAX_ATTACHED))
+    folder = shard_dir(next(path for _, name, path in databases if name == 'main'))
+    # A shard rewritten since it was attached is reattached from its new file
+    wanted = {_schema(month): os.path.realpath(os.path.join(folder, file))
+              for month, file in needed}
+    if wanted == attached and _view_schemas(conn) == sorted(wanted):
+        return len(wanted)
+
+    conn.execute('DROP VIEW IF EXISTS temp.speedtests')
+    for name, path in attached.items():
+        if wanted.get(name) != path:
+            conn.execute('DETACH DATABASE %s' % name)
+    for name, path in wanted.items():
+        if attached.get(name) != path:
+            conn.execute('ATTACH DATABASE ? AS %s' % name, (_shard_uri(path),))
+    if wanted:
+        conn.execute('CREATE TEMP VIEW speedtests AS %s' % ' UNION ALL '.join(
+            'SELECT * FROM %s.speedtests' % name for name in ['main'] + sorted(wanted)))
+    logger.debug("Attached shards: %s", ', '.join(sorted(wanted)) or 'none')
+    return len(wanted)
+
+def detach(conn):
+    """Drop the speedtests view and every shard, so speedtests is main.speedtests again"""
+    return attach(conn, 0, 0)
+
+def _overlapping(conn, start_ts, end_ts):
+    """Manifest rows of the shards overlapping [start_ts, end_ts), oldest first"""
+    return [row for row in get_manifest(conn)
+            if (end_ts is None or row[2] < end_ts) and (start_ts is None or row[3] > start_ts)]
+
+def ranges(conn, start_ts=None, end_ts=None):
+    """Split [start_ts, end_ts) into sub-ranges of at most MAX_ATTACHED shards, oldest first
+
+    Yields (lo, hi) once that sub-range's shards are attached (either end
+    may be None, for open). The sub-ranges don't overlap and cover the
+    whole range, so queries restricted to lo <= ts < hi see every row,
+    wherever it is stored, exactly once across them. The caller must
+    finish each sub-range's statements before asking for the next.
+    """
+    needed = _overlapping(conn, start_ts, end_ts)
+    starts = [row[2] for row in needed[MAX_ATTACHED::MAX_ATTACHED]]
+    bounds = [start_ts] + starts + [end_ts]
+    for lo, hi in zip(bounds, bounds[1:]):
+        attach(conn, lo, hi)
+        yield lo, hi
+
+def ts_clause(lo, hi):
+    """SQL conditions and parameters for lo <= ts < hi, either end optional"""
+    clauses, params = [], []
+    if lo is not None:
+        clauses.append('ts >= ?')
+        params.append(lo)
+    if hi is not None:
+        clauses.append('ts < ?')
+        params.append(hi)
+    return clauses, params
+
+def _view_schemas(conn):
+    """Shard schemas the speedtests view currently covers"""
+    row = conn.execute("SELECT sql FROM sqlite_temp_master WHERE type = 'view' "
+                       "AND name = 'speedtests'").fetchone()
+    if row is None:
+        return []
+    return sorted(part.split()[-1].split('.')[0] for part in row[0].split(' UNION ALL ')[1:])
+
+def archivable_id(c, keep_unshipped=False):
+    """Highest speedtests.id that may move to a shard
+
+    Rows not yet rolled up, checked for incidents or (when shipping)
+    acknowledged stay behind, and so does the newest row, so ids are never
+    reused once the main database's rows are moved out.
+    """
+    max_id = c.execute('SELECT MAX(id) FROM main.speedtests').fetchone()[0] or 0
+    limit = min(rollups.get_rolled_id(c), anomaly.get_detected_id(c), max_id - 1)
+    if keep_unshipped:
+        limit = min(limit, shipper.get_shipped_id(c))
+    return limit
+
+def _create_schema(main_path, shard):
+    """Give a new shard file the main database's speedtests table and indexes"""
+    source = sqlite3.connect(main_path)
+    try:
+        statements = [row[0] for row in source.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = 'speedtests' AND sql IS NOT NULL "
+            "ORDER BY type = 'index'")]
+    finally:
+        source.close()
+    for statement in statements:
+        shard.execute(statement)
+
+def _build_shard(db_path, path, previous, start_ts, end_ts, limit):
+    """Write the month's rows (plus previous's, if any) to a new read-only file at path"""
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    if previous is not None:
+        shutil.copyfile(previous, tmp)
+        os.chmod(tmp, 0o644)
+    shard = sqlite3.connect(tmp, isolation_level=None)
+    try:
+        if previous is None:
+            _create_schema(db_path, shard)
+        shard.execute('ATTACH DATABASE ? AS hot',
+                      ('file:%s?mode=ro' % quote(os.path.abspath(db_path)),))
+        columns = ', '.join(row[1] for row in shard.execute('PRAGMA main.table_info(speedtests)'))
+        shard.execute('BEGIN')
+        shard.execute('''INSERT OR IGNORE INTO main.speedtests (%s)
+                         SELECT %s FROM hot.speedtests
+                         WHERE ts >= ? AND ts < ? AND id <= ? ORDER BY id'''
+                      % (columns, columns), (start_ts, end_ts, limit))
+        shard.execute('COMMIT')
+        shard.execute('DETACH DATABASE hot')
+        rows, max_id = shard.execute('SELECT COUNT(*), MAX(id) FROM speedtests').fetchone()
+    finally:
+        shard.close()
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+    return rows, max_id
+
+def archive_month(db_path, month, start_ts, end_ts, limit):
+    """Move one month's rows up to id limit into its shard; returns how many moved"""
+    writer = db.get_writer(db_path)
+    folder = shard_dir(db_path)
+    os.makedirs(folder, exist_ok=True)
+    previous = writer.transaction(lambda c: c.execute(
+        'SELECT file, generation FROM shards WHERE month = ?', (month,)).fetchone())
+    generation = previous[1] + 1 if previous else 0
+    name = '%s.db' % month if not generation else '%s.%d.db' % (month, generation)
+    rows, max_id = _build_shard(db_path, os.path.join(folder, name),
+                                os.path.join(folder, previous[0]) if previous else None,
+                                start_ts, end_ts, limit)
+
+    def swap(c):
+        # Readers see the rows either in the main database or in the
+        # listed shard, never both and never neither
+        moved = c.execute('DELETE FROM speedtests WHERE ts >= ? AND ts < ? AND id <= ?',
+                          (start_ts, end_ts, limit)).rowcount
+        c.execute('INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  (month, name, start_ts, end_ts, rows, max_id, generation))
+        return moved
+    moved = writer.transaction(swap)
+    if previous:
+        # Connections that have the old file attached keep reading it
+        os.remove(os.path.join(folder, previous[0]))
+    logger.info("Archived %d rows of %s to %s (%d rows)", moved, month, name, rows)
+    return moved
+
+def archive(db_path, now=None, delay_days=ARCHIVE_DELAY_DAYS, keep_unshipped=False):
+    """Seal every month that ended more than delay_days ago; returns the rows moved"""
+    now = time.time() if now is None else now
+    cutoff = month_range(now - delay_days * DAY)[1]
+    writer = db.get_writer(db_path)
+
+    def oldest_row(c):
+        limit = archivable_id(c, keep_unshipped)
+        return limit, c.execute('SELECT MIN(ts) FROM speedtests WHERE ts < ? AND id <= ?',
+                                (cutoff, limit)).fetchone()[0]
+    moved = 0
+    while True:
+        limit, oldest = writer.transaction(oldest_row)
+        if oldest is None:
+            return moved
+        month, start_ts, end_ts = month_range(oldest)
+        moved += archive_month(db_path, month, start_ts, end_ts, limit)
+
+def drop_expired(db_path, raw_floor):
+    """Delete the shards of months wholly older than raw_floor; returns how many"""
+    writer = db.get_writer(db_path)
+
+    def unlist(c):
+        files = [row[0] for row in c.execute('SELECT file FROM shards WHERE end_ts <= ?',
+                                              (raw_floor,))]
+        c.execute('DELETE FROM shards WHERE end_ts <= ?', (raw_floor,))
+        return files
+    files = writer.transaction(unlist)
+    for name in files:
+        path = os.path.join(shard_dir(db_path), name)
+        if os.path.exists(path):
+            os.remove(path)
+    if files:
+        logger.info("Dropped %d shards older than %s", len(files),
+                    time.strftime('%Y-%m', time.gmtime(raw_floor)))
+    return len(files)
+
+async def archive_loop(db_path, keep_unshipped=False, interval=ARCHIVE_INTERVAL):
+    """Seal finished months in the background every interval"""
+    while True:
+        try:
+            await asyncio.to_thread(archive, db_path, None, ARCHIVE_DELAY_DAYS, keep_unshipped)
+        except Exception as e:
+            logger.error("Archiving failed: %s", str(e))
+        await asyncio.sleep(interval)
+
+def _main():
+    parser = argparse.ArgumentParser(description='Move finished months into shard files')
+    parser.add_argument('db_path', help='path to speedtest.db')
+    parser.add_argument('--delay-days', type=int, default=ARCHIVE_DELAY_DAYS,
+                        help='days after a month ends before it is sealed (default: %(default)s)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger.info("Moved %d rows to shards", archive(args.db_path, delay_days=args.delay_days))
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,104 @@
+import json
+import asyncio
+import logging
+from urllib.parse import quote
+import db
+import probes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+SHIP_INTERVAL = 60      # seconds between checks for unshipped rows
+RETRY_BACKOFF = 5       # seconds, doubled after every failed attempt
+MAX_BACKOFF = 900
+REQUEST_TIMEOUT = 30
+
+def get_shipped_id(c):
+    """Return the highest speedtests.id acknowledged by the ingest server"""
+    row = c.execute("SELECT value FROM meta WHERE key = 'shipped_id'").fetchone()
+    return row[0] if row else 0
+
+def set_shipped_id(c, shipped_id):
+    c.execute("INSERT OR REPLACE INTO meta VALUES ('shipped_id', ?)", (shipped_id,))
+
+def remote_probe_id(probe_id, target):
+    """Probe id a local target's rows are shipped under"""
+    if target == probes.LOCAL_PROBE:
+        return probe_id
+    return '%s:%s' % (probe_id, target)
+
+def pending_batch(conn, after_id, limit=DEFAULT_BATCH_SIZE):
+    """Return up to limit unshipped rows as (id, probe_id, record dict)
+
+    Records carry the seq the collector gave each result (microseconds
+    since the epoch), which keeps growing even if the local database is
+    recreated, so the server only drops what it has really stored. The
+    rowid stands in for rows saved before results had one. It restarts
+    at 1 in a new database, so it can't be the seq itself.
+    """
+    rows = conn.execute('''
+        SELECT id, probe_id, COALESCE(seq, id), ts, download, upload, ping, error
+        FROM speedtests
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (after_id, limit)).fetchall()
+    return [(row_id, probe_id, {'seq': seq, 'ts': ts, 'download': download,
+                                'upload': upload, 'ping': ping, 'error': error})
+            for row_id, probe_id, seq, ts, download, upload, ping, error in rows]
+
+def post_batch(url, probe_id, records, token=None, timeout=REQUEST_TIMEOUT):
+    """POST one gzip NDJSON batch to the ingest endpoint and return its reply"""
+    import urllib.request  # pulls in ssl and email; only collectors that ship need it
+    request = urllib.request.Request(
+        '%s/api/ingest/%s' % (url.rstrip('/'), quote(probe_id, safe='')),
+        data=probes.encode_batch(records),
+        headers={'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'},
+        method='POST')
+    if token:
+        request.add_header('Authorization', 'Bearer %s' % token)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def ship_pending(db_path, url, probe_id, token=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Ship every unshipped row in batches; returns the number of rows sent
+
+    The high-water mark only advances after the server has acknowledged
+    a batch, so a failure part-way just resends from there next time.
+    """
+    writer = db.get_writer(db_path)
+    shipped = 0
+    while True:
+        reader = db.get_reader(db_path)
+        batch = pending_batch(reader, get_shipped_id(reader), batch_size)
+        if not batch:
+            return shipped
+        by_target = {}
+        for row_id, target, record in batch:
+            by_target.setdefault(target, []).append(record)
+        for target, records in by_target.items():
+            reply = post_batch(url, remote_probe_id(probe_id, target), records, token)
+            logger.debug("Shipped %d rows for %s: %s", len(records), target, reply)
+        last_id = batch[-1][0]
+        writer.transaction(lambda c: set_shipped_id(c, last_id))
+        shipped += len(batch)
+
+async def ship_loop(db_path, url, probe_id, token=None, interval=SHIP_INTERVAL,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """Keep shipping new rows to the ingest server, backing off while it is unreachable"""
+    delay = RETRY_BACKOFF
+    while True:
+        try:
+            shipped = await asyncio.to_thread(ship_pending, db_path, url, probe_id,
+                                              token, batch_size)
+            if shipped:
+                logger.info("Shipped %d results to %s", shipped, url)
+            delay = RETRY_BACKOFF
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            raise
+        except (OSError, ValueError) as e:  # URLError is an OSError
+            # Rows stay in the local database until the server takes them
+            logger.warning("Shipping to %s failed (%s), retrying in %ds", url, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
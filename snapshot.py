@@ -0,0 +1,207 @@
+import os
+import json
+import mmap
+import zlib
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+
+# File layout: MAGIC, then one record per computed payload, appended as it
+# is published: RECORD (crc32 of key + value, key length, value length),
+# the key (repr of the cache key) and the JSON value. A key published
+# again supersedes its earlier records.
+MAGIC = b'BPSNAP2\n'
+RECORD = struct.Struct('<III')
+MAX_ENTRIES = 64
+COMPACT_FACTOR = 2   # records per entry kept before the file is rewritten
+LOCK_SLOTS = 1024    # byte-range locks keys are hashed onto
+
+_MISSING = object()
+
+class SharedSnapshot:
+    """Computed payloads shared by every worker process through one mapped file
+
+    Like LRUCache, keys carry the data version they were computed from.
+    A miss is computed under a lock on the key's slot of path + '.lock',
+    after checking the file again, so each payload is computed and
+    written once, by whichever worker asks first, while misses on other
+    keys go ahead in parallel. Publishing appends one record; readers map
+    the file and index only what was appended since they last looked.
+    Lookups see the newest max_entries keys. Once the file holds
+    COMPACT_FACTOR times that many records it is rewritten with just
+    those and replaced atomically, so readers of the old mapping are
+    never disturbed. Values must be JSON. Entries outlive the processes
+    that wrote them: remove the file when the database is replaced.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._slot_locks = [threading.Lock() for _ in range(LOCK_SLOTS)]
+        self._file_lock = threading.Lock()
+        self._lock_fd = None
+        self._reset(None)
+
+    def _reset(self, file_id):
+        self._file_id = file_id
+        self._map = None
+        self._index = {}
+        self._scanned = len(MAGIC)
+        self._records = 0
+        self._corrupt = False
+
+    def _load(self):
+        """Return (mapping, index) of the current file, indexing what was appended"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        with self._lock:
+            file_id = (st.st_dev, st.st_ino) if st else None
+            if file_id != self._file_id or (st and st.st_size < self._scanned):
+                # Replaced, removed or truncated by hand: index it afresh
+                self._reset(file_id)
+            if st and st.st_size > (len(self._map) if self._map else 0) and not self._corrupt:
+                self._open()
+            return self._map, self._index
+
+    def _open(self):
+        # Unmapped by the garbage collector once no reader holds it
+        with open(self.path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapping[:len(MAGIC)] != MAGIC:
+            # Foreign file: start over on the next write
+            self._corrupt = True
+            return
+        pos = self._scanned
+        while pos + RECORD.size <= len(mapping):
+            crc, key_size, size = RECORD.unpack_from(mapping, pos)
+            end = pos + RECORD.size + key_size + size
+            if end > len(mapping):
+                break  # still being appended
+            if zlib.crc32(mapping[pos + RECORD.size:end]) != crc:
+                # Torn by a crash and appended to since: rewritten on the next write
+                self._corrupt = True
+                break
+            name = mapping[pos + RECORD.size:pos + RECORD.size + key_size].decode()
+            self._index.pop(name, None)
+            self._index[name] = (end - size, size)
+            while len(self._index) > self.max_entries:
+                del self._index[next(iter(self._index))]
+            self._records += 1
+            pos = end
+        self._scanned = pos
+        self._map = mapping
+
+    def _lookup(self, name):
+        mapping, index = self._load()
+        entry = index.get(name)
+        if entry is None:
+            return _MISSING
+        offset, size = entry
+        try:
+            return json.loads(mapping[offset:offset + size])
+        except ValueError:
+            return _MISSING
+
+    @contextmanager
+    def _locked(self, cmd, start):
+        """Hold a byte-range lock on path + '.lock': byte 0 guards rewrites, 1.. key slots"""
+        # fcntl locks belong to the process and are all released when any
+        # descriptor of the file is closed, so one stays open per process
+        with self._lock:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            fd = self._lock_fd
+        fcntl.lockf(fd, cmd, 1, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, start)
+
+    @contextmanager
+    def _key_lock(self, name):
+        """Exclude other threads and processes computing a key in the same slot"""
+        slot = zlib.crc32(name.encode()) % LOCK_SLOTS
+        with self._slot_locks[slot], self._locked(fcntl.LOCK_EX, 1 + slot):
+            yield
+
+    def _needs_rewrite(self):
+        mapping, _ = self._load()
+        with self._lock:
+            # An incomplete last record is an append in progress, unless it
+            # is still there once appenders are locked out: then it is torn
+            return (mapping is None or self._corrupt or self._scanned < len(mapping)
+                    or self._records >= COMPACT_FACTOR * self.max_entries)
+
+    def _write(self, name, value):
+        """Publish name -> value, appending to the file or rewriting it when due"""
+        blob = json.dumps(value, separators=(',', ':')).encode()
+        key = name.encode()
+        record = RECORD.pack(zlib.crc32(key + blob), len(key), len(blob)) + key + blob
+        with self._file_lock:
+            if self._needs_rewrite():
+                with self._locked(fcntl.LOCK_EX, 0):
+                    if self._needs_rewrite():
+                        self._rewrite(record)
+                        return
+            # Appenders share byte 0, so a rewrite never drops an append
+            with self._locked(fcntl.LOCK_SH, 0):
+                try:
+                    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+                except FileNotFoundError:
+                    return  # cleared meanwhile
+                try:
+                    os.write(fd, record)
+                finally:
+                    os.close(fd)
+
+    def _rewrite(self, record):
+        """Replace the file with its newest entries plus record"""
+        mapping, index = self._load()
+        entries = list(index.items())[-(self.max_entries - 1):] if self.max_entries > 1 else []
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for name, (offset, size) in entries:
+                key, blob = name.encode(), mapping[offset:offset + size]
+                f.write(RECORD.pack(zlib.crc32(key + blob), len(key), len(blob)) + key + blob)
+            f.write(record)
+        os.replace(tmp, self.path)
+
+    def get_or_compute(self, key, compute):
+        """Return the shared value for key, computing and publishing it on a miss"""
+        name = repr(key)
+        value = self._lookup(name)
+        if value is _MISSING:
+            with self._key_lock(name):
+                # Another worker may have written it while we waited
+                value = self._lookup(name)
+                if value is _MISSING:
+                    value = compute()
+                    self._write(name, value)
+                    with self._lock:
+                        self.misses += 1
+                    return value
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def clear(self):
+        with self._file_lock, self._locked(fcntl.LOCK_EX, 0):
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return this process's hit/miss counters and the file's entry count"""
+        _, index = self._load()
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(index), 'maxsize': self.max_entries}
@@ -1,11 +1,27 @@
 import json
 import sqlite3
-import subprocess
+import asyncio
+import shlex
+import shutil
+import socket
 import time
+from collections import namedtuple
 from datetime import datetime
 import sys
 import logging
 import os
+import threading
+import argparse
+import db
+import rollups
+import probes
+import shipper
+import anomaly
+import retention
+import shards
+import scheduler
+import metrics
+from spool import Spool
 
 # Configure logging with both file and console output
 def setup_logging():
@@ -22,102 +38,491 @@ def setup_logging():
 # Get the directory where the script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(SCRIPT_DIR, 'speedtest.db')
+# Results are spooled here before they are written to the database
+SPOOL_PATH = os.path.join(SCRIPT_DIR, 'speedtest.spool')
+FLUSH_RETRY_INTERVAL = 30  # seconds between attempts while the database is unavailable
+
+# One speedtest run per sample: --accept-license avoids the interactive
+# prompt on the same invocation that produces the JSON result
+SPEEDTEST_COMMAND = ['speedtest', '--accept-license', '--json']
+SPEEDTEST_TIMEOUT = 180  # seconds before a run is killed
+INTERVAL_MINUTES = 15      # base minutes between tests of each target
+MIN_INTERVAL_MINUTES = 1   # while results look degraded
+MAX_INTERVAL_MINUTES = 60  # once results have been stable for a while
+
+# A probe target is a named set of extra arguments for its engine: the
+# speedtest binary (e.g. a specific --server or --source interface) or the
+# built-in HTTP engine (a throughput server URL plus options). Its name is
+# the probe id its rows are stored under.
+ProbeTarget = namedtuple('ProbeTarget', ['name', 'args', 'engine'], defaults=['speedtest'])
+DEFAULT_TARGET = ProbeTarget(probes.LOCAL_PROBE, [])
+
+# Prometheus metrics, served with --metrics-port
+SPEEDTEST_DURATION = metrics.Histogram('bandwidth_probe_speedtest_duration_seconds',
+                                       'Wall time of one measurement run',
+                                       ['target', 'engine'],
+                                       buckets=(1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180))
+PARSE_DURATION = metrics.Histogram('bandwidth_probe_speedtest_parse_seconds',
+                                   'Time spent decoding speedtest output')
+SAVE_DURATION = metrics.Histogram('bandwidth_probe_save_duration_seconds',
+                                  'Time to store results, in the spool or the database',
+                                  ['stage'])
+RESULTS = metrics.Counter('bandwidth_probe_results_total',
+                          'Measurement runs by outcome', ['target', 'outcome'])
+INTERVAL = metrics.Gauge('bandwidth_probe_test_interval_seconds',
+                         'Current interval between tests of a target', ['target'])
+SKIPPED = metrics.Counter('bandwidth_probe_skipped_runs_total',
+                          'Scheduled runs skipped because the previous one overran', ['target'])
 
 def verify_speedtest_cli():
     """Verify speedtest is installed and accessible"""
-    try:
-        # Run with --accept-license to avoid interactive prompt
-        result = subprocess.run(['speedtest', '--accept-license', '--json'], 
-                              capture_output=True, 
-                              text=True)
-        if result.returncode == 0:
-            logging.info("Speedtest verified successfully")
-            return True
-        else:
-            logging.error("Speedtest check failed: %s", result.stderr)
-            return False
-    except FileNotFoundError:
+    # Only look the binary up: running it here would cost a full test
+    if shutil.which(SPEEDTEST_COMMAND[0]) is None:
         logging.error("Speedtest not found. Please install it first.")
         return False
+    logging.info("Speedtest verified successfully")
+    return True
+
+def _migrate_v1(c):
+    """Add an integer epoch column, rowid primary key and covering indexes"""
+    # Legacy databases only have the five original columns; make sure the
+    # table exists so fresh and upgraded databases go through the same path.
+    c.execute('''CREATE TABLE IF NOT EXISTS speedtests
+                 (timestamp TEXT, download REAL, upload REAL, ping REAL, error TEXT)''')
+    c.execute('ALTER TABLE speedtests RENAME TO speedtests_v0')
+    c.execute('''CREATE TABLE speedtests
+                 (timestamp TEXT, download REAL, upload REAL, ping REAL, error TEXT,
+                  id INTEGER PRIMARY KEY, ts INTEGER NOT NULL)''')
+    # Timestamps were written with datetime.now().isoformat(), i.e. local time;
+    # the 'utc' modifier converts them to a real Unix epoch.
+    c.execute('''INSERT INTO speedtests (timestamp, download, upload, ping, error, ts)
+                 SELECT timestamp, download, upload, ping, error,
+                        CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                 FROM speedtests_v0
+                 ORDER BY timestamp''')
+    c.execute('DROP TABLE speedtests_v0')
+    c.execute('''CREATE INDEX idx_speedtests_error_ts
+                 ON speedtests (error, ts, download, upload)''')
+    c.execute('CREATE INDEX idx_speedtests_ts ON speedtests (ts)')
+
+def _migrate_v2(c):
+    """Add hourly/daily rollup tables and backfill them from raw rows"""
+    rollups.create_rollup_tables(c)
+    rollups.roll_up_pending(c)
+
+def _migrate_v3(c):
+    """Add per-bucket quantile sketches to the rollup tables"""
+    rollups.add_sketch_columns(c)
+    rollups.backfill_sketches(c)
+
+def _migrate_v4(c):
+    """Tag rows with a probe id and sequence number for fleet ingestion"""
+    probes.add_probe_columns(c)
+
+def _migrate_v5(c):
+    """Add the per-minute latency aggregate table"""
+    import latency
+    latency.create_latency_table(c)
+
+def _migrate_v6(c):
+    """Add the incidents table and the online detector's state"""
+    anomaly.create_incident_tables(c)
+
+def _migrate_v7(c):
+    """Add the manifest of sealed monthly shards"""
+    shards.create_shard_table(c)
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# of them have been applied to a given database file.
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
 def setup_database(db_path=DB_PATH):
     """Initialize the database with the required schema"""
     logging.info("Setting up database at %s", db_path)
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS speedtests
-                 (timestamp TEXT, download REAL, upload REAL, ping REAL, error TEXT)''')
-    conn.commit()
-    conn.close()
+    try:
+        retention.enable_incremental_vacuum(conn)
+        db.enable_wal(conn)
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info("Migrating database schema to version %d", number)
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                migration(c)
+                c.execute('PRAGMA user_version = %d' % number)
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
 
-def run_speedtest():
+def parse_speedtest_output(data):
+    """Convert speedtest JSON output into a result dict"""
+    return {
+        'download': data['download'] / 1_000_000,  # Convert to Mbps (bits/s to Mbps)
+        'upload': data['upload'] / 1_000_000,      # Convert to Mbps (bits/s to Mbps)
+        'ping': data['ping'],
+        'error': None
+    }
+
+async def _read_json(stream):
+    """Parse the first JSON document from a stream as chunks arrive"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    parse_seconds = 0.0
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return None, buffer
+        buffer += chunk.decode(errors='replace')
+        text = buffer.lstrip()
+        start = time.perf_counter()
+        try:
+            data, _ = decoder.raw_decode(text)
+        except ValueError:
+            parse_seconds += time.perf_counter() - start
+            continue  # incomplete document, keep reading
+        PARSE_DURATION.observe(parse_seconds + time.perf_counter() - start)
+        return data, buffer
+
+async def _communicate(proc):
+    (data, raw), stderr = await asyncio.gather(_read_json(proc.stdout), proc.stderr.read())
+    # Drain anything after the document so the process can exit
+    await proc.stdout.read()
+    returncode = await proc.wait()
+    return data, raw, stderr.decode(errors='replace'), returncode
+
+async def _kill(proc):
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+async def run_speedtest_async(args=(), timeout=SPEEDTEST_TIMEOUT):
+    """Run one speedtest with a hard timeout; returns a result dict"""
     try:
-        # First run to accept license if needed
-        subprocess.run(['speedtest', '--accept-license'], 
-                      capture_output=True, 
-                      text=True)
-        
-        # Actual test run
-        result = subprocess.run(['speedtest', '--json'], 
-                              capture_output=True, 
-                              text=True)
-        
-        if result.returncode == 0:
-            # Log raw output for debugging
-            logging.debug("Raw speedtest output: %s", result.stdout)
-            data = json.loads(result.stdout)
-            return {
-                'download': data['download'] / 1_000_000,  # Convert to Mbps (bits/s to Mbps)
-                'upload': data['upload'] / 1_000_000,      # Convert to Mbps (bits/s to Mbps)
-                'ping': data['ping'],
-                'error': None
-            }
-        else:
-            logging.error("Speedtest stderr: %s", result.stderr)
-            return {'error': result.stderr}
-    except Exception as e:
+        proc = await asyncio.create_subprocess_exec(
+            *SPEEDTEST_COMMAND, *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
         logging.error("Error running speedtest: %s", str(e))
-        if 'result' in locals():
-            logging.error("Stdout: %s", result.stdout)
-            logging.error("Stderr: %s", result.stderr)
         return {'error': str(e)}
+    
+    try:
+        data, raw, stderr, returncode = await asyncio.wait_for(_communicate(proc), timeout)
+    except asyncio.TimeoutError:
+        await _kill(proc)
+        logging.error("Speedtest timed out after %s seconds", timeout)
+        return {'error': 'Speedtest timed out after %s seconds' % timeout}
+    except asyncio.CancelledError:
+        await _kill(proc)
+        raise
+    
+    # Log raw output for debugging
+    logging.debug("Raw speedtest output: %s", raw)
+    if returncode != 0:
+        logging.error("Speedtest stderr: %s", stderr)
+        return {'error': stderr or 'speedtest exited with status %d' % returncode}
+    try:
+        return parse_speedtest_output(data)
+    except (TypeError, KeyError) as e:
+        logging.error("Error parsing speedtest output: %s", str(e))
+        logging.error("Stdout: %s", raw)
+        return {'error': 'Unexpected speedtest output: %s' % raw[:200]}
 
-def save_result(data, db_path=DB_PATH):
-    """Save speedtest result to database"""
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    timestamp = datetime.now().isoformat()
+def run_speedtest(args=(), timeout=SPEEDTEST_TIMEOUT):
+    """Run one speedtest synchronously"""
+    return asyncio.run(run_speedtest_async(args, timeout))
+
+_seq_lock = threading.Lock()
+_last_seq = 0
+
+def next_seq():
+    """Return a sequence number unique to this result
     
+    Microseconds since the epoch, bumped if two results arrive within the
+    same microsecond, so numbers keep increasing across restarts without
+    having to be persisted anywhere.
+    """
+    global _last_seq
+    with _seq_lock:
+        _last_seq = max(_last_seq + 1, time.time_ns() // 1000)
+        return _last_seq
+
+def make_record(data, probe_id=probes.LOCAL_PROBE, now=None):
+    """Build the record stored for one speedtest result"""
+    now = datetime.now() if now is None else now
+    record = {
+        'seq': next_seq(),
+        'ts': int(now.timestamp()),
+        'timestamp': now.isoformat(),
+        'probe_id': probe_id,
+        'download': None,
+        'upload': None,
+        'ping': None,
+        'error': None
+    }
     if 'error' in data and data['error']:
-        c.execute('INSERT INTO speedtests VALUES (?, ?, ?, ?, ?)',
-                 (timestamp, None, None, None, data['error']))
+        record['error'] = data['error']
+    else:
+        record.update(download=data['download'], upload=data['upload'], ping=data['ping'])
+    return record
+
+def save_records(records, db_path=DB_PATH):
+    """Write records from make_record to the database in one transaction
+    
+    Records already stored under the same (probe_id, seq) are skipped, so
+    replaying the spool after a crash never duplicates a row.
+    """
+    rows = [(r['timestamp'], r['download'], r['upload'], r['ping'], r['error'],
+             r['ts'], r['probe_id'], r['seq'])
+            for r in records]
+    latest = {}
+    for r in records:
+        latest[r['probe_id']] = max(latest.get(r['probe_id'], 0), r['ts'])
+    
+    def write(c):
+        c.executemany('''INSERT OR IGNORE INTO speedtests
+                         (timestamp, download, upload, ping, error, ts, probe_id, seq)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        for probe_id, ts in latest.items():
+            probes.touch_probe(c, probe_id, ts)
+        # Update the rollups and incidents in the same transaction as the samples
+        rollups.roll_up_pending(c)
+        anomaly.detect_pending(c)
+    
+    # The collector keeps one long-lived writer connection that retries
+    # with backoff if the database is momentarily locked
+    with SAVE_DURATION.labels('database').time():
+        db.get_writer(db_path).transaction(write)
+
+def save_result(data, db_path=DB_PATH, probe_id=probes.LOCAL_PROBE):
+    """Save speedtest result to database"""
+    save_records([make_record(data, probe_id)], db_path)
+
+async def flush_loop(spool, db_path, wakeup, retry_interval=FLUSH_RETRY_INTERVAL):
+    """Drain the spool into the database whenever woken, retrying while that fails"""
+    while True:
+        wakeup.clear()
+        timeout = None
+        try:
+            drained = await asyncio.to_thread(
+                spool.drain, lambda records: save_records(records, db_path))
+            if drained:
+                logging.debug("Flushed %d spooled results", drained)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Results stay spooled on disk until the database takes them
+            logging.error("Could not write spooled results (%s), retrying in %ds",
+                          str(e), retry_interval)
+            timeout = retry_interval
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def log_result(target, result):
+    if result.get('error'):
+        logging.error("[%s] Speedtest error: %s", target.name, result['error'])
     else:
-        c.execute('INSERT INTO speedtests VALUES (?, ?, ?, ?, ?)',
-                 (timestamp, data['download'], data['upload'], data['ping'], None))
+        logging.info("[%s] Speedtest completed - Down: %.2f Mbps, Up: %.2f Mbps, Ping: %.1f ms",
+                   target.name, result['download'], result['upload'], result['ping'])
+
+async def probe_loop(target, store, schedule, offset_seconds=0, timeout=SPEEDTEST_TIMEOUT,
+                     link=None):
+    """Run a target's measurements on its schedule, the first offset_seconds from now
     
-    conn.commit()
-    conn.close()
+    Each result is passed to the coroutine function store(result, probe_id)
+    and adapts the schedule. Measurements hold the link lock, if given,
+    so targets sharing it never test at the same time.
+    """
+    link = link or asyncio.Lock()
+    await asyncio.sleep(schedule.start(offset_seconds))
+    while True:
+        try:
+            async with link:
+                result = await measure(target, timeout)
+            await store(result, target.name)
+            log_result(target, result)
+            previous = schedule.interval
+            if schedule.observe(result) != previous:
+                logging.info("[%s] %s; testing every %g minutes", target.name,
+                             'Link degraded' if schedule.interval < previous else 'Link stable',
+                             schedule.interval / 60)
+            INTERVAL.labels(target.name).set(schedule.interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("[%s] Unexpected error: %s", target.name, e)
+        skipped = schedule.skipped
+        delay = schedule.next_delay()
+        if schedule.skipped > skipped:
+            logging.warning("[%s] Run overran its interval; skipped %d slot(s)",
+                            target.name, schedule.skipped - skipped)
+            SKIPPED.labels(target.name).inc(schedule.skipped - skipped)
+        await asyncio.sleep(delay)
 
-def wait_until_next_interval(interval_minutes=15):
-    current_time = datetime.now()
-    minutes = current_time.minute
-    next_interval = ((minutes // interval_minutes) + 1) * interval_minutes
-    if next_interval == 60:
-        next_interval = 0
+async def run_collector(targets, db_path=DB_PATH, interval_minutes=INTERVAL_MINUTES,
+                        timeout=SPEEDTEST_TIMEOUT, background=(), spool=None,
+                        min_interval_minutes=None, max_interval_minutes=None,
+                        jitter=scheduler.JITTER):
+    """Probe every target from one event loop on a staggered schedule
     
-    target_time = current_time.replace(minute=next_interval, second=0, microsecond=0)
-    if target_time <= current_time:
-        target_time = target_time.replace(hour=target_time.hour + 1)
+    Each target is tested every interval_minutes on a monotonic clock,
+    adapting between min_interval_minutes while the link is degraded
+    and max_interval_minutes while it is stable (both default to the
+    interval, i.e. a fixed rate). Targets start spread evenly across the
+    interval and never test at the same time, so they don't compete for
+    the link. Coroutines in background (e.g. the shipper) run alongside
+    the probes.
     
-    sleep_seconds = (target_time - current_time).total_seconds()
-    time.sleep(sleep_seconds)
+    With a spool, results are appended to it and a flusher task drains it
+    into the database, so a slow or unavailable database never delays or
+    loses a sample. Without one they are saved directly.
+    """
+    stagger = interval_minutes * 60 / len(targets)
+    tasks = [asyncio.create_task(coro) for coro in background]
+    link = asyncio.Lock()
+    
+    if spool is not None:
+        wakeup = asyncio.Event()
+        tasks.append(asyncio.create_task(flush_loop(spool, db_path, wakeup), name='flusher'))
+        
+        async def store(result, probe_id):
+            with SAVE_DURATION.labels('spool').time():
+                await asyncio.to_thread(spool.append, make_record(result, probe_id))
+            wakeup.set()
+    else:
+        async def store(result, probe_id):
+            # The writer is thread-safe; keep the event loop free meanwhile
+            await asyncio.to_thread(save_result, result, db_path, probe_id)
+    
+    for i, target in enumerate(targets):
+        schedule = scheduler.Schedule(interval_minutes * 60,
+                                      min_interval_minutes and min_interval_minutes * 60,
+                                      max_interval_minutes and max_interval_minutes * 60,
+                                      jitter)
+        tasks.append(asyncio.create_task(
+            probe_loop(target, store, schedule, i * stagger, timeout, link),
+            name='probe-%s' % target.name))
+    await asyncio.gather(*tasks)
+
+def parse_target(spec):
+    """Parse a --target NAME[=ARGS] option
+    
+    ARGS starting with an http:// URL select the built-in engine, e.g.
+    lan='http://10.0.0.5:8081 --streams 8'; anything else is passed to
+    speedtest, e.g. office='--server 1234'.
+    """
+    name, _, args = spec.partition('=')
+    args = shlex.split(args)
+    if args and args[0].startswith('http://'):
+        # The engine (and http.server with it) is loaded only when a target uses it
+        import throughput
+        throughput.parse_probe_args(args)  # fail at startup, not on the first run
+        return ProbeTarget(name, args, 'http')
+    return ProbeTarget(name, args)
+
+async def measure(target, timeout=SPEEDTEST_TIMEOUT):
+    """Run one measurement of a target with its engine"""
+    with SPEEDTEST_DURATION.labels(target.name, target.engine).time():
+        if target.engine == 'http':
+            import throughput
+            # Bounded by the engine's own durations and socket timeouts
+            result = await asyncio.to_thread(throughput.run_from_args, target.args)
+        else:
+            result = await run_speedtest_async(target.args, timeout)
+    record_metrics(target, result)
+    return result
+
+def record_metrics(target, result):
+    """Count a run's outcome and publish its values as the latest"""
+    if result.get('error'):
+        RESULTS.labels(target.name, 'error').inc()
+        return
+    RESULTS.labels(target.name, 'success').inc()
+    for key in ('download', 'upload', 'ping'):
+        metrics.LATEST[key].labels(target.name).set(result[key])
+    metrics.LATEST['ts'].labels(target.name).set(time.time())
 
-def main():
+def _latency_target(spec):
+    import latency
+    try:
+        return latency.parse_target(spec)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid latency target %r' % spec)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bandwidth probe collector')
+    parser.add_argument('--interval', type=float, default=INTERVAL_MINUTES,
+                        help='minutes between tests of each target (default: %(default)s)')
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL_MINUTES,
+                        help='minutes between tests while results look degraded '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL_MINUTES,
+                        help='minutes between tests once results are stable (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=scheduler.JITTER,
+                        help='delay each test by a random fraction of the interval up to this '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=SPEEDTEST_TIMEOUT,
+                        help='seconds before a speedtest run is killed (default: %(default)s)')
+    parser.add_argument('--target', dest='targets', action='append', type=parse_target,
+                        metavar='NAME[=ARGS]',
+                        help='probe target with extra speedtest arguments; repeat for more')
+    parser.add_argument('--ship', metavar='URL',
+                        help='also send results in batches to the dashboard at URL')
+    parser.add_argument('--probe-id', default=socket.gethostname(),
+                        help='probe id results are shipped under (default: hostname)')
+    parser.add_argument('--ship-token', default=os.environ.get('INGEST_TOKEN'),
+                        help='bearer token for the ingest endpoint (default: $INGEST_TOKEN)')
+    parser.add_argument('--latency-target', dest='latency_targets', action='append',
+                        type=_latency_target, default=[], metavar='HOST[:PORT]',
+                        help='time a TCP connect to HOST every second and store '
+                             'per-minute latency; repeat for more')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics on PORT at /metrics')
+    parser.add_argument('--keep-raw-days', type=int, default=retention.RAW_DAYS,
+                        help='days individual results are kept (default: %(default)s)')
+    parser.add_argument('--keep-hourly-months', type=int, default=retention.HOURLY_MONTHS,
+                        help='months hourly rollups are kept after that; daily rollups '
+                             'are kept forever (default: %(default)s)')
+    parser.add_argument('--no-compact', action='store_true',
+                        help='never delete old results or rollups')
+    parser.add_argument('--no-shards', action='store_true',
+                        help='keep finished months in the main database instead of '
+                             'moving them to monthly shard files')
+    args = parser.parse_args(argv)
+    if not 0 < args.min_interval <= args.interval <= args.max_interval:
+        parser.error('intervals must satisfy 0 < --min-interval <= --interval <= --max-interval')
+    if not 0 <= args.jitter < 1:
+        parser.error('--jitter must be at least 0 and below 1')
+    if args.keep_raw_days < 1 or args.keep_hourly_months < 0:
+        parser.error('retention periods must be at least 1 day and 0 months')
+    if args.ship and not probes.valid_probe_id(args.probe_id):
+        parser.error('invalid --probe-id %r' % args.probe_id)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
     setup_logging()
     logging.info("Starting bandwidth probe collector...")
     
+    targets = args.targets or [DEFAULT_TARGET]
+    
     # Verify dependencies
-    if not verify_speedtest_cli():
+    if any(target.engine == 'speedtest' for target in targets) and not verify_speedtest_cli():
         logging.error("speedtest-cli verification failed")
         sys.exit(1)
     
@@ -129,25 +534,38 @@ def main():
         logging.error("Failed to initialize database: %s", str(e))
         sys.exit(1)
     
-    logging.info("Starting speedtest collection (every 15 minutes)...")
-    while True:
-        try:
-            result = run_speedtest()
-            save_result(result)
-            
-            if result.get('error'):
-                logging.error("Speedtest error: %s", result['error'])
-            else:
-                logging.info("Speedtest completed - Down: %.2f Mbps, Up: %.2f Mbps, Ping: %.1f ms",
-                           result['download'], result['upload'], result['ping'])
-            
-            wait_until_next_interval()
-        except KeyboardInterrupt:
-            logging.info("Exiting...")
-            sys.exit(0)
-        except Exception as e:
-            logging.error("Unexpected error: %s", e)
-            time.sleep(300)  # Wait 5 minutes on error
+    logging.info("Starting speedtest collection (every %g minutes, %g-%g adaptive, "
+                 "%d target(s))...", args.interval, args.min_interval, args.max_interval,
+                 len(targets))
+    background = []
+    if args.ship:
+        # The local database is the outbox: rows are shipped from it and
+        # kept until the server has acknowledged them
+        logging.info("Shipping results to %s as probe %s", args.ship, args.probe_id)
+        background.append(shipper.ship_loop(DB_PATH, args.ship, args.probe_id, args.ship_token))
+    if args.latency_targets:
+        import latency
+        sampler = latency.LatencySampler(args.latency_targets, DB_PATH)
+        background.append(sampler.run())
+    if not args.no_compact:
+        # Unshipped rows are kept until the dashboard has them
+        background.append(retention.compact_loop(DB_PATH, args.keep_raw_days,
+                                                 args.keep_hourly_months,
+                                                 keep_unshipped=bool(args.ship)))
+    if not args.no_shards:
+        background.append(shards.archive_loop(DB_PATH, keep_unshipped=bool(args.ship)))
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+        logging.info("Serving metrics on port %d", args.metrics_port)
+    spool = Spool(SPOOL_PATH)
+    try:
+        asyncio.run(run_collector(targets, DB_PATH, args.interval, args.timeout, background, spool,
+                                  args.min_interval, args.max_interval, args.jitter))
+    except KeyboardInterrupt:
+        logging.info("Exiting...")
+        sys.exit(0)
+    finally:
+        spool.close()
 
 if __name__ == '__main__':
     main()
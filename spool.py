@@ -0,0 +1,139 @@
+import os
+import json
+import zlib
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Every record is a little-endian (payload length, CRC-32 of payload)
+# header followed by the payload, a UTF-8 JSON object
+HEADER = struct.Struct('<II')
+
+DEFAULT_BATCH_SIZE = 500
+
+def _fsync_dir(path):
+    """Make a rename or new file in path's directory durable"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def parse_records(data):
+    """Decode the complete records at the start of data
+
+    Returns (records, end): end is the offset just past the last intact
+    record. Parsing stops at a truncated or corrupt record, which is what
+    a crash in the middle of an append leaves behind.
+    """
+    records, offset = [], 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        records.append(json.loads(payload))
+        offset = start + length
+    return records, offset
+
+class Spool:
+    """Append-only, fsync'd file of records waiting to be written to the database
+
+    append() returns only once the record is on disk, so a sample is
+    never lost once it has been spooled, whatever state the database is
+    in. drain() hands the spooled records to a writer in batches and only
+    then removes them from the file; after a crash in between they are
+    handed over again, so the writer must ignore records it already has.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._recover()
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+
+    def _recover(self):
+        """Cut off a torn record left by a crash mid-append"""
+        with self._lock:
+            data = b''
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            records, end = parse_records(data)
+            if end < len(data):
+                logger.warning("Discarding %d bytes of incomplete spool record in %s",
+                               len(data) - end, self.path)
+                with open(self.path, 'r+b') as f:
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+            if records:
+                logger.info("Spool %s holds %d records to replay", self.path, len(records))
+            self._open()
+
+    def append(self, record):
+        """Durably add one record (a JSON-serializable dict)"""
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        with self._lock:
+            self._file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def pending(self):
+        """Return (records, end) for everything currently spooled"""
+        with self._lock:
+            with open(self.path, 'rb') as f:
+                return parse_records(f.read())
+
+    def __len__(self):
+        return len(self.pending()[0])
+
+    def commit(self, end):
+        """Remove the first end bytes, which have been written to the database
+
+        Records appended since pending() was called are kept.
+        """
+        with self._lock:
+            size = os.path.getsize(self.path)
+            with open(self.path, 'rb') as f:
+                f.seek(end)
+                tail = f.read()
+            if not tail:
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+                return
+            # Rewrite the tail to a new file and swap it in atomically
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            _fsync_dir(self.path)
+            self._open()
+            logger.debug("Spool compacted from %d to %d bytes", size, len(tail))
+
+    def drain(self, write_batch, batch_size=DEFAULT_BATCH_SIZE):
+        """Pass spooled records to write_batch(records) in batches, then drop them
+
+        Returns the number of records drained. If write_batch raises, the
+        records stay spooled, including those of batches already written.
+        """
+        records, end = self.pending()
+        for start in range(0, len(records), batch_size):
+            write_batch(records[start:start + batch_size])
+        if end:
+            self.commit(end)
+        return len(records)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -3,11 +3,42 @@ import sqlite3
 import json
 from datetime import datetime, timedelta
 import os
-import pandas as pd
 import logging
 import sys
-from speedtest_collector import setup_database, run_speedtest, save_result
-from app import app, get_db_connection
+import threading
+import socket
+import time
+import asyncio
+import tempfile
+import random
+import shutil
+from speedtest_collector import setup_database, run_speedtest, save_result, SCHEMA_VERSION
+import speedtest_collector
+from app import app, get_db_connection, get_stats, get_plot_data, CACHES, window_cache
+import db
+import app as app_module
+import rollups
+import sketch
+import probes
+import shipper
+from spool import Spool, HEADER
+import throughput
+import latency
+import retention
+import bench
+import metrics
+import urllib.request
+import export
+import gzip
+import io
+from snapshot import SharedSnapshot
+import snapshot
+import loadtest
+import scheduler
+import anomaly
+import shards
+import heatmap
+import payload
 
 # Set up logging
 logging.basicConfig(
@@ -29,14 +60,16 @@ class BandwidthProbeTests(unittest.TestCase):
         
         # Create test database
         self.test_db = 'test_speedtest.db'
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self._remove_test_db()
         logger.debug("Created clean test database at %s", self.test_db)
         
         # Set up test client
         app.config['TESTING'] = True
         app.config['DATABASE'] = self.test_db
         self.client = app.test_client()
+        for cache in CACHES.values():
+            cache.clear()
+        window_cache.clear()
         logger.debug("Flask test client configured")
         
         # Initialize database
@@ -46,9 +79,15 @@ class BandwidthProbeTests(unittest.TestCase):
     def tearDown(self):
         """Clean up after each test method"""
         logger.info("Cleaning up test environment")
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
-            logger.debug("Removed test database")
+        self._remove_test_db()
+        logger.debug("Removed test database")
+    
+    def _remove_test_db(self):
+        """Close pooled connections, then delete the database and its WAL files"""
+        db.close_all()
+        for path in (self.test_db, self.test_db + '-wal', self.test_db + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
     
     def test_database_setup(self):
         """Test database initialization"""
@@ -74,6 +113,37 @@ class BandwidthProbeTests(unittest.TestCase):
         
         conn.close()
     
+    def test_schema_migration(self):
+        """Test legacy databases are migrated to the indexed epoch schema"""
+        logger.info("Running schema migration test")
+        self._remove_test_db()
+        conn = sqlite3.connect(self.test_db)
+        conn.execute('''CREATE TABLE speedtests
+                        (timestamp TEXT, download REAL, upload REAL, ping REAL, error TEXT)''')
+        legacy = datetime(2024, 3, 1, 12, 30, 0)
+        conn.execute('INSERT INTO speedtests VALUES (?, ?, ?, ?, ?)',
+                     (legacy.isoformat(), 90.0, 40.0, 15.0, None))
+        conn.commit()
+        conn.close()
+        
+        setup_database(self.test_db)
+        setup_database(self.test_db)  # migrations must be idempotent
+        
+        conn = sqlite3.connect(self.test_db)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA user_version')
+        self.assertEqual(cursor.fetchone()[0], SCHEMA_VERSION)
+        cursor.execute('SELECT id, ts, download FROM speedtests')
+        self.assertEqual(cursor.fetchall(), [(1, int(legacy.timestamp()), 90.0)])
+        
+        # Range scans must be answered from the covering index
+        cursor.execute('''EXPLAIN QUERY PLAN
+                          SELECT download, upload FROM speedtests
+                          WHERE error IS NULL AND ts > ? AND ts <= ?''', (0, 1))
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('COVERING INDEX idx_speedtests_error_ts', plan)
+        conn.close()
+    
     def test_save_result(self):
         """Test saving speedtest results"""
         logger.info("Running save result test")
@@ -101,6 +171,1148 @@ class BandwidthProbeTests(unittest.TestCase):
         self.assertIsNone(row[4])        # error
         logger.debug("Verified successful result was saved correctly")
     
+    def _insert_history(self, hours=48, step=600):
+        """Insert raw samples every `step` seconds over the last `hours`"""
+        now = int(datetime.now().timestamp())
+        rows = []
+        for i, ts in enumerate(range(now - hours * 3600, now, step)):
+            if i % 7 == 0:
+                rows.append((datetime.fromtimestamp(ts).isoformat(), None, None, None, 'timeout', ts))
+            else:
+                rows.append((datetime.fromtimestamp(ts).isoformat(),
+                             50.0 + i % 13, 10.0 + i % 5, 12.0 + i % 3, None, ts))
+        conn = sqlite3.connect(self.test_db)
+        conn.executemany('''INSERT INTO speedtests (timestamp, download, upload, ping, error, ts)
+                            VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        conn.commit()
+        conn.close()
+        return rows
+    
+    def test_rollup_stats(self):
+        """Test rollup-backed stats match a full scan of the raw rows"""
+        logger.info("Running rollup stats test")
+        self._insert_history()
+        conn = sqlite3.connect(self.test_db)
+        rollups.roll_up_pending(conn.cursor())
+        conn.commit()
+        # Rows written after the last roll-up must still be counted
+        self._insert_history(hours=1, step=900)
+        
+        end = datetime.now() - timedelta(days=1)
+        start_ts, end_ts = int((end - timedelta(days=1)).timestamp()), int(end.timestamp())
+        stats = get_stats(conn, 1)
+        cursor = conn.cursor()
+        for section, where, params in (('period', 'AND ts > ? AND ts <= ?', (start_ts, end_ts)),
+                                       ('overall', '', ())):
+            cursor.execute('''SELECT MIN(download), MAX(download), AVG(download), COUNT(*)
+                              FROM speedtests WHERE error IS NULL %s''' % where, params)
+            expected = cursor.fetchone()
+            cursor.execute('SELECT COUNT(*) FROM speedtests WHERE error IS NOT NULL %s' % where, params)
+            errors = cursor.fetchone()[0]
+            self.assertEqual(stats[section]['download']['min'], expected[0])
+            self.assertEqual(stats[section]['download']['max'], expected[1])
+            self.assertAlmostEqual(stats[section]['download']['avg'], expected[2])
+            self.assertEqual(stats[section]['test_count'], expected[3])
+            self.assertEqual(stats[section]['error_count'], errors)
+        
+        # Rebuilding from raw rows gives the same rollups as incremental updates
+        rollups.roll_up_pending(cursor)
+        conn.commit()
+        query = 'SELECT bucket, total_count, error_count, count, down_min FROM speedtest_rollups_hour'
+        incremental = cursor.execute(query).fetchall()
+        conn.isolation_level = None
+        rollups.rebuild_rollups(conn)
+        self.assertEqual(sorted(cursor.execute(query).fetchall()), sorted(incremental))
+        conn.close()
+    
+    def test_distribution_sketches(self):
+        """Test distributions come from merged sketches within their error bound"""
+        logger.info("Running distribution sketch test")
+        self._insert_history(hours=72)
+        conn = sqlite3.connect(self.test_db)
+        rollups.roll_up_pending(conn.cursor())
+        conn.commit()
+        self._insert_history(hours=1, step=900)
+        
+        stats = get_stats(conn, 0)
+        cursor = conn.cursor()
+        cursor.execute('SELECT download FROM speedtests WHERE error IS NULL ORDER BY download')
+        downloads = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        box = stats['overall']['distribution']['download']['data'][0]
+        self.assertEqual(box['type'], 'box')
+        true_median = downloads[len(downloads) // 2]
+        self.assertLessEqual(abs(box['median'][0] - true_median) / true_median, sketch.GAMMA - 1)
+        self.assertEqual(box['lowerfence'][0], downloads[0])
+        self.assertEqual(box['upperfence'][0], downloads[-1])
+        # The payload is a fixed handful of numbers, not one per sample
+        self.assertLess(len(json.dumps(stats['overall']['distribution'])), 1000)
+        
+        # Sketches round-trip through their storage encoding
+        blob = sketch.add_values(None, [0.0, 5.0, 5.0, 250.0])
+        self.assertEqual(sorted(sketch.decode(blob).values()), [1, 1, 2])
+    
+    def test_plot_downsampling(self):
+        """Test the time series is capped at the requested point count"""
+        logger.info("Running plot downsampling test")
+        rows = self._insert_history(hours=23, step=60)
+        conn = sqlite3.connect(self.test_db)
+        # A single deep dip and a two-hour outage must survive downsampling
+        dip_ts = rows[500][5]
+        conn.execute('UPDATE speedtests SET download = 0.5 WHERE ts = ?', (dip_ts,))
+        conn.execute('DELETE FROM speedtests WHERE ts > ? AND ts < ?',
+                     (rows[800][5], rows[800][5] + 7200))
+        conn.commit()
+        
+        plot = get_plot_data(conn, 0, max_points=100)
+        conn.close()
+        downloads = payload.decode_array(plot['data'][0]['y'])
+        self.assertLessEqual(len(downloads), 100)
+        self.assertIn(0.5, downloads)
+        self.assertEqual(downloads.count(None), 1)
+        self.assertEqual(len(payload.decode_array(plot['data'][0]['x'])), len(downloads))
+        
+        response = self.client.get('/?points=50')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_api_etags(self):
+        """Test the JSON API answers 304 until a new sample is saved"""
+        logger.info("Running API ETag test")
+        self._insert_history(hours=2)
+        for url in ('/api/stats', '/api/series?points=50', '/api/distribution'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            self.assertIsNotNone(response.get_json())
+            
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+        
+        save_result({'download': 80.0, 'upload': 30.0, 'ping': 9.0, 'error': None}, self.test_db)
+        response = self.client.get('/api/stats', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['overall']['download']['max'], 80.0)
+        
+        # The page embeds the ETags it was rendered from
+        page = self.client.get('/').data.decode()
+        response = self.client.get('/api/stats')
+        self.assertIn(response.headers['ETag'].replace('"', '\\"'), page)
+    
+    def test_compact_payloads(self):
+        """Test plot arrays are binary-encoded, responses compressed and Plotly served locally"""
+        rows = self._insert_history(hours=3, step=600)
+        conn = sqlite3.connect(self.test_db)
+        plot = get_plot_data(conn, 0)
+        conn.close()
+        x, y = plot['data'][0]['x'], plot['data'][0]['y']
+        self.assertEqual((x['dtype'], y['dtype']), ('i4', 'f4'))
+        # Timestamps decode to the naive local ISO strings the rows carry
+        successes = [row for row in rows if row[4] is None]
+        self.assertEqual(payload.decode_array(x), [row[0] for row in successes])
+        self.assertEqual(payload.decode_array(y), [row[1] for row in successes])
+
+        response = self.client.get('/api/series', headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        compressed = self.client.get('/api/series', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(compressed.data)), response.get_json())
+        self.assertLess(len(compressed.data), len(response.data))
+        # The ETags name the data, not the bytes, so they are weak; conditional
+        # requests still match, whatever the encoding
+        for etag in (response.headers['ETag'], compressed.headers['ETag']):
+            self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(compressed.headers['ETag'], response.headers['ETag'])
+        again = self.client.get('/api/series', headers={'Accept-Encoding': 'gzip',
+                                                        'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertTrue(again.headers['ETag'].startswith('W/"'))
+
+        page = self.client.get('/').data.decode()
+        self.assertNotIn('cdn.plot.ly', page)
+        url = '/vendor/' + app_module.PLOTLY_JS
+        self.assertIn(url, page)
+        asset = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(asset.status_code, 200)
+        self.assertIn('immutable', asset.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', asset.headers['Cache-Control'])
+        with open(os.path.join(app_module.VENDOR_DIR, app_module.PLOTLY_JS), 'rb') as f:
+            self.assertEqual(gzip.decompress(asset.data), f.read())
+        self.assertEqual(self.client.get('/vendor/..%2Fapp.py').status_code, 404)
+
+    def test_response_cache(self):
+        """Test pages are served from cache until their data changes"""
+        logger.info("Running response cache test")
+        self._insert_history(hours=72)
+        
+        first = self.client.get('/2').data
+        self.assertEqual(self.client.get('/2').data, first)
+        self.client.get('/')
+        counters = self.client.get('/api/cache').get_json()
+        self.assertEqual(counters['html']['hits'], 1)
+        self.assertEqual(counters['html']['misses'], 2)
+        
+        # A new sample re-renders both pages, but the historical window's
+        # period stats and plot are reused, and the recomputed overall
+        # section is shared between the two pages
+        save_result({'download': 80.0, 'upload': 30.0, 'ping': 9.0, 'error': None}, self.test_db)
+        stats_hits = counters['stats']['hits']
+        series_hits = counters['series']['hits']
+        self.client.get('/2')
+        self.client.get('/')
+        counters = self.client.get('/api/cache').get_json()
+        self.assertEqual(counters['html']['misses'], 4)
+        self.assertEqual(counters['stats']['hits'], stats_hits + 2)
+        self.assertEqual(counters['series']['hits'], series_hits + 1)
+    
+    def test_concurrent_reads_during_writes(self):
+        """Test dashboard reads never fail while the collector keeps writing"""
+        logger.info("Running concurrent read/write test")
+        self._insert_history(hours=24)
+        errors = []
+        writing = threading.Event()
+        writing.set()
+        
+        def write():
+            try:
+                for i in range(200):
+                    save_result({'download': 100.0 + i, 'upload': 20.0, 'ping': 10.0, 'error': None},
+                                self.test_db)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                writing.clear()
+        
+        def read():
+            reads = 0
+            try:
+                while writing.is_set() or reads < 5:
+                    conn = db.get_reader(self.test_db)
+                    get_stats(conn, 0)
+                    get_plot_data(conn, 0)
+                    reads += 1
+            except Exception as e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        conn = db.get_reader(self.test_db)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(get_stats(conn, 0)['overall']['download']['max'], 299.0)
+    
+    def test_window_cache(self):
+        """Test the in-memory window cache tails new rows and matches the SQL path"""
+        logger.info("Running window cache test")
+        self._insert_history(hours=30)
+        conn = db.get_reader(self.test_db)
+        cached = get_stats(conn, 0)
+        self.assertTrue(window_cache.covers(int(datetime.now().timestamp()) - 86400))
+        loaded = len(window_cache.columns['ts'])
+        
+        save_result({'download': 500.0, 'upload': 30.0, 'ping': 9.0, 'error': None}, self.test_db)
+        tailed = get_stats(conn, 0)
+        self.assertEqual(len(window_cache.columns['ts']), loaded + 1)
+        self.assertEqual(tailed['period']['download']['max'], 500.0)
+        self.assertEqual(tailed['period']['test_count'], cached['period']['test_count'] + 1)
+        
+        # With the cache disabled the rollup/SQL path gives the same answer
+        app.config['WINDOW_CACHE_DAYS'] = 0
+        try:
+            uncached = get_stats(conn, 0)
+        finally:
+            app.config['WINDOW_CACHE_DAYS'] = 7
+        self.assertEqual(uncached['period']['test_count'], tailed['period']['test_count'])
+        self.assertEqual(uncached['period']['error_count'], tailed['period']['error_count'])
+        self.assertAlmostEqual(uncached['period']['upload']['avg'], tailed['period']['upload']['avg'])
+    
+    def test_event_stream(self):
+        """Test /events pushes new measurements from one shared watcher"""
+        logger.info("Running event stream test")
+        self._insert_history(hours=2)
+        app.config['EVENTS_POLL_INTERVAL'] = 0.05
+        first = self.client.get('/events')
+        second = self.client.get('/events')
+        self.assertEqual(first.mimetype, 'text/event-stream')
+        streams = [(chunk.decode() for chunk in response.response) for response in (first, second)]
+        for stream in streams:
+            self.assertTrue(next(stream).startswith('retry:'))
+        feed = app_module.change_feed
+        self.assertEqual(feed.subscriber_count(), 2)
+        
+        # Let the watcher take its baseline before the collector writes
+        time.sleep(0.2)
+        save_result({'download': 77.0, 'upload': 33.0, 'ping': 8.0, 'error': None}, self.test_db)
+        for stream in streams:
+            measurement = next(stream)
+            self.assertTrue(measurement.startswith('event: measurement'))
+            self.assertEqual(json.loads(measurement.split('data: ')[1])['download'], 77.0)
+            stats = next(stream)
+            self.assertTrue(stats.startswith('event: stats'))
+        
+        first.close()
+        second.close()
+        self.assertEqual(feed.subscriber_count(), 0)
+        feed.stop()
+        app_module.change_feed = None
+    
+    STUB_SPEEDTEST = """#!%s
+import json, os, sys, time
+mode = os.environ.get('STUB_SPEEDTEST_MODE', 'ok')
+if mode == 'hang':
+    time.sleep(60)
+if mode == 'fail':
+    sys.stderr.write('Cannot retrieve speedtest configuration')
+    sys.exit(1)
+# Flush the document in pieces to exercise incremental parsing
+doc = json.dumps({'download': 93500000.0, 'upload': 41200000.0, 'ping': 12.5, 'args': sys.argv[1:]})
+for i in range(0, len(doc), 16):
+    sys.stdout.write(doc[i:i + 16])
+    sys.stdout.flush()
+    time.sleep(0.01)
+"""
+    
+    def _install_stub_speedtest(self, mode='ok'):
+        """Put a fake speedtest executable first on PATH"""
+        stub_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stub_dir)
+        path = os.path.join(stub_dir, 'speedtest')
+        with open(path, 'w') as f:
+            f.write(self.STUB_SPEEDTEST % sys.executable)
+        os.chmod(path, 0o755)
+        old_path, old_mode = os.environ.get('PATH', ''), os.environ.get('STUB_SPEEDTEST_MODE')
+        os.environ['PATH'] = stub_dir + os.pathsep + old_path
+        os.environ['STUB_SPEEDTEST_MODE'] = mode
+        def restore():
+            os.environ['PATH'] = old_path
+            if old_mode is None:
+                os.environ.pop('STUB_SPEEDTEST_MODE', None)
+            else:
+                os.environ['STUB_SPEEDTEST_MODE'] = old_mode
+        self.addCleanup(restore)
+    
+    def test_run_speedtest_stub(self):
+        """Test the async runner parses streamed output and handles failures"""
+        self._install_stub_speedtest()
+        self.assertTrue(speedtest_collector.verify_speedtest_cli())
+        result = run_speedtest()
+        self.assertIsNone(result['error'])
+        self.assertAlmostEqual(result['download'], 93.5)
+        self.assertAlmostEqual(result['upload'], 41.2)
+        self.assertEqual(result['ping'], 12.5)
+        
+        os.environ['STUB_SPEEDTEST_MODE'] = 'fail'
+        result = run_speedtest()
+        self.assertIn('Cannot retrieve', result['error'])
+        
+        os.environ['STUB_SPEEDTEST_MODE'] = 'hang'
+        start = time.monotonic()
+        result = run_speedtest(timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('timed out', result['error'])
+    
+    def test_collector_targets(self):
+        """Test staggered multi-target collection into the database"""
+        self._install_stub_speedtest()
+        target = speedtest_collector.parse_target("office=--server 1234 --source 10.0.0.2")
+        self.assertEqual(target.name, 'office')
+        self.assertEqual(target.args, ['--server', '1234', '--source', '10.0.0.2'])
+        
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        spool = Spool(os.path.join(spool_dir, 'speedtest.spool'))
+        self.addCleanup(spool.close)
+        
+        async def collect():
+            targets = [speedtest_collector.DEFAULT_TARGET, target]
+            # An interval of 0.01 minutes staggers the targets 0.3 s apart
+            task = asyncio.create_task(speedtest_collector.run_collector(
+                targets, self.test_db, interval_minutes=0.01, timeout=10, spool=spool))
+            await asyncio.sleep(1.0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(collect())
+        
+        conn = sqlite3.connect(self.test_db)
+        rows = conn.execute('SELECT download, error FROM speedtests').fetchall()
+        probe_ids = {row[0] for row in conn.execute('SELECT probe_id FROM speedtests')}
+        conn.close()
+        self.assertGreaterEqual(len(rows), 2)
+        self.assertEqual(probe_ids, {'local', 'office'})
+        self.assertTrue(all(error is None and download == 93.5 for download, error in rows))
+    
+    def test_adaptive_schedule(self):
+        """Test the monotonic schedule skips overruns and adapts to degradation"""
+        now = [1000.0]
+        schedule = scheduler.Schedule(900, 60, 3600, jitter=0, clock=lambda: now[0])
+        self.assertEqual(schedule.start(30), 30)
+        now[0] += 30 + 40  # a 40 s test
+        self.assertEqual(schedule.next_delay(), 860)  # due 900 s after the last was due
+        now[0] += 860 + 2000  # this one overran past the next two slots
+        self.assertEqual(schedule.next_delay(), 700)
+        self.assertEqual(schedule.skipped, 2)
+        
+        good = {'download': 100.0, 'upload': 20.0, 'ping': 10.0, 'error': None}
+        intervals = [schedule.observe(good) for _ in range(7)]
+        self.assertEqual(intervals, [900, 900, 900, 1800, 3600, 3600, 3600])
+        self.assertEqual(schedule.observe({'error': 'timed out'}), 60)
+        self.assertEqual(schedule.observe(dict(good, download=50.0)), 60)  # off the baseline
+        self.assertEqual(schedule.observe(dict(good, ping=25.0)), 60)
+        self.assertEqual(schedule.observe(dict(good, download=95.0)), 900)
+        
+        # Jitter delays runs without shifting the slots they belong to
+        schedule = scheduler.Schedule(600, jitter=0.1, clock=lambda: now[0], rng=random.Random(1))
+        schedule.start()
+        first, jitters = schedule.due, []
+        for k in range(1, 51):
+            now[0] += schedule.next_delay()
+            self.assertEqual(schedule.due, first + k * 600)
+            jitters.append(now[0] - schedule.due)
+            self.assertTrue(0 <= jitters[-1] < 60)
+        self.assertEqual(schedule.skipped, 0)
+        self.assertGreater(len({round(j) for j in jitters}), 10)
+        
+        args = speedtest_collector.parse_args(['--interval', '5'])
+        self.assertEqual((args.min_interval, args.max_interval), (1, 60))
+        with self.assertRaises(SystemExit):
+            speedtest_collector.parse_args(['--interval', '5', '--max-interval', '2'])
+    
+    def test_incidents(self):
+        """Test degradations are detected as rows arrive and served as incidents"""
+        rng = random.Random(7)
+        start = datetime.now() - timedelta(hours=20)
+        def record(i, download, error=None):
+            data = {'error': error} if error else {
+                'download': download * rng.uniform(0.95, 1.05), 'upload': 20.0,
+                'ping': 10.0 * rng.uniform(0.9, 1.1)}
+            return speedtest_collector.make_record(data, now=start + timedelta(minutes=15 * i))
+        # A stable link, two hours at a third of its speed, then recovery;
+        # a single failed test is noise, two in a row are an incident
+        speeds = [100.0] * 40 + [30.0] * 8 + [100.0] * 12
+        save = lambda records: speedtest_collector.save_records(records, self.test_db)
+        save([record(i, speed) for i, speed in enumerate(speeds)])
+        save([record(60, 0, 'timed out'), record(61, 100.0)])
+        save([record(62, 0, 'timed out'), record(63, 0, 'timed out')])
+
+        conn = sqlite3.connect(self.test_db)
+        incidents = anomaly.get_incidents(conn.cursor())
+        self.assertEqual([i['metric'] for i in incidents], ['download', 'error'])
+        download, error = incidents
+        drop = int((start + timedelta(minutes=600)).timestamp())
+        # The change point is where the CUSUM run began, at most a sample or two early
+        self.assertTrue(drop - 1800 <= download['start_ts'] <= drop)
+        self.assertEqual(download['end_ts'], int((start + timedelta(minutes=720)).timestamp()))
+        self.assertGreater(download['severity'], 0.6)
+        self.assertAlmostEqual(download['baseline'], 100.0, delta=5)
+        self.assertIsNone(error['end_ts'])  # still failing
+        self.assertEqual(error['samples'], 2)
+
+        # Replaying history finds the same incidents
+        conn.isolation_level = None
+        self.assertEqual(anomaly.rebuild_incidents(conn), 2)
+        self.assertEqual([dict(i, id=None) for i in anomaly.get_incidents(conn.cursor())],
+                         [dict(i, id=None) for i in incidents])
+        conn.close()
+
+        response = self.client.get('/api/incidents')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual([i['metric'] for i in body], ['download', 'error'])
+        self.assertEqual(body[0]['start'], datetime.fromtimestamp(download['start_ts']).isoformat())
+        self.assertIsNone(body[1]['end'])
+        self.assertEqual(self.client.get('/api/incidents?probe=elsewhere').get_json(), [])
+        self.assertEqual(self.client.get('/api/incidents?offset=3').get_json(), [])
+        self.assertEqual(self.client.get('/api/incidents?start=soon').status_code, 400)
+
+        shapes = self.client.get('/api/series').get_json()['layout']['shapes']
+        self.assertEqual(len(shapes), 2)
+        self.assertTrue(all(s['type'] == 'rect' and s['yref'] == 'paper' for s in shapes))
+
+    def test_monthly_shards(self):
+        """Test finished months move to read-only shards that reads still see"""
+        self.addCleanup(shutil.rmtree, shards.shard_dir(self.test_db), True)
+        now = datetime.now()
+        def record(days_ago, download):
+            return speedtest_collector.make_record(
+                {'download': download, 'upload': 20.0, 'ping': 10.0},
+                now=now - timedelta(days=days_ago))
+        speedtest_collector.save_records(
+            [record(days / 8, 50.0 + days % 40) for days in range(100 * 8, 0, -1)], self.test_db)
+
+        conn = sqlite3.connect(self.test_db)
+        offsets = (40, 70, 95)
+        before = [(get_stats(conn, offset), get_plot_data(conn, offset)) for offset in offsets]
+        total = conn.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0]
+        conn.close()
+
+        moved = shards.archive(self.test_db)
+        self.assertGreater(moved, 0)
+        conn = sqlite3.connect(self.test_db)
+        manifest = shards.get_manifest(conn)
+        self.assertEqual(sum(row[4] for row in manifest), moved)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0],
+                         total - moved)
+        for month, name, *_ in manifest:
+            mode = os.stat(os.path.join(shards.shard_dir(self.test_db), name)).st_mode
+            self.assertFalse(mode & 0o222)  # sealed shards are read-only
+        # Windows in sealed months read the same as before, through the shards
+        for offset, (stats, plot) in zip(offsets, before):
+            self.assertEqual(get_stats(conn, offset), stats)
+            self.assertEqual(get_plot_data(conn, offset), plot)
+        self.assertEqual(shards.attach(conn), len(manifest))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0], total)
+        self.assertEqual(shards.attach(conn, 0, 1), 0)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0],
+                         total - moved)
+        conn.close()
+        # A pooled reader left attached by one request is reset for the next
+        reader = get_db_connection()
+        shards.attach(reader)
+        self.assertIs(get_db_connection(), reader)
+        self.assertEqual(reader.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0],
+                         total - moved)
+        for cache in CACHES.values():
+            cache.clear()
+        response = self.client.get('/api/series?offset=70')
+        self.assertEqual(response.get_json()['data'], before[1][1]['data'])
+        lines = self.client.get('/export/ndjson', headers={'Accept-Encoding': 'identity'}).data
+        self.assertEqual(len(lines.splitlines()), total)
+
+        # A late result for a sealed month produces a new generation of its shard
+        speedtest_collector.save_records([record(70, 99.0), record(0, 60.0)], self.test_db)
+        self.assertEqual(shards.archive(self.test_db), 1)
+        conn = sqlite3.connect(self.test_db)
+        month = shards.month_range(int((now - timedelta(days=70)).timestamp()))[0]
+        row = conn.execute('SELECT file, rows, generation FROM shards WHERE month = ?',
+                           (month,)).fetchone()
+        self.assertEqual(row[0], '%s.1.db' % month)
+        self.assertEqual(sorted(os.listdir(shards.shard_dir(self.test_db))),
+                         sorted(name for _, name, *_ in shards.get_manifest(conn)))
+        self.assertEqual(get_stats(conn, 70)['period']['test_count'],
+                         before[1][0]['period']['test_count'] + 1)
+        conn.close()
+
+        # Retention drops whole shards once their month is below the raw floor
+        retention.compact(self.test_db, raw_days=30)
+        conn = sqlite3.connect(self.test_db)
+        floor = rollups.get_floors(conn.cursor())[0]
+        self.assertTrue(all(row[3] > floor for row in shards.get_manifest(conn)))
+        self.assertEqual(len(os.listdir(shards.shard_dir(self.test_db))),
+                         len(shards.get_manifest(conn)))
+        conn.close()
+
+    def test_many_shards(self):
+        """Test reads spanning more shards than can be attached at once see every row"""
+        self.addCleanup(shutil.rmtree, shards.shard_dir(self.test_db), True)
+        now = datetime.now()
+        speedtest_collector.save_records(
+            [speedtest_collector.make_record(
+                {'download': 50.0 + days % 40, 'upload': 20.0, 'ping': 10.0},
+                now=now - timedelta(days=days / 2)) for days in range(330 * 2, 0, -1)],
+            self.test_db)
+        probe = probes.LOCAL_PROBE
+        hour = int(now.timestamp())
+
+        conn = sqlite3.connect(self.test_db)
+        total = conn.execute('SELECT COUNT(*) FROM speedtests').fetchone()[0]
+        overall = get_stats(conn, 0, probe=probe)['overall']
+        earliest = rollups.probe_earliest_ts(conn.cursor(), probe)
+        grid = heatmap.get_heatmap(conn.cursor(), 365, hour, probe)
+        incidents = [dict(i, id=None) for i in anomaly.get_incidents(conn.cursor())]
+        conn.close()
+
+        shards.archive(self.test_db)
+        conn = sqlite3.connect(self.test_db)
+        self.assertGreater(len(shards.get_manifest(conn)), shards.MAX_ATTACHED)
+        with self.assertRaises(shards.TooManyShards):
+            shards.attach(conn)
+        self.assertEqual(sum(len(rows) for rows in export.iter_batches(conn, batch_size=100)),
+                         total)
+        self.assertEqual(get_stats(conn, 0, probe=probe)['overall'], overall)
+        self.assertEqual(rollups.probe_earliest_ts(conn.cursor(), probe), earliest)
+        self.assertEqual(heatmap.get_heatmap(conn.cursor(), 365, hour, probe), grid)
+        conn.isolation_level = None
+        anomaly.rebuild_incidents(conn, batch_size=100)
+        self.assertEqual([dict(i, id=None) for i in anomaly.get_incidents(conn.cursor())],
+                         incidents)
+        conn.close()
+
+        for cache in CACHES.values():
+            cache.clear()
+        lines = self.client.get('/export/ndjson', headers={'Accept-Encoding': 'identity'}).data
+        self.assertEqual(len(lines.splitlines()), total)
+        body = self.client.get('/api/stats?probe=%s' % probe).get_json()
+        self.assertEqual(body['overall']['test_count'], overall['test_count'])
+        page = self.client.get('/300?probe=%s' % probe).data.decode()
+        self.assertNotIn('onclick="navigate(301)" disabled', page)
+
+    def test_weekly_heatmap(self):
+        """Test the weekday x hour heatmap from the rollups matches the raw samples"""
+        now = datetime.now().replace(minute=30, second=0, microsecond=0)
+        records = []
+        for step in range(1, 35 * 48):
+            when = now - timedelta(minutes=30 * step)
+            if step % 11 == 0:
+                records.append(speedtest_collector.make_record({'error': 'timeout'}, now=when))
+                continue
+            # Weekday evenings are congested
+            busy = when.weekday() < 5 and 18 <= when.hour < 22
+            records.append(speedtest_collector.make_record(
+                {'download': (20.0 if busy else 100.0) + step % 7, 'upload': 20.0 + step % 3,
+                 'ping': 40.0 if busy else 10.0}, now=when))
+        speedtest_collector.save_records(records, self.test_db)
+
+        conn = sqlite3.connect(self.test_db)
+        result = heatmap.get_heatmap(conn.cursor(), 28)
+        self.assertEqual(result['start_ts'], result['end_ts'] - 28 * 86400)
+        # Expected values straight from the raw samples in the same range
+        rows = conn.execute('''SELECT ts, download, error FROM speedtests
+                               WHERE ts >= ? AND ts < ?''',
+                            (result['start_ts'], result['end_ts'])).fetchall()
+        slots = {}
+        for ts, download, error in rows:
+            when = datetime.fromtimestamp(ts)
+            slots.setdefault((when.weekday(), when.hour), []).append((download, error))
+        for (day, hour), samples in slots.items():
+            values = [d for d, error in samples if error is None]
+            self.assertEqual(result['tests'][day][hour], len(samples))
+            self.assertEqual(result['errors'][day][hour], len(samples) - len(values))
+            expected = sketch.quantiles(sketch.merge([], values), [0.1, 0.5])
+            self.assertAlmostEqual(result['download']['p10'][day][hour], expected[0], places=2)
+            self.assertAlmostEqual(result['download']['median'][day][hour], expected[1], places=2)
+        self.assertLess(result['download']['median'][1][19], 30)
+        self.assertGreater(result['download']['median'][5][19], 95)
+        self.assertGreater(result['ping']['median'][1][19], result['ping']['median'][1][3])
+        # One probe is read from its raw rows and agrees with the rollups
+        self.assertEqual(heatmap.get_heatmap(conn.cursor(), 28, probe_id=probes.LOCAL_PROBE),
+                         result)
+        self.assertIsNone(heatmap.get_heatmap(conn.cursor(), 28, probe_id='elsewhere'))
+        conn.close()
+
+        response = self.client.get('/api/heatmap?days=28')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['download'], result['download'])
+        again = self.client.get('/api/heatmap?days=28',
+                                headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        week = self.client.get('/api/heatmap?days=7').get_json()
+        self.assertEqual(week['start_ts'], week['end_ts'] - 7 * 86400)
+        self.assertEqual(sum(map(sum, week['tests'])),
+                         len([r for r in records if r['ts'] >= week['start_ts']]))
+
+    def _fleet_records(self, count, start_seq=1):
+        base = int(time.time()) - 3600
+        return [{'seq': seq, 'ts': base + seq * 60, 'download': 50.0 + seq, 'upload': 20.0,
+                 'ping': 10.0, 'error': None}
+                for seq in range(start_seq, start_seq + count)]
+    
+    def test_fleet_ingest(self):
+        """Test batched NDJSON ingestion is idempotent and filterable per probe"""
+        save_result({'download': 100.0, 'upload': 50.0, 'ping': 5.0, 'error': None}, self.test_db)
+        body = probes.encode_batch(self._fleet_records(30))
+        headers = {'Content-Encoding': 'gzip', 'Content-Type': 'application/x-ndjson'}
+        
+        response = self.client.post('/api/ingest/site-7', data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'accepted': 30, 'duplicates': 0, 'last_seq': 30})
+        # A retried batch, overlapping the first, only adds the new rows
+        body = probes.encode_batch(self._fleet_records(10, start_seq=25))
+        response = self.client.post('/api/ingest/site-7', data=body, headers=headers)
+        self.assertEqual(response.get_json(), {'accepted': 4, 'duplicates': 6, 'last_seq': 34})
+        
+        conn = sqlite3.connect(self.test_db)
+        counts = dict(conn.execute('SELECT probe_id, COUNT(*) FROM speedtests GROUP BY probe_id'))
+        self.assertEqual(counts, {'local': 1, 'site-7': 34})
+        rolled = conn.execute('SELECT SUM(total_count) FROM speedtest_rollups_hour').fetchone()[0]
+        self.assertEqual(rolled, 35)
+        conn.close()
+        
+        listed = self.client.get('/api/probes').get_json()
+        self.assertEqual([(p['probe_id'], p['last_seq']) for p in listed],
+                         [('local', None), ('site-7', 34)])
+        stats = self.client.get('/api/stats?probe=site-7').get_json()
+        self.assertEqual(stats['overall']['test_count'], 34)
+        self.assertEqual(stats['period']['download']['max'], 84.0)
+        everything = self.client.get('/api/stats').get_json()
+        self.assertEqual(everything['overall']['test_count'], 35)
+        series = self.client.get('/api/series?probe=local').get_json()
+        self.assertEqual(payload.decode_array(series['data'][0]['y']), [100.0])
+        page = self.client.get('/?probe=site-7')
+        self.assertIn(b'probe-select', page.data)
+        self.assertEqual(self.client.get('/api/stats?probe=bad%20id').status_code, 400)
+        
+        # Malformed batches are rejected as a whole
+        response = self.client.post('/api/ingest/site-7', data=b'{"seq": 99, "ts": 1}\nnot json\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('line 2', response.get_json()['error'])
+        # Values SQLite or datetime can't represent are rejected, not stored
+        for line in (b'{"seq": 99, "ts": 1000000000000000000}', b'{"seq": %d, "ts": 1}' % 2 ** 70):
+            response = self.client.post('/api/ingest/site-7', data=line)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('must be at most', response.get_json()['error'])
+        app.config['INGEST_TOKEN'] = 'secret'
+        try:
+            self.assertEqual(self.client.post('/api/ingest/site-7', data=b'').status_code, 401)
+            response = self.client.post('/api/ingest/site-7', data=b'',
+                                        headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['INGEST_TOKEN'] = None
+    
+    def test_shipper(self):
+        """Test a collector ships its local rows in batches and resumes after failures"""
+        from werkzeug.serving import make_server
+        probe_db = 'test_probe_speedtest.db'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(probe_db + suffix):
+                os.remove(probe_db + suffix)
+        self.addCleanup(lambda: [os.remove(probe_db + suffix) for suffix in ('', '-wal', '-shm')
+                                 if os.path.exists(probe_db + suffix)])
+        setup_database(probe_db)
+        for i in range(7):
+            save_result({'download': 10.0 + i, 'upload': 5.0, 'ping': 20.0, 'error': None}, probe_db)
+        save_result({'download': 99.0, 'upload': 9.0, 'ping': 9.0, 'error': None}, probe_db, 'wan2')
+        
+        # Nothing listening: the rows stay queued locally
+        with self.assertRaises(OSError):
+            shipper.ship_pending(probe_db, 'http://127.0.0.1:9', 'site-3')
+        self.assertEqual(shipper.get_shipped_id(db.get_reader(probe_db)), 0)
+        
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_port
+            self.assertEqual(shipper.ship_pending(probe_db, url, 'site-3', batch_size=3), 8)
+            self.assertEqual(shipper.ship_pending(probe_db, url, 'site-3'), 0)
+            # Forgetting the acknowledgement only causes harmless resends
+            db.get_writer(probe_db).transaction(lambda c: shipper.set_shipped_id(c, 0))
+            self.assertEqual(shipper.ship_pending(probe_db, url, 'site-3'), 8)
+            # A recreated probe database restarts its rowids, not its seqs
+            fresh_db = 'test_probe2_speedtest.db'
+            self.addCleanup(lambda: [os.remove(fresh_db + suffix) for suffix in ('', '-wal', '-shm')
+                                     if os.path.exists(fresh_db + suffix)])
+            setup_database(fresh_db)
+            for i in range(2):
+                save_result({'download': 50.0, 'upload': 5.0, 'ping': 20.0, 'error': None},
+                            fresh_db)
+            self.assertEqual(shipper.ship_pending(fresh_db, url, 'site-3'), 2)
+        finally:
+            server.shutdown()
+            thread.join()
+        
+        conn = sqlite3.connect(self.test_db)
+        counts = dict(conn.execute('SELECT probe_id, COUNT(*) FROM speedtests GROUP BY probe_id'))
+        conn.close()
+        self.assertEqual(counts, {'site-3': 9, 'site-3:wan2': 1})
+    
+    def test_spool_recovery(self):
+        """Test spooled results survive crashes and replay without duplicates"""
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        path = os.path.join(spool_dir, 'speedtest.spool')
+        spool = Spool(path)
+        for i in range(3):
+            spool.append(speedtest_collector.make_record(
+                {'download': 80.0 + i, 'upload': 30.0, 'ping': 9.0, 'error': None}))
+        # A crash mid-append leaves a torn record at the end of the file
+        spool.close()
+        with open(path, 'ab') as f:
+            f.write(HEADER.pack(100, 0) + b'{"seq":')
+        spool = Spool(path)
+        self.addCleanup(spool.close)
+        self.assertEqual(len(spool), 3)
+        
+        # The database being unavailable loses nothing
+        missing = os.path.join(spool_dir, 'missing.db')
+        with self.assertRaises(OSError):
+            spool.drain(lambda records: speedtest_collector.save_records(records, missing))
+        self.assertEqual(len(spool), 3)
+        
+        # A crash after the rows are committed but before the spool is
+        # cleared replays them next time; they are not stored twice
+        def write_then_crash(records):
+            speedtest_collector.save_records(records, self.test_db)
+            raise RuntimeError('crash')
+        with self.assertRaises(RuntimeError):
+            spool.drain(write_then_crash)
+        spool.append(speedtest_collector.make_record({'error': 'timeout'}))
+        written = []
+        def write(records):
+            written.extend(records)
+            speedtest_collector.save_records(records, self.test_db)
+        self.assertEqual(spool.drain(write, batch_size=2), 4)
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(os.path.getsize(path), 0)
+        
+        conn = sqlite3.connect(self.test_db)
+        rows = conn.execute('SELECT download, error FROM speedtests ORDER BY seq').fetchall()
+        rolled = conn.execute('SELECT SUM(total_count) FROM speedtest_rollups_day').fetchone()[0]
+        conn.close()
+        self.assertEqual(rows, [(80.0, None), (81.0, None), (82.0, None), (None, 'timeout')])
+        self.assertEqual(rolled, 4)
+        
+        # Records appended while a drain is in progress are kept
+        spool.append(speedtest_collector.make_record({'error': 'first'}))
+        records, end = spool.pending()
+        spool.append(speedtest_collector.make_record({'error': 'second'}))
+        spool.commit(end)
+        self.assertEqual([r['error'] for r in spool.pending()[0]], ['second'])
+    
+    def test_throughput_probe(self):
+        """Test the built-in HTTP engine against the local throughput server"""
+        server = throughput.ThroughputServer(('127.0.0.1', 0), throughput.ThroughputHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d' % server.server_port
+        
+        target = speedtest_collector.parse_target('lan=%s --streams 2 --duration 1 --warmup 0.4 --interval 0.2' % url)
+        self.assertEqual(target.engine, 'http')
+        result = asyncio.run(speedtest_collector.measure(target))
+        self.assertIsNone(result['error'])
+        self.assertGreater(result['download'], 10)
+        self.assertGreater(result['upload'], 10)
+        self.assertGreater(result['ping'], 0)
+        # Samples cover the warm-up too, one per interval
+        self.assertGreaterEqual(len(result['samples']['download']), 4)
+        
+        save_result(result, self.test_db, target.name)
+        conn = sqlite3.connect(self.test_db)
+        row = conn.execute('SELECT probe_id, download FROM speedtests').fetchone()
+        conn.close()
+        self.assertEqual(row, ('lan', result['download']))
+        
+        # Uploads need a sane Content-Length
+        for length, status in ((None, 411), ('ten', 400), ('-5', 400),
+                               (str(throughput.MAX_UPLOAD_BYTES + 1), 413), ('3', 200)):
+            with socket.create_connection(('127.0.0.1', server.server_port), timeout=5) as sock:
+                head = 'POST /upload HTTP/1.1\r\nHost: test\r\n'
+                if length is not None:
+                    head += 'Content-Length: %s\r\n' % length
+                sock.sendall((head + '\r\n').encode() + b'abc')
+                self.assertIn(b' %d ' % status, sock.recv(1024).split(b'\r\n')[0])
+        
+        # An unreachable server is reported like a failed speedtest run
+        server.shutdown()
+        server.server_close()
+        result = throughput.run_probe(url, streams=1, duration=0.5, warmup=0.1)
+        self.assertIsNotNone(result['error'])
+        with self.assertRaises(ValueError):
+            speedtest_collector.parse_target('lan=%s --streams many' % url)
+    
+    def test_latency_sampler(self):
+        """Test per-minute latency aggregates from the TCP connect sampler"""
+        ring = latency.RttRing(size=4)
+        for i in range(6):
+            ring.add(60.0 + i, None if i == 4 else 10.0 + i)
+        window = ring.window(60, 120)
+        self.assertEqual(len(window), 4)  # the oldest two were overwritten
+        self.assertEqual(window[:2], [12.0, 13.0])
+        agg = latency.aggregate(window)
+        self.assertEqual((agg['sent'], agg['received']), (4, 3))
+        self.assertEqual((agg['rtt_min'], agg['rtt_p50'], agg['rtt_p99']), (12.0, 13.0, 15.0))
+        self.assertAlmostEqual(agg['jitter'], 1.5)  # (|13-12| + |15-13|) / 2
+        self.assertIsNone(latency.aggregate([float('nan')])['rtt_p50'])
+        self.assertEqual(latency.parse_target('[::1]:8080'), ('::1', 8080))
+        with self.assertRaises(ValueError):
+            latency.parse_target('example.com:0')
+        
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(16)
+        self.addCleanup(listener.close)
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))  # bound but not listening: refused
+        self.addCleanup(closed.close)
+        targets = ['127.0.0.1:%d' % listener.getsockname()[1],
+                   '127.0.0.1:%d' % closed.getsockname()[1]]
+        sampler = latency.LatencySampler(targets, self.test_db, interval=0.1)
+        
+        async def sample():
+            task = asyncio.create_task(sampler.run())
+            await asyncio.sleep(0.55)
+            task.cancel()
+            await sampler.flush(int(time.time()) // 60)
+        asyncio.run(sample())
+        
+        payload = self.client.get('/api/latency').get_json()
+        self.assertEqual(sorted(payload['series']), sorted(targets))
+        for target in targets:
+            columns = payload['series'][target]
+            self.assertEqual(columns['loss'][-1], 0.0)  # a refusal is a reply
+            self.assertGreater(columns['rtt_p50'][-1], 0)
+        self.assertEqual(len(payload['plot']['data']), 3 * len(targets))
+        etag = self.client.get('/api/latency').headers['ETag']
+        response = self.client.get('/api/latency', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertIsNone(self.client.get('/api/latency?offset=3').get_json()['plot'])
+    
+    def test_compaction(self):
+        """Test retention tiers keep stats answerable after raw rows are compacted"""
+        self._insert_history(hours=24 * 12, step=1800)
+        conn = sqlite3.connect(self.test_db)
+        rollups.roll_up_pending(conn.cursor())
+        conn.commit()
+        # An old row that has not been rolled up yet must survive compaction
+        old_ts = int(time.time()) - 10 * 86400
+        conn.execute('''INSERT INTO speedtests (timestamp, download, upload, ping, error, ts)
+                        VALUES (?, 1.0, 1.0, 1.0, NULL, ?)''',
+                     (datetime.fromtimestamp(old_ts).isoformat(), old_ts))
+        conn.commit()
+        before = get_stats(conn, 5, distributions=False)
+        conn.close()
+        
+        raw, hourly = retention.compact(self.test_db, raw_days=3, hourly_months=1, batch_size=50)
+        conn = sqlite3.connect(self.test_db)
+        raw_floor, hour_floor = rollups.get_floors(conn.cursor())
+        self.assertEqual(raw_floor % 86400, 0)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM speedtests WHERE ts < ?',
+                                      (raw_floor,)).fetchone()[0], 1)
+        self.assertGreater(raw, 300)
+        self.assertEqual(hourly, 0)
+        
+        # Overall stats come from the daily rollups and do not change; a
+        # window in the hourly tier only differs at its partial edge hours
+        after = get_stats(conn, 5, distributions=False)
+        self.assertEqual(after['overall'], before['overall'])
+        self.assertLessEqual(abs(after['period']['test_count'] - before['period']['test_count']), 2)
+        self.assertAlmostEqual(after['period']['download']['avg'],
+                               before['period']['download']['avg'], delta=1.0)
+        plot = get_plot_data(conn, 5)
+        self.assertTrue(22 <= len(payload.decode_array(plot['data'][0]['x'])) <= 25)  # hourly averages
+        
+        # Past the hourly tier windows are read from the daily rollups
+        retention.compact(self.test_db, raw_days=3, hourly_months=0, batch_size=50)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM speedtest_rollups_hour WHERE bucket < ?',
+                                      (raw_floor // 3600,)).fetchone()[0], 0)
+        daily = get_stats(conn, 5, distributions=True)
+        self.assertEqual(daily['overall'], get_stats(conn, 0, distributions=True)['overall'])
+        self.assertGreater(daily['period']['test_count'], 0)
+        self.assertIsNotNone(daily['period']['distribution'])
+        self.assertEqual(self.client.get('/5').status_code, 200)
+        self.assertIn(b'Previous 24h', self.client.get('/').data)
+        
+        # Freed pages were handed back and a rebuild keeps compacted history
+        self.assertEqual(conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        self.assertEqual(conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+        conn.isolation_level = None
+        rollups.rebuild_rollups(conn)
+        self.assertEqual(rollups.overall_aggregate(conn.cursor())['count'],
+                         before['overall']['test_count'])
+        conn.close()
+    
+    def test_benchmark_harness(self):
+        """Test the synthetic history generator and benchmark report"""
+        self._remove_test_db()
+        rows = bench.generate_history(self.test_db, days=3, interval=30, error_rate=0.1,
+                                      probe_count=2)
+        self.assertAlmostEqual(rows, 3 * 48 * 2, delta=2)  # every 30 minutes for 2 probes
+        conn = sqlite3.connect(self.test_db)
+        errors = conn.execute('SELECT COUNT(*) FROM speedtests WHERE error IS NOT NULL').fetchone()[0]
+        self.assertTrue(0 < errors < rows / 2)
+        self.assertEqual(len(probes.list_probes(conn.cursor())), 2)
+        # The generator goes through the collector's write path, rollups included
+        self.assertEqual(rollups.overall_aggregate(conn.cursor())['total_count'], rows)
+        conn.close()
+        
+        results = bench.run_benchmarks(self.test_db, iterations=2, offset=1)
+        self.assertEqual(app.config['DATABASE'], self.test_db)
+        for name in ('get_stats', 'get_plot_data', 'get_distribution_data',
+                     'index_cold', 'offset_warm'):
+            self.assertLessEqual(results[name]['p50_ms'], results[name]['max_ms'])
+            self.assertGreater(results[name]['peak_kib'], 0)
+        self.assertGreater(results['index_cold']['bytes'], 1000)
+        baseline = {'results': {'get_stats': dict(results['get_stats'],
+                                                  p50_ms=results['get_stats']['p50_ms'] * 2)}}
+        self.assertIn('p50_ms -50%', bench.compare(results, baseline)[0])
+    
+    def test_metrics(self):
+        """Test the Prometheus endpoints of the dashboard and the collector"""
+        registry = metrics.Registry()
+        hist = metrics.Histogram('t_seconds', 'test', ['route'], buckets=(0.1, 1), registry=registry)
+        hist.labels('/a"b').observe(0.5)
+        hist.labels('/a"b').observe(5)
+        metrics.Counter('t_total', 'test', registry=registry).inc(2)
+        text = registry.render()
+        self.assertIn('t_seconds_bucket{route="/a\\"b",le="0.1"} 0', text)
+        self.assertIn('t_seconds_bucket{route="/a\\"b",le="1.0"} 1', text)
+        self.assertIn('t_seconds_bucket{route="/a\\"b",le="+Inf"} 2', text)
+        self.assertIn('t_seconds_sum{route="/a\\"b"} 5.5', text)
+        self.assertIn('# TYPE t_total counter\nt_total 2.0', text)
+        with self.assertRaises(ValueError):
+            metrics.Counter('t_total', 'again', registry=registry)
+        
+        save_result({'download': 95.0, 'upload': 42.0, 'ping': 11.0, 'error': None},
+                    self.test_db, 'office')
+        self.client.get('/')
+        self.client.get('/api/stats')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.data.decode()
+        self.assertRegex(text, r'bandwidth_probe_http_request_duration_seconds_count'
+                               r'\{route="/",method="GET",status="200"\} [1-9]')
+        self.assertIn('route="/api/stats"', text)
+        self.assertRegex(text, r'bandwidth_probe_sql_duration_seconds_count\{query="period_aggregate"\} [1-9]')
+        self.assertRegex(text, r'bandwidth_probe_render_duration_seconds_count\{template="index.html"\} [1-9]')
+        self.assertIn('bandwidth_probe_download_mbps{probe="office"} 95.0', text)
+        self.assertIn('bandwidth_probe_ping_ms{probe="office"} 11.0', text)
+        
+        # The collector records its runs and serves them on its own port
+        self._install_stub_speedtest()
+        result = asyncio.run(speedtest_collector.measure(speedtest_collector.DEFAULT_TARGET))
+        self.assertIsNone(result['error'])
+        server = metrics.start_http_server(0, '127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.server_port) as response:
+            text = response.read().decode()
+        self.assertRegex(text, r'bandwidth_probe_results_total\{target="local",outcome="success"\} [1-9]')
+        self.assertRegex(text, r'bandwidth_probe_speedtest_duration_seconds_count'
+                               r'\{target="local",engine="speedtest"\} [1-9]')
+        self.assertRegex(text, r'bandwidth_probe_speedtest_parse_seconds_count [1-9]')
+        self.assertRegex(text, r'bandwidth_probe_save_duration_seconds_count\{stage="database"\} [1-9]')
+        self.assertIn('bandwidth_probe_download_mbps{probe="local"} 93.5', text)
+
+    def test_export(self):
+        """Test streaming exports of the raw history"""
+        total = bench.generate_history(self.test_db, days=1, interval=10, probe_count=2, seed=3)
+        conn = sqlite3.connect(self.test_db)
+        batches = list(export.iter_batches(conn, batch_size=100))
+        self.assertEqual([len(rows) for rows in batches[:-1]], [100] * (len(batches) - 1))
+        self.assertEqual(sum(len(rows) for rows in batches), total)
+        chunks = list(export.export(conn, 'csv', batch_size=100))
+        self.assertEqual(len(chunks), len(batches) + 1)  # header, then one chunk per batch
+        conn.close()
+
+        response = self.client.get('/export/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/csv'))
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], ','.join(export.COLUMNS))
+        self.assertEqual(len(lines), total + 1)
+
+        # Half-open time range and probe filter
+        start = int(lines[1].split(',')[1]) + 3600
+        response = self.client.get('/export/ndjson?probe=probe-1&start=%d&end=%d'
+                                   % (start, start + 7200))
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual({row['probe_id'] for row in rows}, {'probe-1'})
+        self.assertTrue(all(start <= row['ts'] < start + 7200 for row in rows))
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(self.client.get('/export/csv?start=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/export/xml').status_code, 404)
+
+        # Compression follows Accept-Encoding
+        response = self.client.get('/export/csv', headers={'Accept-Encoding': 'br, gzip;q=0.8'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(len(gzip.decompress(response.data).decode().splitlines()), total + 1)
+
+        # Columnar formats need pyarrow
+        response = self.client.get('/export/parquet')
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.assertEqual(response.status_code, 501)
+        else:
+            table = pq.read_table(io.BytesIO(response.data))
+            self.assertEqual(table.num_rows, total)
+
+    def test_shared_snapshot(self):
+        """Test worker processes share computed payloads through the snapshot file"""
+        path = os.path.join(tempfile.mkdtemp(), 'test.snapshot')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        calls = []
+        def compute(value):
+            calls.append(value)
+            return value
+        first, second = SharedSnapshot(path, max_entries=3), SharedSnapshot(path, max_entries=3)
+        payload = {'download': {'min': 1.5, 'max': None}, 'counts': [1, 2]}
+        self.assertEqual(first.get_or_compute(('stats', 1), lambda: compute(payload)), payload)
+        # The other worker maps the file instead of computing again
+        self.assertEqual(second.get_or_compute(('stats', 1), lambda: compute('again')), payload)
+        self.assertEqual(calls, [payload])
+        self.assertEqual(second.stats()['hits'], 1)
+        self.assertIsNone(second.get_or_compute(('none',), lambda: compute(None)))
+        self.assertIsNone(first.get_or_compute(('none',), lambda: compute('again')))
+        # Oldest entries are dropped beyond max_entries
+        for i in range(2, 5):
+            second.get_or_compute(('stats', i), lambda: compute(i))
+        self.assertEqual(first.stats()['size'], 3)
+        self.assertEqual(first.get_or_compute(('stats', 1), lambda: compute('recomputed')),
+                         'recomputed')
+        # A torn file is treated as empty
+        with open(path, 'wb') as f:
+            f.write(b'BPSNAP1\n\xff')
+        self.assertEqual(first.get_or_compute(('stats', 4), lambda: compute(44)), 44)
+        # So is an empty one, which can't be mapped
+        open(path, 'wb').close()
+        self.assertEqual(first.get_or_compute(('stats', 4), lambda: compute(45)), 45)
+        self.assertEqual(second.get_or_compute(('stats', 4), lambda: compute('again')), 45)
+        # A miss appends one record instead of rewriting the file
+        inode, size = os.stat(path).st_ino, os.path.getsize(path)
+        first.get_or_compute(('stats', 5), lambda: compute(5))
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(os.path.getsize(path),
+                         size + snapshot.RECORD.size + len(repr(('stats', 5))) + 1)
+        self.assertEqual(second.get_or_compute(('stats', 5), lambda: compute('again')), 5)
+        # Misses on different keys are computed concurrently, not one at a time
+        started = threading.Event()
+        def slow():
+            started.set()
+            self.assertTrue(done.wait(5))
+            return 'slow'
+        done = threading.Event()
+        thread = threading.Thread(target=first.get_or_compute, args=(('slow',), slow))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(second.get_or_compute(('fast',), lambda: 'fast'), 'fast')
+        done.set()
+        thread.join()
+        self.assertEqual(second.get_or_compute(('slow',), lambda: compute('again')), 'slow')
+        
+        # Served by several workers, the dashboard publishes its payloads once
+        self._insert_history(hours=24)
+        process, port = loadtest.start_server(self.test_db, 2)
+        try:
+            report = loadtest.run_load('127.0.0.1', port, ['/api/stats', '/api/series', '/'],
+                                       clients=2, duration=0.5)
+        finally:
+            loadtest.stop_server(process)
+        self.assertGreater(report['requests'], 0)
+        self.assertEqual(report['errors'], 0)
+        shared = SharedSnapshot(os.path.splitext(self.test_db)[0] + '.snapshot')
+        self.addCleanup(os.remove, shared.path + '.lock')
+        self.addCleanup(shared.clear)
+        self.assertGreaterEqual(shared.stats()['size'], 3)
+    
+    def test_lean_imports(self):
+        """Test the collector starts without NumPy or HTTP modules, and nothing loads pandas or plotly"""
+        results = bench.run_startup(runs=1)
+        # Nor the HTTP stack: the throughput engine and metrics server load it on demand
+        self.assertEqual(results['collector']['modules'], [])
+        self.assertEqual(results['web']['modules'][:2], ['numpy', 'flask'])
+        self.assertNotIn('pandas', results['web']['modules'])
+        self.assertNotIn('plotly', results['web']['modules'])
+        for report in results.values():
+            self.assertGreater(report['rss_kib'], 0)
+            self.assertGreater(report['p50_ms'], report['import_ms'])
+        # Dense sketch functions still work once NumPy is loaded on demand
+        counts = sketch.merge([sketch.add_values(b'', [10.0, 20.0, 30.0])])
+        self.assertAlmostEqual(sketch.quantiles(counts, [0.5])[0], 20.0, delta=0.5)
+    
     def test_web_interface(self):
         """Test web interface with empty database"""
         logger.info("Running web interface test")
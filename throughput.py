@@ -0,0 +1,331 @@
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Built-in alternative to the speedtest binary: N parallel HTTP streams
+# against a server of our own (see serve()), so internal links can be
+# measured too and a run costs no process spawn.
+DEFAULT_STREAMS = 4
+DEFAULT_DURATION = 10.0  # seconds per direction, warm-up included
+DEFAULT_WARMUP = 2.0     # seconds discarded while TCP windows open up
+DEFAULT_INTERVAL = 0.5   # seconds per throughput sample
+PING_COUNT = 5
+SOCKET_TIMEOUT = 10.0
+DEFAULT_PORT = 8081
+
+BUFFER_SIZE = 1 << 20    # per stream, allocated once
+STREAM_BYTES = 1 << 50   # Content-Length of an open-ended transfer
+MAX_UPLOAD_BYTES = STREAM_BYTES  # largest upload the server accepts
+MAX_HEAD_SIZE = 16384
+
+class ThroughputHandler(BaseHTTPRequestHandler):
+    """Serves /ping, /download?bytes=N and /upload for the probe engine"""
+
+    protocol_version = 'HTTP/1.1'
+    payload = memoryview(bytes(BUFFER_SIZE))
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _reply(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/ping':
+            self._reply(200)
+        elif url.path == '/download':
+            try:
+                remaining = int(parse_qs(url.query).get('bytes', [STREAM_BYTES])[0])
+            except ValueError:
+                self._reply(400)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(remaining))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            try:
+                while remaining > 0:
+                    chunk = self.payload if remaining >= len(self.payload) else self.payload[:remaining]
+                    self.connection.sendall(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stops reading once its test is over
+                self.close_connection = True
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/upload':
+            self._reply(404)
+            return
+        length = self.headers.get('Content-Length')
+        status = (411 if length is None else 400 if not (length.isascii() and length.isdigit())
+                  else 413 if int(length) > MAX_UPLOAD_BYTES else None)
+        if status is not None:
+            # Whatever body follows is left unread, so the connection can't be reused
+            self.close_connection = True
+            self._reply(status)
+            return
+        remaining = int(length)
+        view = memoryview(bytearray(BUFFER_SIZE))
+        received = 0
+        try:
+            while remaining > 0:
+                n = self.rfile.readinto(view[:min(remaining, len(view))])
+                if not n:
+                    break
+                received += n
+                remaining -= n
+        except ConnectionResetError:
+            pass
+        if remaining > 0:
+            # Open-ended upload cut short by the client: nobody to answer
+            self.close_connection = True
+            return
+        self._reply(200, json.dumps({'bytes': received}).encode())
+
+class ThroughputServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(host='0.0.0.0', port=DEFAULT_PORT):
+    """Run the throughput server until interrupted"""
+    server = ThroughputServer((host, port), ThroughputHandler)
+    logger.info("Throughput server listening on %s:%d", host, server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def _connect(host, port, timeout=SOCKET_TIMEOUT):
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def _read_head(sock, buf):
+    """Read a response head into buf; returns (status, headers, body bytes already read)"""
+    view = memoryview(buf)
+    size = 0
+    while True:
+        n = sock.recv_into(view[size:MAX_HEAD_SIZE])
+        if not n:
+            raise ConnectionError('connection closed by server')
+        size += n
+        end = buf.find(b'\r\n\r\n', 0, size)
+        if end >= 0:
+            break
+        if size >= MAX_HEAD_SIZE:
+            raise ValueError('response head too large')
+    lines = bytes(buf[:end]).decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(lines[0].split()[1]), headers, size - end - 4
+
+def _request_head(method, host, path, length=None):
+    head = '%s %s HTTP/1.1\r\nHost: %s\r\n' % (method, path, host)
+    if length is not None:
+        head += 'Content-Type: application/octet-stream\r\nContent-Length: %d\r\n' % length
+    return (head + '\r\n').encode('latin-1')
+
+class _Stream(threading.Thread):
+    """One connection moving data as fast as it can until stopped
+
+    count is only ever written by this thread; the sampler reads it.
+    """
+
+    def __init__(self, host, port, prefix, direction, stop):
+        super().__init__(daemon=True)
+        self.host, self.port, self.prefix = host, port, prefix
+        self.direction = direction
+        self.stop = stop
+        self.count = 0
+        self.error = None
+        self.sock = None
+
+    def run(self):
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        try:
+            self.sock = sock = _connect(self.host, self.port)
+            if self.direction == 'download':
+                sock.sendall(_request_head('GET', self.host, self.prefix + '/download'))
+                status, _, self.count = _read_head(sock, buf)
+                if status != 200:
+                    raise ValueError('download returned HTTP %d' % status)
+                recv_into = sock.recv_into
+                while not self.stop.is_set():
+                    n = recv_into(view)
+                    if not n:
+                        break
+                    self.count += n
+            else:
+                sock.sendall(_request_head('POST', self.host, self.prefix + '/upload', STREAM_BYTES))
+                send = sock.send
+                while not self.stop.is_set():
+                    self.count += send(view)
+        except (OSError, ValueError) as e:
+            if not self.stop.is_set():
+                self.error = e
+        finally:
+            if self.sock is not None:
+                self.sock.close()
+
+    def interrupt(self):
+        """Unblock a pending recv/send once the test is over"""
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def measure_direction(host, port, prefix, direction, streams=DEFAULT_STREAMS,
+                      duration=DEFAULT_DURATION, warmup=DEFAULT_WARMUP,
+                      interval=DEFAULT_INTERVAL):
+    """Measure throughput one way over parallel streams
+
+    Returns (mbps, samples): mbps covers everything after the warm-up;
+    samples holds (seconds since start, Mbps) for every interval,
+    warm-up included.
+    """
+    stop = threading.Event()
+    workers = [_Stream(host, port, prefix, direction, stop) for _ in range(streams)]
+    for worker in workers:
+        worker.start()
+    start = last_time = time.perf_counter()
+    last_total = 0
+    warm = None
+    samples = []
+    tick = 1
+    try:
+        while True:
+            time.sleep(max(0.0, start + tick * interval - time.perf_counter()))
+            tick += 1
+            now = time.perf_counter()
+            total = sum(worker.count for worker in workers)
+            samples.append((round(now - start, 3),
+                            (total - last_total) * 8 / (now - last_time) / 1e6))
+            last_total, last_time = total, now
+            if warm is None and now - start >= warmup:
+                warm = (total, now)
+            if now - start >= duration or not any(worker.is_alive() for worker in workers):
+                break
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.interrupt()
+        for worker in workers:
+            worker.join(SOCKET_TIMEOUT)
+    errors = [worker.error for worker in workers if worker.error is not None]
+    if errors and len(errors) == len(workers):
+        raise errors[0]
+    if warm is None or last_time <= warm[1]:
+        raise ValueError('%s ended during the warm-up' % direction)
+    return (last_total - warm[0]) * 8 / (last_time - warm[1]) / 1e6, samples
+
+def measure_latency(host, port, prefix, count=PING_COUNT):
+    """Median round-trip time in ms of /ping requests on one kept-alive connection"""
+    buf = bytearray(MAX_HEAD_SIZE)
+    request = _request_head('GET', host, prefix + '/ping')
+    rtts = []
+    with _connect(host, port) as sock:
+        for _ in range(count):
+            start = time.perf_counter()
+            sock.sendall(request)
+            status, _, _ = _read_head(sock, buf)
+            rtts.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                raise ValueError('ping returned HTTP %d' % status)
+    return statistics.median(rtts)
+
+def run_probe(url, streams=DEFAULT_STREAMS, duration=DEFAULT_DURATION,
+              warmup=DEFAULT_WARMUP, interval=DEFAULT_INTERVAL):
+    """Measure latency, download and upload against a throughput server
+
+    Returns a result dict shaped like run_speedtest's, plus the
+    per-interval samples of each direction.
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 'http' or not parts.hostname:
+        return {'error': 'Unsupported probe URL: %s' % url}
+    host, port, prefix = parts.hostname, parts.port or 80, parts.path.rstrip('/')
+    try:
+        ping = measure_latency(host, port, prefix)
+        download, download_samples = measure_direction(host, port, prefix, 'download',
+                                                       streams, duration, warmup, interval)
+        upload, upload_samples = measure_direction(host, port, prefix, 'upload',
+                                                   streams, duration, warmup, interval)
+    except (OSError, ValueError) as e:
+        logger.error("Throughput probe against %s failed: %s", url, str(e))
+        return {'error': str(e) or e.__class__.__name__}
+    return {
+        'download': download,
+        'upload': upload,
+        'ping': ping,
+        'error': None,
+        'samples': {'download': download_samples, 'upload': upload_samples}
+    }
+
+def _probe_parser():
+    parser = argparse.ArgumentParser(prog='throughput.py measure',
+                                     description='Measure throughput against a throughput server')
+    parser.add_argument('url', help='server URL, e.g. http://10.0.0.5:%d' % DEFAULT_PORT)
+    parser.add_argument('--streams', type=int, default=DEFAULT_STREAMS)
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION)
+    parser.add_argument('--warmup', type=float, default=DEFAULT_WARMUP)
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL)
+    return parser
+
+def parse_probe_args(args):
+    """Parse URL [--streams N] [--duration S] [--warmup S] [--interval S]"""
+    try:
+        return _probe_parser().parse_args(args)
+    except SystemExit:
+        raise ValueError('invalid throughput probe arguments: %s' % ' '.join(args))
+
+def run_from_args(args):
+    """run_probe from command-line style arguments (see parse_probe_args)"""
+    options = parse_probe_args(args)
+    return run_probe(options.url, options.streams, options.duration,
+                     options.warmup, options.interval)
+
+def _main():
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        parser = argparse.ArgumentParser(prog='throughput.py serve',
+                                         description='Run a throughput server')
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+        options = parser.parse_args(sys.argv[2:])
+        try:
+            serve(options.host, options.port)
+        except KeyboardInterrupt:
+            pass
+    elif len(sys.argv) > 1 and sys.argv[1] == 'measure':
+        options = _probe_parser().parse_args(sys.argv[2:])
+        print(json.dumps(run_probe(options.url, options.streams, options.duration,
+                                   options.warmup, options.interval), indent=2))
+    else:
+        print('usage: throughput.py {serve,measure} ...', file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    _main()
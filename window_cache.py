@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+import rollups
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW_SECONDS = 7 * 86400
+
+_COLUMNS = ('id', 'ts', 'download', 'upload', 'ping', 'error')
+_EMPTY = {
+    'id': np.zeros(0, dtype=np.int64),
+    'ts': np.zeros(0, dtype=np.int64),
+    'download': np.zeros(0),
+    'upload': np.zeros(0),
+    'ping': np.zeros(0),
+    'error': np.zeros(0, dtype=bool),
+}
+
+class WindowCache:
+    """Process-wide columnar copy of the most recent samples
+
+    Holds NumPy arrays (id, ts, download, upload, ping and an error mask)
+    sorted by ts and covering the last window_seconds. The first sync
+    loads the window; later syncs only fetch rows with a higher rowid and
+    trim samples that have aged out, so stats, series and distributions
+    for recent windows never re-query the raw table.
+
+    Rows are assumed append-only inside the window; updates or deletes
+    of already-cached rows are not picked up.
+    """
+
+    def __init__(self, window_seconds=DEFAULT_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, source):
+        self.source = source
+        self.last_id = 0
+        self.last_row = None
+        self.coverage_start = None
+        self.columns = dict(_EMPTY)
+
+    def clear(self):
+        """Drop everything; the next sync reloads the window"""
+        with self._lock:
+            self._reset(None)
+
+    @staticmethod
+    def _identify(conn):
+        """Identify the database file behind conn (path and inode)"""
+        path = conn.execute('PRAGMA database_list').fetchone()[2]
+        if not path:
+            return None
+        st = os.stat(path)
+        return path, st.st_dev, st.st_ino
+
+    def sync(self, conn, now=None):
+        """Load or tail new rows from conn; returns the current column snapshot"""
+        now = time.time() if now is None else now
+        with self._lock:
+            source = self._identify(conn)
+            if source != self.source or not self._still_valid(conn):
+                self._reset(source)
+            cutoff = int(now) - self.window_seconds
+            if self.coverage_start is not None and cutoff < self.coverage_start:
+                # The window was widened; reload rather than leave a hole
+                self._reset(source)
+            if self.coverage_start is None:
+                self.coverage_start = cutoff
+                rows = conn.execute('''
+                    SELECT id, ts, download, upload, ping, error IS NOT NULL
+                    FROM main.speedtests
+                    WHERE ts >= ?
+                    ORDER BY ts
+                ''', (cutoff,)).fetchall()
+                logger.debug("Window cache loaded %d rows", len(rows))
+            else:
+                rows = conn.execute('''
+                    SELECT id, ts, download, upload, ping, error IS NOT NULL
+                    FROM main.speedtests
+                    WHERE id > ?
+                    ORDER BY id
+                ''', (self.last_id,)).fetchall()
+            self._append(rows)
+            self._trim(cutoff)
+            return self.columns
+
+    def _still_valid(self, conn):
+        """Check the newest row seen so far is still there unchanged"""
+        if self.last_row is None:
+            return True
+        row = conn.execute('SELECT id, ts FROM main.speedtests WHERE id = ?',
+                           (self.last_row[0],)).fetchone()
+        return row == self.last_row
+
+    def _append(self, rows):
+        if not rows:
+            return
+        new = np.array(rows, dtype=np.float64)
+        newest = int(new[:, 0].argmax())
+        if int(new[newest, 0]) > self.last_id:
+            self.last_id = int(new[newest, 0])
+            self.last_row = (self.last_id, int(new[newest, 1]))
+        # Rows from before the covered range (e.g. back-filled history)
+        # are left to the rollups
+        new = new[new[:, 1] >= self.coverage_start]
+        columns = {
+            'id': new[:, 0].astype(np.int64),
+            'ts': new[:, 1].astype(np.int64),
+            'download': new[:, 2],
+            'upload': new[:, 3],
+            'ping': new[:, 4],
+            'error': new[:, 5].astype(bool),
+        }
+        merged = {name: np.concatenate([self.columns[name], columns[name]]) for name in _COLUMNS}
+        if len(merged['ts']) > 1 and (np.diff(merged['ts']) < 0).any():
+            order = np.argsort(merged['ts'], kind='stable')
+            merged = {name: merged[name][order] for name in _COLUMNS}
+        # Replace the dict wholesale so readers keep a consistent snapshot
+        self.columns = merged
+
+    def _trim(self, cutoff):
+        if cutoff <= self.coverage_start:
+            return
+        start = np.searchsorted(self.columns['ts'], cutoff, side='left')
+        self.columns = {name: self.columns[name][start:] for name in _COLUMNS}
+        self.coverage_start = cutoff
+
+    def covers(self, start_ts):
+        """Whether the window start_ts < ts <= end is fully held in memory"""
+        return self.coverage_start is not None and start_ts + 1 >= self.coverage_start
+
+    @staticmethod
+    def _slice(columns, start_ts, end_ts):
+        ts = columns['ts']
+        lo = np.searchsorted(ts, start_ts, side='right')
+        hi = np.searchsorted(ts, end_ts, side='right')
+        return {name: columns[name][lo:hi] for name in _COLUMNS}
+
+    def aggregate(self, columns, start_ts, end_ts):
+        """Aggregate start_ts < ts <= end_ts in rollups.AGG_FIELDS form"""
+        window = self._slice(columns, start_ts, end_ts)
+        ok = ~window['error']
+        result = {
+            'total_count': int(len(window['ts'])),
+            'error_count': int(window['error'].sum()),
+            'count': int(ok.sum()),
+        }
+        for metric in rollups.METRICS:
+            values = window[rollups.METRIC_COLUMNS[metric]][ok]
+            values = values[~np.isnan(values)]
+            empty = not len(values)
+            result[metric + '_sum'] = float(values.sum())
+            result[metric + '_sumsq'] = float((values * values).sum())
+            result[metric + '_min'] = None if empty else float(values.min())
+            result[metric + '_max'] = None if empty else float(values.max())
+        return result
+
+    def values(self, columns, metric, start_ts, end_ts):
+        """Successful values of one metric with start_ts < ts <= end_ts"""
+        window = self._slice(columns, start_ts, end_ts)
+        return window[rollups.METRIC_COLUMNS[metric]][~window['error']]
+
+    def series(self, columns, start_ts, end_ts):
+        """(ts, download, upload) arrays of the successful samples in the window"""
+        window = self._slice(columns, start_ts, end_ts)
+        ok = ~window['error']
+        return window['ts'][ok], window['download'][ok], window['upload'][ok]